@@ -0,0 +1,146 @@
+# ------------------------------------------------------------------------
+# coding=utf-8
+# ------------------------------------------------------------------------
+#
+#  Headless benchmark of the UWB particle filter in simulation mode
+# ------------------------------------------------------------------------
+#
+#  Runs the SIMULATION loop of particle_filter.py without turtle or plots
+#  over a grid of particle counts, anchor counts, RANDOM_LOSS and SIGMA
+#  settings and fixed seeds, and appends one JSON line per run, e.g.
+#
+#    python benchmark.py --particles 500 2000 10000 --anchors 4 8 --seeds 0 1 2
+#
+
+import matplotlib
+matplotlib.use("Agg")   # no windows, plot_3d is only imported
+
+import argparse
+import itertools
+import json
+import platform
+import time
+
+import numpy as np
+
+from draw import Maze
+from particle_filter import (Particle, ParticleFilter, Robot, ROOM_MARGIN, SIGMA, SIM_STEP_INTERVAL, Z_RANGE,
+                             compute_mean_point, free_space_checker)
+
+# The 4 anchors of the lab setup, followed by extra anchors along the walls
+# for the anchor count sweep. Unit in cm
+BENCHMARK_ANCHORS = [('C584',16,0,151), ('DA36',40,325,79), ('9234',291,285,55), ('8287',270,0,134),
+                     ('A004',150,0,120), ('A005',290,150,90), ('A006',150,320,70), ('A007',20,160,110)]
+STAGES = ("weight", "normalize", "resample", "move", "mean")
+
+
+def run_benchmark(particle_count, anchor_count, random_loss, sigma, seed, steps=100,
+                  resampling="systematic", adaptive_count=False, speed=0):
+    """
+    One headless SIMULATION run, returns a dict of the settings, the
+    throughput, the mean time per step of every stage (ms) and the
+    localization error (cm) of the mean point against the Robot.
+    """
+    world_rng, robot_rng, filter_rng, loss_rng = [
+        np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(4)]
+    world = Maze(None, anc_list=BENCHMARK_ANCHORS[:anchor_count], turtle_init=False, rng=world_rng,
+                 z_range=Z_RANGE, margin=ROOM_MARGIN)
+    pf = ParticleFilter(Particle.create_random_particles(particle_count, world, rng=filter_rng), world,
+                        resampling=resampling, adaptive_count=adaptive_count,
+                        max_particles=max(particle_count, 10000), sigma=sigma, rng=filter_rng)
+    robbie = Robot(world, rng=robot_rng)
+    checker = free_space_checker(world, z_range=Z_RANGE)
+
+    stage_time = dict.fromkeys(STAGES, 0.0)
+    errors, confident, particle_counts = [], 0, []
+    start = time.perf_counter()
+    for _ in range(steps):
+        robbie_position = robbie.x, robbie.y, robbie.z
+        r_ds = robbie.sim_read_sensors(world)
+        if random_loss:
+            lost = loss_rng.choice(len(r_ds), loss_rng.integers(0, len(r_ds) + 1), replace=False)
+            for i in lost:
+                r_ds[i] = float('inf')
+
+        t0 = time.perf_counter()
+        particles = pf.particles
+        is_free = world.is_free_batch(particles.xyz)
+        pf.update_weights(r_ds, world.distance_matrix(particles.xyz), is_free)
+        t1 = time.perf_counter()
+        m_x, m_y, m_z, confidence_indicator = compute_mean_point(world, particles, dist_threshold=5)
+        t2 = time.perf_counter()
+        pf.normalize()
+        t3 = time.perf_counter()
+        pf.resample_if_needed()
+        t4 = time.perf_counter()
+        old_xy_heading = robbie.xy_heading
+        robbie.move(world, speed=speed, delta_t=SIM_STEP_INTERVAL)
+        pf.predict(speed, d_xy_heading=robbie.xy_heading - old_xy_heading, delta_t=SIM_STEP_INTERVAL,
+                   checker=checker)
+        t5 = time.perf_counter()
+
+        stage_time["weight"] += t1 - t0
+        stage_time["mean"] += t2 - t1
+        stage_time["normalize"] += t3 - t2
+        stage_time["resample"] += t4 - t3
+        stage_time["move"] += t5 - t4
+        # the estimate belongs to the position the ranges were read at, i.e. before the move
+        if m_x != -1:
+            errors.append(world.euclidean_dist(m_x, m_y, m_z, *robbie_position))
+        confident += confidence_indicator
+        particle_counts.append(len(pf.particles))
+    elapsed = time.perf_counter() - start
+
+    errors = np.asarray(errors)
+    return {
+        "particles": particle_count,
+        "anchors": anchor_count,
+        "random_loss": random_loss,
+        "sigma": sigma,
+        "seed": seed,
+        "steps": steps,
+        "resampling": resampling,
+        "adaptive_count": adaptive_count,
+        "steps_per_sec": steps / elapsed,
+        "stage_ms": {stage: 1000 * t / steps for stage, t in stage_time.items()},
+        "error_mean": float(errors.mean()) if len(errors) else None,
+        "error_median": float(np.median(errors)) if len(errors) else None,
+        "error_p95": float(np.percentile(errors, 95)) if len(errors) else None,
+        "error_final": float(errors[-1]) if len(errors) else None,
+        "confident_fraction": confident / steps,
+        "mean_particle_count": float(np.mean(particle_counts)),
+        "resample_count": pf.resample_count,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Headless particle filter benchmark")
+    parser.add_argument("--particles", type=int, nargs="+", default=[500, 2000, 10000])
+    parser.add_argument("--anchors", type=int, nargs="+", default=[4],
+                        help="anchor counts, 3 to {}".format(len(BENCHMARK_ANCHORS)))
+    parser.add_argument("--random-loss", type=int, nargs="+", default=[0], choices=[0, 1])
+    parser.add_argument("--sigma", type=float, nargs="+", default=[SIGMA])
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0, 1, 2])
+    parser.add_argument("--steps", type=int, default=100)
+    parser.add_argument("--resampling", default="systematic")
+    parser.add_argument("--adaptive", action="store_true", help="KLD-adaptive particle count")
+    parser.add_argument("--output", default="benchmark_results.jsonl",
+                        help="JSON lines file the results are appended to")
+    args = parser.parse_args()
+
+    run_info = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+                "numpy": np.__version__, "machine": platform.machine()}
+    print("{:>9} {:>7} {:>4} {:>6} {:>4} {:>9} {:>8} {:>8} {:>8}  stage ms ({})"
+          .format("particles", "anchors", "loss", "sigma", "seed", "steps/s", "err mean", "err p95",
+                  "err end", ", ".join(STAGES)))
+    with open(args.output, "a") as f:
+        for particle_count, anchor_count, random_loss, sigma, seed in itertools.product(
+                args.particles, args.anchors, args.random_loss, args.sigma, args.seeds):
+            result = run_benchmark(particle_count, anchor_count, bool(random_loss), sigma, seed,
+                                   steps=args.steps, resampling=args.resampling,
+                                   adaptive_count=args.adaptive)
+            f.write(json.dumps(dict(result, **run_info)) + "\n")
+            f.flush()
+            print("{particles:>9} {anchors:>7} {random_loss:>4d} {sigma:>6g} {seed:>4} {steps_per_sec:>9.1f} "
+                  "{error_mean:>8.1f} {error_p95:>8.1f} {error_final:>8.1f}  ".format(**result)
+                  + " ".join("{:.2f}".format(result["stage_ms"][s]) for s in STAGES))
@@ -9,9 +9,10 @@
 import math
 import turtle
 
-import random
 import time
 
+import numpy as np
+
 from typing import (Dict, List, Tuple, Set)
 
 UPDATE_EVERY = 0
@@ -28,14 +29,24 @@ DRAW_EVERY = 0
 #                 ( 3, 0, 0, 0, 0, 0, 0, 0, 0, 3 ))
 
 class Maze(object):
-    def __init__(self, maze_matrix, anc_list=None, block_width=5, turtle_init=True):
+    """
+    The world of the anchors. The free space is a precomputed 3D boolean
+    voxel grid (voxel_size cm) over the anchor bounds widened by margin and
+    the allowed z_range band (floor to the highest anchor if None), with
+    the occupied cells of maze_matrix (block_width wide squares, row 0 at
+    the top, extruded over all z) and the obstacles, boxes given as
+    (x0, y0, z0, x1, y1, z1), carved out.
+    """
+    def __init__(self, maze_matrix, anc_list=None, block_width=5, turtle_init=True, rng=None,
+                 z_range=None, obstacles=None, voxel_size=5, margin=0):
+        self.rng = rng if rng is not None else np.random.default_rng()
         self.block_witdh = block_width
         self.blocks = []
         for anc in anc_list:
             self.blocks.append((anc[1]-self.block_witdh/2, anc[2]-self.block_witdh/2))
         self.update_cnt = 0
         self.beacons = []
-        self.maze = None
+        self.maze = maze_matrix
         self.anchor_x_list = [anc[1] for anc in anc_list]
         self.anchor_y_list = [anc[2] for anc in anc_list]
         self.anchor_z_list = [anc[3] for anc in anc_list]
@@ -43,6 +54,16 @@ class Maze(object):
         self.width = max(self.anchor_y_list) - min(self.anchor_y_list)
         self.height = max(self.anchor_z_list) - min(self.anchor_z_list)
         self.beacons = anc_list
+        # anchor positions as one (M, 3) array, rows keyed by anchor id
+        self.anchor_ids = [anc[0] for anc in anc_list]
+        self.anchor_index = {anc_id: i for i, anc_id in enumerate(self.anchor_ids)}
+        self.anchor_xyz = np.asarray([anc[1:4] for anc in anc_list], dtype=float).reshape(-1, 3)
+        if z_range is None:
+            z_range = (min(0, min(self.anchor_z_list)), max(self.anchor_z_list))
+        self.bounds_min = np.array([min(self.anchor_x_list) - margin, min(self.anchor_y_list) - margin, min(z_range)])
+        self.bounds_max = np.array([max(self.anchor_x_list) + margin, max(self.anchor_y_list) + margin, max(z_range)])
+        self.voxel_size = voxel_size
+        self.voxels = self.build_voxel_grid(obstacles or [])
         
         if turtle_init:
             turtle.tracer(0, delay=0)
@@ -82,35 +103,59 @@ class Maze(object):
     def weight_to_color(self, weight):
         return "#%02x00%02x" % (int(weight * 255), int((1 - weight) * 255))
 
+    def build_voxel_grid(self, obstacles):
+        """
+        Boolean (nx, ny, nz) grid of the free voxels, from the voxel centers.
+        """
+        shape = np.floor((self.bounds_max - self.bounds_min) / self.voxel_size).astype(int) + 1
+        centers = [self.bounds_min[i] + (np.arange(shape[i]) + 0.5) * self.voxel_size for i in range(3)]
+        free = np.ones(shape, dtype=bool)
+        if self.maze:
+            # 0 - empty square
+            # 1 - occupied square
+            # 2 - occupied square with a beacon at each corner, detectable by the robot
+            # 3 - occupied square with a beacon at the sensor, detectable by the robot
+            occupied = np.asarray(self.maze) != 0
+            rows = np.floor((self.bounds_max[1] - centers[1]) / self.block_witdh).astype(int)
+            cols = np.floor((centers[0] - self.bounds_min[0]) / self.block_witdh).astype(int)
+            in_x = cols < occupied.shape[1]
+            in_y = rows < occupied.shape[0]
+            blocked = np.zeros((shape[0], shape[1]), dtype=bool)
+            blocked[np.ix_(in_x, in_y)] = occupied[np.ix_(rows[in_y], cols[in_x])].T
+            free &= ~blocked[:, :, np.newaxis]
+        for x0, y0, z0, x1, y1, z1 in obstacles:
+            inside = [(c >= min(lo, hi)) & (c <= max(lo, hi)) for c, lo, hi in zip(centers, (x0, y0, z0), (x1, y1, z1))]
+            free[np.ix_(*inside)] = False
+        return free
+
     def is_in(self, x, y, z=None, **kwargs):
-        if x < min(self.anchor_x_list) \
-        or x > max(self.anchor_x_list) \
-        or y < min(self.anchor_y_list) \
-        or y > max(self.anchor_y_list):
-            if kwargs.get('z_range', None) is None:
-                pass
-            else:
-                if z > kwargs.get('z_range')[1] \
-                or z < kwargs.get('z_range')[0]:
-                    return False
-        return True
+        return bool(self.is_in_batch((x, y, z if z is not None else self.bounds_min[2]), **kwargs)[0])
 
     def is_free(self, x, y, z=None, **kwargs):
-        if not z:
-            z = min(self.anchor_z_list)
-        if not self.is_in(x, y, z, **kwargs):
-            return False
-        
-        yy = self.width - int(y) - 1
-        xx = int(x)
-        if self.maze:
-            return self.maze[yy][xx] == 0
-        return True
+        return bool(self.is_free_batch((x, y, z if z is not None else self.bounds_min[2]), **kwargs)[0])
+
+    def is_in_batch(self, xyz, **kwargs):
+        """
+        Boolean array of the places of an (N, 3) array inside the bounds of
+        the world, and inside the z_range keyword argument if given.
+        """
+        xyz = np.asarray(xyz, dtype=float).reshape(-1, 3)
+        inside = np.all((xyz >= self.bounds_min) & (xyz <= self.bounds_max), axis=1)
+        if kwargs.get('z_range', None) is not None:
+            inside &= (xyz[:, 2] >= min(kwargs.get('z_range'))) & (xyz[:, 2] <= max(kwargs.get('z_range')))
+        return inside
 
-        # 0 - empty square
-        # 1 - occupied square
-        # 2 - occupied square with a beacon at each corner, detectable by the robot
-        # 3 - occupied square with a beacon at the sensor, detectable by the robot
+    def is_free_batch(self, xyz, **kwargs):
+        """
+        Boolean array of the places of an (N, 3) array in the free space,
+        one lookup in the voxel grid.
+        """
+        xyz = np.asarray(xyz, dtype=float).reshape(-1, 3)
+        free = self.is_in_batch(xyz, **kwargs)
+        idx = np.floor((xyz[free] - self.bounds_min) / self.voxel_size).astype(int)
+        idx = np.minimum(idx, np.array(self.voxels.shape) - 1)
+        free[free] = self.voxels[idx[:, 0], idx[:, 1], idx[:, 2]]
+        return free
 
     def show_mean(self, x, y, z=None, confident=False):
         if confident:
@@ -129,22 +174,21 @@ class Maze(object):
         turtle.clearstamps()
         turtle.shape('tri')
 
-        draw_cnt = 0
+        step = DRAW_EVERY if DRAW_EVERY > 0 else 1
         px = {}
-        for p in particles:
-            draw_cnt += 1
-            if DRAW_EVERY == 0 or draw_cnt % DRAW_EVERY == 1:
-                # Keep track of which positions already have something
-                # drawn to speed up display rendering
-                scaled_x = int(p.x * self.one_px)
-                scaled_y = int(p.y * self.one_px)
-                scaled_xy = scaled_x * 10000 + scaled_y
-                if not scaled_xy in px:
-                    px[scaled_xy] = 1
-                    turtle.setposition(*p.xy)
-                    turtle.setheading(90 - p.xy_heading)
-                    turtle.color(self.weight_to_color(p.w))
-                    turtle.stamp()
+        for x, y, xy_heading, w in zip(particles.x[::step], particles.y[::step],
+                                       particles.xy_heading[::step], particles.w[::step]):
+            # Keep track of which positions already have something
+            # drawn to speed up display rendering
+            scaled_x = int(x * self.one_px)
+            scaled_y = int(y * self.one_px)
+            scaled_xy = scaled_x * 10000 + scaled_y
+            if not scaled_xy in px:
+                px[scaled_xy] = 1
+                turtle.setposition(x, y)
+                turtle.setheading(90 - xy_heading)
+                turtle.color(self.weight_to_color(w))
+                turtle.stamp()
 
     def show_robot(self, robot):
         turtle.color("green")
@@ -154,20 +198,42 @@ class Maze(object):
         turtle.stamp()
         turtle.update()
 
-    def random_place(self, **kwargs):
-        x = random.uniform(min(self.anchor_x_list), max(self.anchor_x_list))
-        y = random.uniform(min(self.anchor_y_list), max(self.anchor_y_list))
-        if kwargs.get('z_range', None) is None:
-            z = 0
-        else:
-            z = random.uniform(min(kwargs.get('z_range')), max(kwargs.get('z_range')))
+    def random_place(self, rng=None, **kwargs):
+        x, y, z = self.random_places(1, rng=rng, **kwargs)[0]
         return x, y, z
 
-    def random_free_place(self, **kwargs):
-        while True:
-            x, y, z = self.random_place(**kwargs)
-            if self.is_free(x, y, z, **kwargs):
-                return x, y, z
+    def random_places(self, count, rng=None, **kwargs):
+        """
+        Draw count uniformly distributed places in the bounds of the world
+        (and the z_range keyword argument) at once, as a (count, 3) array.
+        """
+        rng = rng if rng is not None else self.rng
+        low, high = self.bounds_min.copy(), self.bounds_max.copy()
+        if kwargs.get('z_range', None) is not None:
+            low[2] = max(low[2], min(kwargs.get('z_range')))
+            high[2] = min(high[2], max(kwargs.get('z_range')))
+        return rng.uniform(low, high, size=(count, 3))
+
+    def random_free_place(self, rng=None, **kwargs):
+        x, y, z = self.random_free_places(1, rng=rng, **kwargs)[0]
+        return x, y, z
+
+    def random_free_places(self, count, rng=None, chunk_size=1024, max_chunks=1000, **kwargs):
+        """
+        Draw count places in the free space, as a (count, 3) array, by
+        rejection sampling in vectorized chunks of candidates.
+        """
+        chunks, found = [np.empty((0, 3))], 0
+        for _ in range(max_chunks):
+            if found >= count:
+                break
+            candidates = self.random_places(max(chunk_size, 2 * (count - found)), rng=rng, **kwargs)
+            chunks.append(candidates[self.is_free_batch(candidates, **kwargs)])
+            found += len(chunks[-1])
+        if found < count:
+            raise ValueError("Only {} of {} free places found in {} chunks, is the maze all occupied?"
+                             .format(found, count, max_chunks))
+        return np.concatenate(chunks)[:count]
 
     def euclidean_dist(self, x1, y1, z1, x2, y2, z2):
         return math.sqrt((x1 - x2) ** 2 + (y1 - y2) ** 2 + (z1 - z2) ** 2)
@@ -175,20 +241,35 @@ class Maze(object):
     def euclidean_dist_xy(self, x1, y1, x2, y2):
         return math.sqrt((x1 - x2) ** 2 + (y1 - y2) ** 2)
         
+    def anchor_positions(self, anchor_ids=None):
+        """
+        (M, 3) positions of the given anchor ids (all anchors if None), in
+        that order. Unknown anchor ids get an inf row.
+        """
+        if anchor_ids is None:
+            return self.anchor_xyz
+        idx = np.asarray([self.anchor_index.get(anc_id, -1) for anc_id in anchor_ids], dtype=int)
+        positions = self.anchor_xyz[idx] if len(self.anchor_xyz) else np.empty((len(idx), 3))
+        positions[idx < 0] = float('inf')
+        return positions
+
+    def distance_matrix(self, xyz, anchor_ids=None):
+        """
+        Distances from every place of an (N, 3) array to the given anchors
+        (all anchors if None), as an (N, M) matrix in the order of anchor_ids.
+        Unknown anchor ids give inf distances.
+        """
+        xyz = np.asarray(xyz, dtype=float).reshape(-1, 3)
+        anchor_xyz = self.anchor_positions(anchor_ids)
+        with np.errstate(invalid='ignore'):
+            diff = xyz[:, np.newaxis, :] - anchor_xyz[np.newaxis, :, :]
+            dist = np.sqrt(np.einsum('ijk,ijk->ij', diff, diff))
+        dist[:, ~np.all(np.isfinite(anchor_xyz), axis=1)] = float('inf')
+        return dist
+
     #  ---------------only for simulation, no Z-axis involved-------
     def distance_to_nearest_beacon(self, x, y, z=0) -> float:
-        d = float('inf')
-        for i in range(len(self.beacons)):
-            c_x, c_y, c_z = self.beacons[i][1], self.beacons[i][2], self.beacons[i][3]
-            distance = self.euclidean_dist(c_x, c_y, c_z, x, y, z)
-            if distance < d:
-                d = distance
-                d_x, d_y, d_z = c_x, c_y, c_z
-        return d
+        return float(self.distance_matrix((x, y, z)).min(initial=float('inf')))
     
     def distances_to_all_beacons(self, x, y, z=0) -> Tuple:
-        dist = []
-        for i in range(len(self.beacons)):
-            c_x, c_y, c_z = self.beacons[i][1], self.beacons[i][2], self.beacons[i][3]
-            dist.append(self.euclidean_dist(c_x, c_y, c_z, x, y, z))
-        return dist
+        return self.distance_matrix((x, y, z))[0].tolist()
@@ -0,0 +1,92 @@
+# ------------------------------------------------------------------------
+# coding=utf-8
+# ------------------------------------------------------------------------
+#
+#  State estimation from the weighted particle cloud
+# ------------------------------------------------------------------------
+
+from collections import namedtuple
+
+import numpy as np
+
+# mean: (3,) weighted mean, covariance: (3, 3) weighted covariance,
+# confidence: fraction of the particles within the radius around the mean,
+# confident: confidence above the confidence level,
+# modes: list of ((x, y, z), weight fraction), heaviest first
+Estimate = namedtuple("Estimate", ["mean", "covariance", "confidence", "confident", "modes"])
+
+
+def _box_sum(grid):
+    """ Sum over the 3x3x3 neighbourhood of every cell.
+    """
+    for axis in range(grid.ndim):
+        grid = grid + np.roll(grid, 1, axis) + np.roll(grid, -1, axis)
+    return grid
+
+
+def _box_max(grid):
+    """ Maximum over the 3x3x3 neighbourhood of every cell.
+    """
+    for axis in range(grid.ndim):
+        grid = np.maximum(grid, np.maximum(np.roll(grid, 1, axis), np.roll(grid, -1, axis)))
+    return grid
+
+
+def find_modes(xyz, w, cell_size=20, k=3):
+    """
+    Top-k modes of the weighted particles by grid-hash clustering, O(N + cells):
+    the particles are hashed into cell_size-wide cells, the weight of every cell
+    is summed with its neighbours, and the local maxima of those sums are the
+    modes, located at the weighted mean of their 3x3x3 neighbourhood.
+    Returns a list of ((x, y, z), weight fraction), heaviest first.
+    """
+    total = w.sum()
+    if k <= 0 or total <= 0:
+        return []
+    cells = np.floor(xyz / cell_size).astype(np.int64)
+    # one empty cell around the occupied ones, so np.roll never wraps weight around
+    cells -= cells.min(axis=0) - 1
+    shape = tuple(cells.max(axis=0) + 2)
+    flat = np.ravel_multi_index(cells.T, shape)
+    size = int(np.prod(shape))
+    cell_w = np.bincount(flat, weights=w, minlength=size).reshape(shape)
+    near_w = _box_sum(cell_w)
+    peaks = np.flatnonzero((cell_w > 0) & (near_w >= _box_max(near_w)))
+    peaks = peaks[np.argsort(near_w.ravel()[peaks], kind='stable')[::-1]]
+    # a plateau of equal neighbourhood sums gives adjacent peaks of the same
+    # cluster, keep the heaviest of the peaks within 2 cells of each other
+    kept = []
+    for peak in peaks:
+        cell = np.array(np.unravel_index(peak, shape))
+        if all(np.abs(cell - other).max() > 2 for other in kept):
+            kept.append(cell)
+            if len(kept) == k:
+                break
+    peaks = np.ravel_multi_index(np.array(kept).T, shape)
+    modes = []
+    near_wx = [_box_sum(np.bincount(flat, weights=w * xyz[:, i], minlength=size).reshape(shape)).ravel()[peaks]
+               for i in range(3)]
+    for j, peak in enumerate(peaks):
+        weight = near_w.ravel()[peak]
+        modes.append((tuple(float(c[j] / weight) for c in near_wx), float(weight / total)))
+    return modes
+
+
+def estimate_state(xyz, w, radius=25, confidence_level=0.95, modes=0, mode_cell_size=20):
+    """
+    Weighted mean and covariance of the particle positions xyz (N x 3) with
+    weights w, the fraction of particles within radius of the mean, and the
+    top modes if modes > 0. All particles improbable gives a nan mean.
+    """
+    xyz = np.asarray(xyz, dtype=float)
+    w = np.asarray(w, dtype=float)
+    total = w.sum()
+    if total <= 0:
+        return Estimate(np.full(3, np.nan), np.full((3, 3), np.nan), 0.0, False, [])
+    mean = w @ xyz / total
+    diff = xyz - mean
+    covariance = (diff * w[:, np.newaxis]).T @ diff / total
+    inside = np.einsum('ij,ij->i', diff, diff) < radius ** 2
+    confidence = float(np.count_nonzero(inside) / len(w))
+    return Estimate(mean, covariance, confidence, confidence > confidence_level,
+                    find_modes(xyz, w, mode_cell_size, modes))
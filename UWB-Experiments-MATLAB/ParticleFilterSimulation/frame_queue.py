@@ -0,0 +1,216 @@
+# ------------------------------------------------------------------------
+# coding=utf-8
+# ------------------------------------------------------------------------
+#
+#  Bounded hand-over of UWB location frames from the MQTT network thread
+#  to the particle filter loop
+# ------------------------------------------------------------------------
+
+import collections
+import threading
+import time
+
+from location_codec import decode_batch, decode_payload
+
+DROP_OLDEST = "drop_oldest"     # a full queue makes room for the new frame
+DROP_NEWEST = "drop_newest"     # a full queue rejects the new frame
+DEVICE_CLOCK_WRAP = 2 ** 32 / 1e6   # s
+RESTART_GAP = 256   # a superFrameNumber this far behind the last one means the publisher restarted,
+                    # more than a LocationBatch (255 frames) can hold
+RESTART_QUIET = 2.0     # s, a superFrameNumber behind the last one after this long without frames
+                        # means the publisher restarted, whatever the gap
+
+# frame_number: superFrameNumber of the publisher, or None,
+# received: time.monotonic() on arrival, in s,
+# device_time: UWBLOCALTIME of the tag, in s, or None,
+# anchor_ids: ids of the ranged anchors, in reporting order,
+# ranges: {anchor id: range}, unit as reported (m),
+# est_pos: (x, y, z) position estimated by the tag (m), or None,
+# payload: the decoded JSON dict
+LocationFrame = collections.namedtuple(
+    "LocationFrame", ["frame_number", "received", "device_time", "tag_id", "anchor_ids", "ranges", "est_pos",
+                      "payload"])
+
+
+def decode_location_frame(payload, received=None):
+    """
+    Decode the payload (bytes, JSON or binary) of a location message into a LocationFrame.
+    received defaults to time.monotonic() now.
+    """
+    if received is None:
+        received = time.monotonic()
+    return location_frame(decode_payload(payload), received)
+
+
+def location_frame(frame, received):
+    """ LocationFrame of a decoded location frame dict.
+    """
+    if not isinstance(frame, dict):
+        raise TypeError("Location frame is not an object: {!r}".format(frame))
+    anchor_ids = list(frame.get('all_anc_id', []))
+    ranges = {anc: frame[anc]['dist_to'] for anc in anchor_ids if anc in frame}
+    est_pos = frame.get('est_pos')
+    if est_pos is not None:
+        est_pos = (est_pos['x'], est_pos['y'], est_pos['z'])
+    device_time = frame.get('timestamp')    # UWBLOCALTIME, in us
+    if device_time is not None:
+        device_time = device_time / 1e6
+    return LocationFrame(frame.get('superFrameNumber'), received, device_time, frame.get('tag_id'), anchor_ids,
+                         ranges, est_pos, frame)
+
+
+def frame_interval(previous, frame):
+    """
+    Seconds between two LocationFrames, from the device clock when both
+    carry one (UWBLOCALTIME is a 32 bit us counter, it wraps after ~71 min),
+    else from the arrival times.
+    """
+    if previous.device_time is not None and frame.device_time is not None:
+        return (frame.device_time - previous.device_time) % DEVICE_CLOCK_WRAP
+    return frame.received - previous.received
+
+
+class FrameQueue(object):
+    """
+    Bounded FIFO of decoded location frames, keyed by their superFrameNumber.
+    put() / put_payload() are called from the MQTT network thread, get()
+    blocks the filter loop until a new frame arrives, so every frame is
+    processed exactly once and the network thread never shares state with
+    the loop other than through the queue.
+
+    - a frame whose superFrameNumber was seen recently (e.g. the retained
+      message re-delivered after a reconnect) is counted as duplicate and dropped
+    - when the queue is full the oldest (DROP_OLDEST) or the new (DROP_NEWEST)
+      frame is dropped
+    - gaps in superFrameNumber are counted as missed frames
+    - a frame behind the last one (e.g. the batch arriving after the retained
+      newer frame on a reconnect) is counted as stale and dropped, so the
+      loop sees the frames in order
+    - a superFrameNumber more than restart_gap behind the last one, or behind
+      it after restart_quiet s without any frame, means the publisher
+      restarted, the numbering starts over from it
+    """
+    def __init__(self, maxlen=16, history=64, policy=DROP_OLDEST, restart_gap=RESTART_GAP,
+                 restart_quiet=RESTART_QUIET):
+        if policy not in (DROP_OLDEST, DROP_NEWEST):
+            raise ValueError("Unknown backpressure policy: {}".format(policy))
+        self.maxlen = maxlen
+        self.policy = policy
+        self.restart_gap = restart_gap
+        self.restart_quiet = restart_quiet
+        self._frames = collections.deque()
+        self._recent = collections.deque(maxlen=history)
+        self._cond = threading.Condition()
+        self.last_frame_number = None
+        self.last_received = None
+        self.received = 0
+        self.duplicates = 0
+        self.dropped = 0
+        self.missed = 0
+        self.stale = 0
+        self.restarts = 0
+        self.decoded = 0
+        self.decode_errors = 0
+        self.decode_time = 0.0
+        self.decode_time_max = 0.0
+        self.max_depth = 0
+
+    def __len__(self):
+        with self._cond:
+            return len(self._frames)
+
+    def put_payload(self, payload):
+        """
+        Decode a raw message payload and put() the frame, timing the decoding.
+        A payload that does not decode is counted and dropped.
+        """
+        received = time.monotonic()
+        try:
+            frame = decode_location_frame(payload, received)
+        except (ValueError, KeyError, TypeError):
+            with self._cond:
+                self.decode_errors += 1
+            return False
+        decode_time = time.monotonic() - received
+        with self._cond:
+            self.decoded += 1
+            self.decode_time += decode_time
+            self.decode_time_max = max(self.decode_time_max, decode_time)
+        return self.put(frame)
+
+    def put_batch_payload(self, payload):
+        """
+        Decode a LocationBatch payload and put() its frames, oldest first.
+        Returns the number of frames queued.
+        """
+        received = time.monotonic()
+        try:
+            frames = [location_frame(frame, received) for frame in decode_batch(payload)]
+        except (ValueError, KeyError, TypeError):
+            with self._cond:
+                self.decode_errors += 1
+            return 0
+        decode_time = time.monotonic() - received
+        with self._cond:
+            self.decoded += len(frames)
+            self.decode_time += decode_time
+            self.decode_time_max = max(self.decode_time_max, decode_time)
+        return sum(self.put(frame) for frame in frames)
+
+    def put(self, frame):
+        frame_number = frame.frame_number
+        with self._cond:
+            self.received += 1
+            quiet = self.last_received is not None and frame.received - self.last_received > self.restart_quiet
+            self.last_received = frame.received
+            if frame_number is not None:
+                restarted = self.last_frame_number is not None and frame_number < self.last_frame_number and \
+                    (quiet or frame_number < self.last_frame_number - self.restart_gap)
+                if frame_number in self._recent and not restarted:
+                    self.duplicates += 1
+                    return False
+                if self.last_frame_number is not None:
+                    if restarted:
+                        self.restarts += 1
+                        self._recent.clear()
+                    elif frame_number < self.last_frame_number:
+                        self.stale += 1
+                        return False
+                    elif frame_number > self.last_frame_number + 1:
+                        self.missed += frame_number - self.last_frame_number - 1
+                self.last_frame_number = frame_number
+                self._recent.append(frame_number)
+            if len(self._frames) >= self.maxlen:
+                self.dropped += 1
+                if self.policy == DROP_NEWEST:
+                    return False
+                self._frames.popleft()
+            self._frames.append(frame)
+            self.max_depth = max(self.max_depth, len(self._frames))
+            self._cond.notify()
+            return True
+
+    def get(self, timeout=None):
+        """
+        Block until a frame is available and return it, or None on timeout.
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._frames, timeout=timeout):
+                return None
+            return self._frames.popleft()
+
+    def stats(self):
+        with self._cond:
+            return {
+                "received": self.received,
+                "queued": len(self._frames),
+                "max_queued": self.max_depth,
+                "dropped": self.dropped,
+                "duplicates": self.duplicates,
+                "missed": self.missed,
+                "stale": self.stale,
+                "restarts": self.restarts,
+                "decode_errors": self.decode_errors,
+                "decode_ms_mean": 1000 * self.decode_time / self.decoded if self.decoded else 0.0,
+                "decode_ms_max": 1000 * self.decode_time_max,
+            }
@@ -0,0 +1,312 @@
+# ------------------------------------------------------------------------
+# coding=utf-8
+# ------------------------------------------------------------------------
+#
+#  Headless rendering of the particle filter state into image buffers,
+#  exported as a PNG sequence or an MJPEG/AVI stream
+# ------------------------------------------------------------------------
+
+import collections
+import io
+import os
+import signal
+import struct
+import threading
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+try:
+    from PIL import Image   # only needed for the JPEG based formats
+except ImportError:
+    Image = None
+
+BACKGROUND = (255, 255, 255)
+ROOM = (235, 235, 235)
+SELECTED_ANCHOR = (0, 160, 0)
+ANCHOR = (220, 0, 0)
+MEAN = (128, 128, 128)
+CONFIDENT_MEAN = (0, 200, 0)
+TRUTH = (0, 0, 0)
+
+
+class FrameRenderer(object):
+    """
+    Rasterizes the particles, anchors, mean estimate and ground truth into an
+    RGB uint8 image: the top (x, y) view on the left, the side (x, z) view on
+    the right, both over the world bounds.
+    """
+    def __init__(self, world, width=800, height=400, border=10):
+        self.world = world
+        self.width = width
+        self.height = height
+        self.border = border
+        self.panel_width = width // 2
+
+    def to_pixels(self, a, b, panel):
+        """ World coordinates (cm) of the panel's horizontal (a) and vertical (b) axes to pixel columns and rows.
+        """
+        axis_b = 1 if panel == 0 else 2
+        low, high = self.world.bounds_min, self.world.bounds_max
+        size_a = self.panel_width - 2 * self.border
+        size_b = self.height - 2 * self.border
+        scale = min(size_a / (high[0] - low[0]), size_b / (high[axis_b] - low[axis_b]))
+        col = self.border + panel * self.panel_width + (np.asarray(a) - low[0]) * scale
+        row = self.height - self.border - (np.asarray(b) - low[axis_b]) * scale
+        return np.round(col).astype(int), np.round(row).astype(int)
+
+    def splat(self, image, cols, rows, colors, radius=1, disc=False):
+        """ Paint a square (or disc) of radius pixels around every point, in one indexed assignment per offset.
+        """
+        colors = np.broadcast_to(np.asarray(colors, dtype=np.uint8), (len(cols), 3))
+        for dr in range(-radius, radius + 1):
+            for dc in range(-radius, radius + 1):
+                if disc and dr * dr + dc * dc > radius * radius:
+                    continue
+                r, c = rows + dr, cols + dc
+                inside = (r >= 0) & (r < self.height) & (c >= 0) & (c < self.width)
+                image[r[inside], c[inside]] = colors[inside]
+
+    def render(self, xyz, weights, mean=None, confident=False, truth=None, selected=()):
+        image = np.empty((self.height, self.width, 3), dtype=np.uint8)
+        image[:] = BACKGROUND
+        xyz = np.asarray(xyz, dtype=float).reshape(-1, 3)
+        weights = np.asarray(weights, dtype=float)
+        # heaviest particles are drawn last, on top
+        order = np.argsort(weights, kind='stable')
+        xyz = xyz[order]
+        top = weights[order].max(initial=0)
+        shade = weights[order] / top if top > 0 else np.zeros(len(order))
+        colors = np.column_stack((shade * 255, np.zeros(len(shade)), (1 - shade) * 255)).astype(np.uint8)
+        selected = np.isin(self.world.anchor_ids, list(selected))
+        anchor_colors = np.where(selected[:, np.newaxis], SELECTED_ANCHOR, ANCHOR)
+        for panel, axis_b in enumerate((1, 2)):
+            low, high = self.world.bounds_min, self.world.bounds_max
+            (c0, c1), (r1, r0) = self.to_pixels([low[0], high[0]], [low[axis_b], high[axis_b]], panel)
+            image[max(r0, 0):r1 + 1, max(c0, 0):c1 + 1] = ROOM
+            self.splat(image, *self.to_pixels(xyz[:, 0], xyz[:, axis_b], panel), colors, radius=1)
+            self.splat(image, *self.to_pixels(self.world.anchor_xyz[:, 0], self.world.anchor_xyz[:, axis_b], panel),
+                       anchor_colors, radius=4)
+            if mean is not None:
+                self.splat(image, *self.to_pixels([mean[0]], [mean[axis_b]], panel),
+                           CONFIDENT_MEAN if confident else MEAN, radius=5, disc=True)
+            if truth is not None:
+                col, row = self.to_pixels([truth[0]], [truth[axis_b]], panel)
+                for d in range(-6, 7):  # a cross
+                    self.splat(image, col + d, row + d, TRUTH, radius=1)
+                    self.splat(image, col + d, row - d, TRUTH, radius=1)
+        return image
+
+
+# ------------------------------------------------------------------------
+# Encoders
+
+def _png_chunk(tag, data):
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+
+
+def encode_png(image, level=6):
+    """ RGB uint8 (H, W, 3) image to PNG bytes, with zlib only.
+    """
+    height, width = image.shape[:2]
+    raw = np.zeros((height, 1 + 3 * width), dtype=np.uint8)     # filter type 0 in front of every row
+    raw[:, 1:] = image.reshape(height, -1)
+    return (b"\x89PNG\r\n\x1a\n"
+            + _png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + _png_chunk(b"IDAT", zlib.compress(raw.tobytes(), level))
+            + _png_chunk(b"IEND", b""))
+
+
+def encode_jpeg(image, quality=85):
+    buffer = io.BytesIO()
+    Image.fromarray(image).save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+class AviWriter(object):
+    """
+    Minimal MJPEG AVI (RIFF) writer: one video stream of JPEG frames, with
+    the frame count and chunk sizes patched in on close().
+    """
+    def __init__(self, path, width, height, fps=10):
+        self.file = open(path, "wb")
+        self.width, self.height, self.fps = width, height, fps
+        self.index = []
+        strl = self._list(b"strl", self._chunk(b"strh", self._strh(0)) + self._chunk(b"strf", self._strf()))
+        hdrl = self._list(b"hdrl", self._chunk(b"avih", self._avih(0)) + strl)
+        self.file.write(b"RIFF" + struct.pack("<I", 0) + b"AVI " + hdrl)
+        self.movi_offset = self.file.tell()
+        self.file.write(b"LIST" + struct.pack("<I", 0) + b"movi")
+
+    @staticmethod
+    def _chunk(tag, data):
+        return tag + struct.pack("<I", len(data)) + data + (b"\0" if len(data) % 2 else b"")
+
+    @staticmethod
+    def _list(tag, data):
+        return b"LIST" + struct.pack("<I", len(data) + 4) + tag + data
+
+    def _avih(self, frames):
+        return struct.pack("<14I", 1000000 // self.fps, 0, 0, 0x10, frames, 0, 1, 0,
+                           self.width, self.height, 0, 0, 0, 0)
+
+    def _strh(self, frames):
+        return (b"vidsMJPG" + struct.pack("<IHHIIIIIIIIhhhh", 0, 0, 0, 0, 1, self.fps, 0, frames, 0,
+                                          0xffffffff, 0, 0, 0, self.width, self.height))
+
+    def _strf(self):
+        return struct.pack("<IiiHH4sIiiII", 40, self.width, self.height, 1, 24, b"MJPG",
+                           self.width * self.height * 3, 0, 0, 0, 0)
+
+    def write(self, jpeg):
+        self.index.append((self.file.tell() - self.movi_offset - 8, len(jpeg)))
+        self.file.write(self._chunk(b"00dc", jpeg))
+
+    def close(self):
+        movi_end = self.file.tell()
+        self.file.write(b"idx1" + struct.pack("<I", 16 * len(self.index)))
+        for offset, size in self.index:
+            self.file.write(b"00dc" + struct.pack("<III", 0x10, offset, size))
+        riff_end = self.file.tell()
+        frames = len(self.index)
+        self.file.seek(4)
+        self.file.write(struct.pack("<I", riff_end - 8))
+        # the avih and strh payloads sit at fixed offsets behind the RIFF/hdrl/strl headers
+        self.file.seek(32)
+        self.file.write(self._avih(frames))
+        self.file.seek(32 + 56 + 20)
+        self.file.write(self._strh(frames))
+        self.file.seek(self.movi_offset + 4)
+        self.file.write(struct.pack("<I", movi_end - self.movi_offset - 8))
+        self.file.close()
+
+
+# ------------------------------------------------------------------------
+# Export through a worker pool
+
+_renderer = None
+
+
+def _init_worker(world, width, height):
+    global _renderer
+    # Ctrl-C is for the main process, which closes the exporter, the workers keep rendering till then
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _renderer = FrameRenderer(world, width, height)
+
+
+class _DeferredInterrupt(object):
+    """ Holds back Ctrl-C while the executor and its futures are locked: a
+        KeyboardInterrupt raised with one of their locks held leaves it locked,
+        and the executor's exit hook then waits forever for its manager thread.
+        The interrupt is raised on leaving the block. Only in the main thread.
+    """
+    def __enter__(self):
+        self.interrupted = False
+        self.active = threading.current_thread() is threading.main_thread()
+        if self.active:
+            self.handler = signal.signal(signal.SIGINT, self._hold)
+        return self
+
+    def _hold(self, signum, frame):
+        self.interrupted = True
+
+    def __exit__(self, *exc):
+        if not self.active:
+            return
+        signal.signal(signal.SIGINT, self.handler)
+        if self.interrupted:
+            if callable(self.handler):
+                self.handler(signal.SIGINT, None)
+            elif self.handler != signal.SIG_IGN:
+                raise KeyboardInterrupt
+
+
+def _render_and_encode(fmt, path, quality, args, kwargs):
+    image = _renderer.render(*args, **kwargs)
+    if fmt == "png":
+        with open(path, "wb") as f:
+            f.write(encode_png(image))
+        return None
+    return encode_jpeg(image, quality)
+
+
+class FrameExporter(object):
+    """
+    Renders and encodes every `every`-th exported step in a pool of worker
+    processes. path is a directory for a PNG sequence (frame_000000.png, ...),
+    or a .avi/.mjpeg file for an MJPEG stream (needs Pillow). export() never
+    waits: finished stream frames are written in order as they come in, and a
+    step is dropped (and counted) when max_pending frames are in flight.
+    """
+    def __init__(self, world, path, every=1, width=800, height=400, fps=10, quality=85, workers=2, max_pending=8):
+        extension = os.path.splitext(path)[1].lower()
+        self.fmt = {".avi": "avi", ".mjpeg": "mjpeg", ".mjpg": "mjpeg"}.get(extension, "png")
+        if self.fmt != "png" and Image is None:
+            raise ImportError("Pillow is needed to export JPEG frames to {}, or export a PNG sequence".format(path))
+        self.path = path
+        self.every = every
+        self.quality = quality
+        self.max_pending = max_pending
+        if self.fmt == "png":
+            os.makedirs(path, exist_ok=True)
+            self.stream = None
+        elif self.fmt == "avi":
+            self.stream = AviWriter(path, width, height, fps)
+        else:
+            self.stream = open(path, "wb")
+        self.pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                        initargs=(world, width, height))
+        self.pending = collections.deque()
+        self.steps = 0
+        self.exported = 0
+        self.dropped = 0
+
+    def export(self, xyz, weights, mean=None, confident=False, truth=None, selected=()):
+        self.steps += 1
+        with _DeferredInterrupt():
+            self.write_finished()
+            if (self.steps - 1) % self.every:
+                return
+            if len(self.pending) >= self.max_pending:
+                self.dropped += 1
+                return
+            frame_path = os.path.join(self.path, "frame_{:06d}.png".format(self.exported)) if self.fmt == "png" else None
+            args = (np.array(xyz, dtype=float), np.array(weights, dtype=float))
+            kwargs = {"mean": mean, "confident": confident, "truth": truth, "selected": list(selected)}
+            self.pending.append(self.pool.submit(_render_and_encode, self.fmt, frame_path, self.quality, args, kwargs))
+            self.exported += 1
+
+    def write_finished(self, wait=False):
+        """ Write the encoded frames at the head of the queue that are done (all of them if wait).
+        """
+        while self.pending and (wait or self.pending[0].done()):
+            future = self.pending.popleft()
+            try:
+                data = future.result()
+            except Exception:
+                # a frame that failed to render is skipped, the stream stays valid
+                self.dropped += 1
+                continue
+            if self.stream is not None:
+                self.stream.write(data)
+
+    def stats(self):
+        return {"steps": self.steps, "exported": self.exported, "dropped": self.dropped, "pending": len(self.pending)}
+
+    def close(self):
+        """ Write the pending frames and finalize the stream, also when interrupted on the way.
+        """
+        try:
+            with _DeferredInterrupt():
+                try:
+                    self.write_finished(wait=True)
+                finally:
+                    # frames not started yet are dropped (shutdown(cancel_futures=True) needs Python 3.9)
+                    for future in self.pending:
+                        future.cancel()
+                    self.pending.clear()
+                    self.pool.shutdown(wait=True)
+        finally:
+            if self.stream is not None:
+                self.stream.close()
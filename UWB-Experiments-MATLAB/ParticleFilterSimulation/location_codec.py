@@ -0,0 +1,231 @@
+# ------------------------------------------------------------------------
+# coding=utf-8
+# ------------------------------------------------------------------------
+#
+#  Compact binary encoding of the Tag/<id>/Uplink/Location frames
+# ------------------------------------------------------------------------
+#
+#  The same module is kept in tag_mqtt_publisher/ (publisher) and in
+#  ParticleFilterSimulation/ (subscribers), keep both copies in sync.
+#
+#  A binary payload starts with the version byte 0xB1, a JSON payload
+#  with "{", so a subscriber tells both apart from the first byte and
+#  publishers can be switched over one at a time. Layout of version 1,
+#  little endian, lengths in mm:
+#
+#    header    B version, B flags, B anchor count, B tag id length,
+#              I superFrameNumber (0xFFFFFFFF: none)
+#    tag id    ascii
+#    flags & TIMESTAMP   I UWBLOCALTIME (us)
+#    flags & EST_POS     i x, i y, i z, B quality factor
+#    flags & ACC         h x, h y, h z (raw accelerometer)
+#    flags & PROXIMITY   f proximity (cm), nan: out of range
+#    per anchor          4s id, i x, i y, i z, i dist_to, B quality factor (255: none)
+#
+#  A batch of frames (Tag/<id>/Uplink/LocationBatch) is a JSON list, or
+#  the byte 0xBB, B frame count and per frame H length + frame payload.
+#
+
+import json
+import math
+import struct
+import sys
+import time
+
+VERSION_1 = 0xB1
+BATCH = 0xBB
+
+EST_POS = 0x01
+ACC = 0x02
+TIMESTAMP = 0x04
+PROXIMITY = 0x08
+
+NO_FRAME_NUMBER = 0xFFFFFFFF
+NO_QUALITY = 0xFF
+MAX_BATCH_FRAMES = 0xFF     # the frame count of a binary batch is one byte
+
+_HEADER = struct.Struct("<BBBBI")
+_TIMESTAMP = struct.Struct("<I")
+_EST_POS = struct.Struct("<iiiB")
+_ACC = struct.Struct("<hhh")
+_PROXIMITY = struct.Struct("<f")
+_ANCHOR = struct.Struct("<4siiiiB")
+_BATCH_HEADER = struct.Struct("<BB")
+_BATCH_LENGTH = struct.Struct("<H")
+
+
+def _mm(meters):
+    return int(round(meters * 1000))
+
+
+def encode_frame(frame):
+    """ Encode a location frame dictionary (as made by make_json_dic, unit in m)
+        into the version 1 binary payload.
+
+        :returns:
+            bytes
+    """
+    flags = 0
+    tag_id = frame.get('tag_id', '').encode('ascii')
+    frame_number = frame.get('superFrameNumber')
+    all_anc_id = frame.get('all_anc_id', [])
+    parts = [None, tag_id]
+    if frame.get('timestamp') is not None:
+        flags |= TIMESTAMP
+        parts.append(_TIMESTAMP.pack(frame['timestamp'] & 0xFFFFFFFF))
+    est_pos = frame.get('est_pos')
+    if est_pos is not None:
+        flags |= EST_POS
+        parts.append(_EST_POS.pack(_mm(est_pos['x']), _mm(est_pos['y']), _mm(est_pos['z']),
+                                   frame.get('est_qual', NO_QUALITY)))
+    acc = frame.get('acc')
+    if acc is not None:
+        flags |= ACC
+        parts.append(_ACC.pack(acc['x'], acc['y'], acc['z']))
+    if 'proximity' in frame:
+        flags |= PROXIMITY
+        proximity = frame['proximity']
+        parts.append(_PROXIMITY.pack(proximity if isinstance(proximity, (int, float)) else math.nan))
+    for anc_id in all_anc_id:
+        anc = frame[anc_id]
+        parts.append(_ANCHOR.pack(anc_id.encode('ascii'), _mm(anc['x']), _mm(anc['y']), _mm(anc['z']),
+                                  _mm(anc['dist_to']), anc.get('anc_qf', NO_QUALITY)))
+    parts[0] = _HEADER.pack(VERSION_1, flags, len(all_anc_id), len(tag_id),
+                            NO_FRAME_NUMBER if frame_number is None else frame_number & 0xFFFFFFFF)
+    return b"".join(parts)
+
+
+def decode_frame(payload):
+    """ Decode a version 1 binary payload into the same dictionary make_json_dic
+        (plus the publisher's fields) makes, unit in m.
+
+        :raises ValueError:
+            On an unknown version or a truncated payload
+        :returns:
+            Dictionary of the location frame
+    """
+    try:
+        version, flags, anc_num, tag_id_len, frame_number = _HEADER.unpack_from(payload, 0)
+        if version != VERSION_1:
+            raise ValueError("Unknown location frame version: {:#x}".format(version))
+        offset = _HEADER.size
+        data = {'tag_id': payload[offset:offset + tag_id_len].decode('ascii')}
+        offset += tag_id_len
+        if frame_number != NO_FRAME_NUMBER:
+            data['superFrameNumber'] = frame_number
+        if flags & TIMESTAMP:
+            data['timestamp'], = _TIMESTAMP.unpack_from(payload, offset)
+            offset += _TIMESTAMP.size
+        if flags & EST_POS:
+            x, y, z, qual = _EST_POS.unpack_from(payload, offset)
+            offset += _EST_POS.size
+            data['est_pos'] = {'x': x / 1000, 'y': y / 1000, 'z': z / 1000}
+            if qual != NO_QUALITY:
+                data['est_qual'] = qual
+        if flags & ACC:
+            x, y, z = _ACC.unpack_from(payload, offset)
+            offset += _ACC.size
+            data['acc'] = {'x': x, 'y': y, 'z': z}
+        if flags & PROXIMITY:
+            proximity, = _PROXIMITY.unpack_from(payload, offset)
+            offset += _PROXIMITY.size
+            data['proximity'] = "OutOfRange" if math.isnan(proximity) else proximity
+        all_anc_id = []
+        for anc_id, x, y, z, dist_to, qf in _ANCHOR.iter_unpack(payload[offset:offset + anc_num * _ANCHOR.size]):
+            anc_id = anc_id.decode('ascii')
+            all_anc_id.append(anc_id)
+            data[anc_id] = {'anc_id': anc_id, 'x': x / 1000, 'y': y / 1000, 'z': z / 1000, 'dist_to': dist_to / 1000}
+            if qf != NO_QUALITY:
+                data[anc_id]['anc_qf'] = qf
+        if len(all_anc_id) != anc_num:
+            raise ValueError("Truncated location frame")
+        data['anc_num'] = anc_num
+        data['all_anc_id'] = all_anc_id
+    except struct.error as e:
+        raise ValueError("Truncated location frame") from e
+    return data
+
+
+def decode_payload(payload):
+    """ Decode a location payload of either format, binary or JSON.
+
+        :returns:
+            Dictionary of the location frame
+    """
+    if payload[:1] == b"{":
+        return json.loads(payload.decode("utf-8"))
+    return decode_frame(payload)
+
+
+def encode_batch(frames, binary=False):
+    """ Encode up to MAX_BATCH_FRAMES location frame dictionaries into one batch payload.
+
+        :raises ValueError:
+            On more than MAX_BATCH_FRAMES frames
+        :returns:
+            bytes
+    """
+    if len(frames) > MAX_BATCH_FRAMES:
+        raise ValueError("A batch holds at most {} frames, got {}".format(MAX_BATCH_FRAMES, len(frames)))
+    if not binary:
+        return json.dumps(frames).encode("utf-8")
+    parts = [_BATCH_HEADER.pack(BATCH, len(frames))]
+    for frame in frames:
+        payload = encode_frame(frame)
+        parts.append(_BATCH_LENGTH.pack(len(payload)))
+        parts.append(payload)
+    return b"".join(parts)
+
+
+def decode_batch(payload):
+    """ Decode a batch payload of either format, binary or JSON.
+
+        :raises ValueError:
+            On an unknown or truncated binary batch
+        :returns:
+            List of the location frame dictionaries, oldest first
+    """
+    if payload[:1] == b"[":
+        return json.loads(payload.decode("utf-8"))
+    try:
+        marker, count = _BATCH_HEADER.unpack_from(payload, 0)
+        if marker != BATCH:
+            raise ValueError("Not a location frame batch: {:#x}".format(marker))
+        frames, offset = [], _BATCH_HEADER.size
+        for _ in range(count):
+            length, = _BATCH_LENGTH.unpack_from(payload, offset)
+            offset += _BATCH_LENGTH.size
+            frames.append(decode_frame(payload[offset:offset + length]))
+            offset += length
+    except struct.error as e:
+        raise ValueError("Truncated location frame batch") from e
+    return frames
+
+
+if __name__ == "__main__":
+    # Benchmark against JSON on a 4 anchor frame of the tag publisher
+    frame = {'C584': {'anc_id': 'C584', 'x': 0.16, 'y': 0.0, 'z': 1.51, 'dist_to': 1.18},
+             'DA36': {'anc_id': 'DA36', 'x': 0.4, 'y': 3.25, 'z': 0.79, 'dist_to': 2.84},
+             '9234': {'anc_id': '9234', 'x': 2.91, 'y': 2.85, 'z': 0.55, 'dist_to': 3.06},
+             '8287': {'anc_id': '8287', 'x': 2.7, 'y': 0.0, 'z': 1.34, 'dist_to': 2.8},
+             'anc_num': 4, 'all_anc_id': ['C584', 'DA36', '9234', '8287'],
+             'est_pos': {'x': 0.5, 'y': 0.83, 'z': 0.8}, 'est_qual': 58,
+             'tag_id': 'DECA9A1C', 'superFrameNumber': 12345, 'proximity': "OutOfRange"}
+    assert decode_frame(encode_frame(frame)) == frame
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    json_payload = json.dumps(frame).encode("utf-8")
+    binary_payload = encode_frame(frame)
+    rows = [("json", len(json_payload), lambda: json.dumps(frame).encode("utf-8"),
+             lambda: json.loads(json_payload.decode("utf-8"))),
+            ("binary", len(binary_payload), lambda: encode_frame(frame), lambda: decode_frame(binary_payload))]
+    print("{:>8} {:>8} {:>14} {:>14}".format("format", "bytes", "encode/s", "decode/s"))
+    for name, size, encode, decode in rows:
+        start = time.perf_counter()
+        for _ in range(n):
+            encode()
+        encode_rate = n / (time.perf_counter() - start)
+        start = time.perf_counter()
+        for _ in range(n):
+            decode()
+        decode_rate = n / (time.perf_counter() - start)
+        print("{:>8} {:>8} {:>14.0f} {:>14.0f}".format(name, size, encode_rate, decode_rate))
@@ -0,0 +1,224 @@
+# ------------------------------------------------------------------------
+# coding=utf-8
+# ------------------------------------------------------------------------
+#
+#  Multi-tag tracking service: one particle filter per tag, with the tags
+#  sharded over a pool of worker processes
+# ------------------------------------------------------------------------
+
+import collections
+import multiprocessing as mp
+import os
+import queue
+import sys
+import time
+import zlib
+
+import numpy as np
+import paho.mqtt.client as mqtt
+
+from draw import Maze
+from location_codec import decode_batch, decode_payload
+from particle_filter import ROOM_MARGIN, Z_RANGE, Particle, ParticleFilter, filter_mqtt_frame
+
+# Constants for the MQTT
+MQTT_BROKER = "192.168.0.182"
+MQTT_PORT = 1883
+LOCATION_TOPIC = "Tag/+/Uplink/Location"
+LOCATION_BATCH_TOPIC = "Tag/+/Uplink/LocationBatch"
+
+
+def tag_id_from_topic(topic):
+    """ Tag/<tag_id>/Uplink/Location(Batch) -> <tag_id>
+    """
+    return topic.split('/')[1]
+
+
+def worker_for_tag(tag_id, worker_count):
+    """ Stable tag -> worker mapping, so a tag is always handled by the same
+        worker (and its filter state never has to move between processes).
+    """
+    return zlib.crc32(tag_id.encode()) % worker_count
+
+
+def tag_rng(seed, tag_id):
+    """ Random stream of one tag's filter, independent of the other tags and
+        reproducible for a given seed (unseeded if seed is None).
+    """
+    if seed is None:
+        return np.random.default_rng()
+    return np.random.default_rng([seed, zlib.crc32(tag_id.encode())])
+
+
+class TagWorker(object):
+    """
+    Worker process target. Keeps one ParticleFilter per tag_id, created on the
+    first frame of the tag and evicted after evict_after seconds of silence.
+    Reads (tag_id, frame) items from its own frame queue and puts
+    (tag_id, superFrameNumber, estimation.Estimate, particle count) on the
+    result queue; the estimate carries the top `modes` modes.
+    """
+    def __init__(self, anchor_list, particle_count=2000, evict_after=30, cpu=None, seed=None, modes=0,
+                 **filter_kwargs):
+        self.anchor_list = anchor_list
+        self.modes = modes
+        self.seed = seed
+        self.particle_count = particle_count
+        self.evict_after = evict_after
+        self.cpu = cpu
+        self.filter_kwargs = filter_kwargs
+
+    def create_filter(self, tag_id):
+        rng = tag_rng(self.seed, tag_id)
+        particles = Particle.create_random_particles(self.particle_count, self.world, rng=rng)
+        return ParticleFilter(particles, self.world, rng=rng, **self.filter_kwargs)
+
+    def evict_silent_tags(self, now, result_queue):
+        for tag_id in [t for t, (_, last_seen) in self.filters.items() if now - last_seen > self.evict_after]:
+            del self.filters[tag_id]
+            result_queue.put((tag_id, None, None, 0))
+
+    def __call__(self, frame_queue, result_queue):
+        if self.cpu is not None and hasattr(os, "sched_setaffinity"):
+            try:
+                os.sched_setaffinity(0, {self.cpu})
+            except OSError as e:
+                # e.g. the CPU is outside the allowed set of a container, run unpinned
+                print("Tag worker not pinned to CPU {}: {}".format(self.cpu, e))
+        self.world = Maze(None, anc_list=self.anchor_list, turtle_init=False, z_range=Z_RANGE, margin=ROOM_MARGIN)
+        self.filters = {}
+        while True:
+            try:
+                item = frame_queue.get(timeout=1.0)
+            except queue.Empty:
+                item = ()
+            now = time.monotonic()
+            if item is None:
+                return
+            if item:
+                tag_id, frame = item
+                if tag_id not in self.filters:
+                    self.filters[tag_id] = [self.create_filter(tag_id), now]
+                state = self.filters[tag_id]
+                state[1] = now
+                estimate = filter_mqtt_frame(state[0], self.world, frame, modes=self.modes)
+                result_queue.put((tag_id, frame.get('superFrameNumber'), estimate, len(state[0].particles)))
+            self.evict_silent_tags(now, result_queue)
+
+
+class MultiTagTracker(object):
+    """
+    Subscribes to the location topic of every tag and dispatches the frames
+    to a pool of TagWorker processes, sharded by tag_id.
+    Frames that do not fit in a worker's queue are dropped and counted, so
+    are payloads that do not decode. The recent superFrameNumbers of a tag
+    are forgotten after evict_after seconds of silence, like its filter.
+    """
+    def __init__(self, anchor_list, workers=None, queue_size=64, pin_cpus=True, evict_after=30, **worker_kwargs):
+        self.worker_count = workers or mp.cpu_count()
+        self.frame_queues = [mp.Queue(maxsize=queue_size) for _ in range(self.worker_count)]
+        self.result_queue = mp.Queue()
+        self.dropped = 0
+        self.duplicates = 0
+        self.decode_errors = 0
+        self.recent_frames = {}     # tag_id: [deque of the recent superFrameNumbers, last seen]
+        self.evict_after = evict_after
+        self.evicted_at = time.monotonic()
+        cpu_count = mp.cpu_count()
+        self.worker_processes = [
+            mp.Process(target=TagWorker(anchor_list, evict_after=evict_after, cpu=i % cpu_count if pin_cpus else None,
+                                        **worker_kwargs),
+                       args=(self.frame_queues[i], self.result_queue),
+                       name="Tag Worker {}".format(i), daemon=True)
+            for i in range(self.worker_count)]
+
+    def start(self):
+        for p in self.worker_processes:
+            p.start()
+
+    def stop(self):
+        for q in self.frame_queues:
+            q.put(None)
+        for p in self.worker_processes:
+            p.join()
+
+    def dispatch(self, tag_id, frame):
+        try:
+            self.frame_queues[worker_for_tag(tag_id, self.worker_count)].put_nowait((tag_id, frame))
+        except queue.Full:
+            self.dropped += 1
+
+    def evict_silent_tags(self, now):
+        for tag_id in [t for t, (_, last_seen) in self.recent_frames.items() if now - last_seen > self.evict_after]:
+            del self.recent_frames[tag_id]
+        self.evicted_at = now
+
+    def results(self, timeout=None):
+        """ Generator over the results of the workers, until none arrives for timeout seconds.
+        """
+        while True:
+            try:
+                yield self.result_queue.get(timeout=timeout)
+            except queue.Empty:
+                return
+
+    def mqtt_on_connect(self, client, userdata, flags, rc):
+        print("MQTT connected with result code "+str(rc))
+        client.subscribe([(LOCATION_TOPIC, 0), (LOCATION_BATCH_TOPIC, 0)])
+
+    def mqtt_on_message(self, client, userdata, msg):
+        tag_id = tag_id_from_topic(msg.topic)
+        try:
+            if msg.topic.endswith("/LocationBatch"):
+                frames = decode_batch(msg.payload)
+            else:
+                frames = [decode_payload(msg.payload)]
+            if not all(isinstance(frame, dict) for frame in frames):
+                raise TypeError("Location frames must be dictionaries")
+        except (ValueError, KeyError, TypeError):
+            # a malformed or foreign payload on the tag topics, never raise on the network thread
+            self.decode_errors += 1
+            return
+        now = time.monotonic()
+        if now - self.evicted_at >= 1.0:
+            self.evict_silent_tags(now)
+        state = self.recent_frames.setdefault(tag_id, [collections.deque(maxlen=64), now])
+        recent, state[1] = state[0], now
+        for frame in frames:
+            # a batching publisher repeats the last frame of a batch as the retained location
+            frame_number = frame.get('superFrameNumber')
+            if frame_number is not None:
+                if frame_number in recent:
+                    self.duplicates += 1
+                    continue
+                recent.append(frame_number)
+            self.dispatch(tag_id, frame)
+
+
+if __name__ == '__main__':
+    anchor_list = [('C584',16,0,151), ('DA36',40,325,79), ('9234',291,285,55), ('8287',270,0,134)] # unit in cm
+    EVICT_AFTER = 30    # seconds of silence before a tag's filter is dropped
+    tracker = MultiTagTracker(anchor_list, particle_count=2000, evict_after=EVICT_AFTER, adaptive_count=True)
+    tracker.start()
+    client = mqtt.Client()
+    client.on_connect = tracker.mqtt_on_connect
+    client.on_message = tracker.mqtt_on_message
+    client.connect(MQTT_BROKER, MQTT_PORT, 60)
+    client.loop_start()
+    try:
+        while True:
+            for tag_id, frame_number, estimate, particle_count in tracker.results(timeout=1.0):
+                if estimate is None:
+                    print("tag {} evicted after {} s of silence".format(tag_id, EVICT_AFTER))
+                    continue
+                m_x, m_y, m_z = estimate.mean
+                s_x, s_y, s_z = np.sqrt(np.diag(estimate.covariance))
+                print("tag {} frame {}: x: {} y: {} z: {} std: {} {} {} confident: {} particles: {} dropped frames: {} "
+                      "decode errors: {}"
+                      .format(tag_id, frame_number, round(m_x, 2), round(m_y, 2), round(m_z, 2),
+                              round(s_x, 2), round(s_y, 2), round(s_z, 2),
+                              estimate.confident, particle_count, tracker.dropped, tracker.decode_errors))
+    except KeyboardInterrupt:
+        client.loop_stop()
+        tracker.stop()
+        sys.exit()
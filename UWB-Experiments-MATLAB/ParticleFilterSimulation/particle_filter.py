@@ -10,14 +10,20 @@
 from typing import (Dict, List, Tuple, Set)
 
 import paho.mqtt.client as mqtt
+import argparse
+import atexit
+import collections
 import json
 from draw import *
 from plot_3d import *
-import random
+from frame_queue import FrameQueue, DROP_OLDEST, frame_interval
+from resampling import get_resampler, multinomial_resample, kld_resample, effective_sample_size, weight_entropy
+from estimation import estimate_state
+from telemetry import Telemetry, JsonlSink, StdoutSink
+from headless_render import FrameExporter
 import math
 import numpy as np
 from scipy.stats import multivariate_normal
-import bisect
 
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
@@ -26,23 +32,31 @@ import time
 
 
 AXIAL_NOISE, AXIAL_NOISE_LARGE=5,0.1
-SPEED_NOISE=0.5
+SPEED_NOISE=10      # unit in cm/s, scaled by the step interval: +-1 cm per step at 10 Hz
 HEADING_NOISE, HEADING_RANGE = 10, [0, 360]
 PITCH_NOISE, PITCH_RANGE = 10, [-90, 90]
 Z_RANGE = [30,150]
+ROOM_MARGIN = 25    # unit in cm, how far the tag may get outside the anchor bounds
 WEIGHT_CUT_OFF = 0.3
+SIM_STEP_INTERVAL = 0.1     # unit in s, the simulated frame interval (10 Hz like the tags)
+MAX_STEP_INTERVAL = 1.0     # unit in s, longer gaps between frames are not extrapolated further
 
 # ------------------------------------------------------------------------
 # Some utility functions
 
-def add_noise(level, range_lim=None, *coords):
+# Every stochastic component draws from a numpy.random.Generator passed in as
+# rng, so that runs can be reproduced from a seed. Without one, a fresh
+# unseeded generator is used.
+
+def add_noise(level, range_lim=None, *coords, rng=None):
+    rng = rng if rng is not None else np.random.default_rng()
     if len(coords)==1:
         if isinstance(coords[0], List):
-            raw = [x + random.uniform(-level, level) for x in coords[0]]    
+            raw = [x + n for x, n in zip(coords[0], rng.uniform(-level, level, size=len(coords[0])))]
         else:
-            raw = coords[0] + random.uniform(-level, level)
+            raw = coords[0] + rng.uniform(-level, level)
     else:
-        raw = [x + random.uniform(-level, level) for x in coords]
+        raw = [x + n for x, n in zip(coords, rng.uniform(-level, level, size=len(coords)))]
     if not range_lim:
         return raw
     elif isinstance(raw, List):
@@ -58,6 +72,28 @@ def add_noise(level, range_lim=None, *coords):
             raw = range_lim[1]
     return raw
 
+def add_noise_batch(level, range_lim, values, rng=None):
+    """
+    Vectorized add_noise() for a whole numpy array of coordinates.
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    raw = values + rng.uniform(-level, level, size=np.shape(values))
+    if range_lim:
+        raw = np.clip(raw, range_lim[0], range_lim[1])
+    return raw
+
+def motion_deltas(speed, xy_heading, pitch, delta_t=1):
+    """
+    Displacement (dx, dy, dz) for a speed along xy_heading/pitch (degrees),
+    works on scalars as well as on arrays of particles.
+    """
+    xy_heading_r, pitch_r = np.radians(xy_heading), np.radians(pitch)
+    speed_xy = np.cos(pitch_r) * speed
+    dx = np.sin(xy_heading_r) * speed_xy * delta_t
+    dy = np.cos(xy_heading_r) * speed_xy * delta_t
+    dz = np.sin(pitch_r) * speed * delta_t
+    return dx, dy, dz
+
 # This is just a gaussian kernel I pulled out of my hat, to transform
 # values near to robbie's measurement => 1, further away => 0
 SIGMA = 15
@@ -89,6 +125,18 @@ def w_gauss_multi(a: List, b: List, sigma: float) -> float:
         g = multivariate_normal.pdf(x=error, mean=mean, cov=cov) / center_pdf
         return g
 
+# Batched, log-domain counterpart of w_gauss_multi for the whole particle cloud.
+# a is the measured range vector (M,), b the predicted ranges of N particles (N x M).
+# Anchors that are inf on either side are left out of each particle's error, so
+# exp() of a row equals w_gauss_multi(a, b[i], sigma). Rows without any common
+# anchor carry no evidence and get a log weight of 0 (w_gauss_multi returns None).
+def log_w_gauss_multi_batch(a, b, sigma: float) -> np.ndarray:
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float).reshape(-1, len(a))
+    valid = np.isfinite(a) & np.isfinite(b)
+    error = np.subtract(a, b, out=np.zeros(b.shape), where=valid)
+    return -np.einsum('ij,ij->i', error, error) / (2 * sigma ** 2)
+
 # ------------------------------------------------------------------------
 def compute_mean_point(world, particles, dist_threshold=25):
     """
@@ -97,61 +145,47 @@ def compute_mean_point(world, particles, dist_threshold=25):
     addition to show the "best belief" for current position.
     """
 
-    m_x, m_y, m_z, m_count = 0, 0, 0, 0
-    for p in particles:
-        m_count += p.w
-        m_x += p.x * p.w
-        m_y += p.y * p.w
-        m_z += p.z * p.w
-
-    if m_count == 0:
+    if particles.w.sum() == 0:
         return -1, -1, -1, False
 
-    m_x /= m_count
-    m_y /= m_count
-    m_z /= m_count
-
-    # Now compute how good that mean is -- check how many particles
-    # actually are in the immediate vicinity
-    m_count = 0
-    for p in particles:
-        if world.euclidean_dist(p.x, p.y, p.z, m_x, m_y, m_z) < dist_threshold:
-            m_count += 1
-
-    return m_x, m_y, m_z, m_count > PARTICLE_COUNT * 0.95
+    # How good that mean is -- are 95% of the particles in its immediate vicinity
+    estimate = estimate_state(particles.xyz, particles.w, radius=dist_threshold, confidence_level=0.95)
+    m_x, m_y, m_z = (float(c) for c in estimate.mean)
+    return m_x, m_y, m_z, estimate.confident
 
 # ------------------------------------------------------------------------
 class WeightedDistribution(object):
-    def __init__(self, state):
-        accum = 0.0
-        self.state = [p for p in state if p.w > 0]
-        self.distribution = []
-        for x in self.state:
-            accum += x.w
-            self.distribution.append(accum)
+    def __init__(self, state, rng=None):
+        self.state = state
+        self.rng = rng if rng is not None else np.random.default_rng()
 
     def pick(self):
-        try:
-            uni = random.uniform(0, 1)
-            idx = bisect.bisect_left(self.distribution, uni)
-            picked_p = self.state[idx]
-            return picked_p
-        except IndexError:
-            # Happens when all particles are improbable w=0
+        idx = self.pick_indices(1)
+        if idx is None:
             return None
+        return self.state[int(idx[0])]
+
+    def pick_indices(self, count):
+        """
+        Draw count particle indices at once, proportionally to the weights.
+        Returns None when all particles are improbable (w=0).
+        """
+        return multinomial_resample(self.state.w, count, rng=self.rng)
 
 # ------------------------------------------------------------------------
 class Particle(object):
-    def __init__(self, x, y, z=0, xy_heading=None, pitch=None, w=1, noisy=False):
+    def __init__(self, x, y, z=0, xy_heading=None, pitch=None, w=1, noisy=False, rng=None):
+        if rng is None and (xy_heading is None or pitch is None or noisy):
+            rng = np.random.default_rng()
         if xy_heading is None:
-            xy_heading = random.uniform(HEADING_RANGE[0], HEADING_RANGE[1])
+            xy_heading = rng.uniform(HEADING_RANGE[0], HEADING_RANGE[1])
         if pitch is None:
-            pitch = random.uniform(PITCH_RANGE[0], PITCH_RANGE[1])
+            pitch = rng.uniform(PITCH_RANGE[0], PITCH_RANGE[1])
             pitch = 0
         if noisy:
-            x, y, z = add_noise(AXIAL_NOISE, [], x, y, z)
-            xy_heading = add_noise(HEADING_NOISE, HEADING_RANGE, xy_heading)
-            pitch = add_noise(PITCH_NOISE, PITCH_RANGE, pitch)
+            x, y, z = add_noise(AXIAL_NOISE, [], x, y, z, rng=rng)
+            xy_heading = add_noise(HEADING_NOISE, HEADING_RANGE, xy_heading, rng=rng)
+            pitch = add_noise(PITCH_NOISE, PITCH_RANGE, pitch, rng=rng)
             pitch = 0
 
         self.x = x
@@ -173,8 +207,9 @@ class Particle(object):
         return self.x, self.y, self.z
 
     @classmethod
-    def create_random_particles(cls, particle_count, maze):
-        return [cls(*maze.random_free_place(z_range=Z_RANGE)) for _ in range(0, particle_count)]
+    def create_random_particles(cls, particle_count, maze, rng=None):
+        places = maze.random_free_places(particle_count, rng=rng, z_range=Z_RANGE)
+        return ParticleSet(places[:, 0], places[:, 1], places[:, 2], rng=rng)
 
     def sim_read_nearest_sensor(self, maze):
         """
@@ -188,18 +223,14 @@ class Particle(object):
         """
         return maze.distances_to_all_beacons(*self.xyz)
 
-    def advance_by(self, speed, delta_t=1, checker=None, noisy=False):
+    def advance_by(self, speed, delta_t=1, checker=None, noisy=False, rng=None):
         xy_heading = self.xy_heading
         pitch = self.pitch
         if noisy:
-            speed = add_noise(SPEED_NOISE, [], speed)
-            xy_heading = add_noise(HEADING_NOISE, HEADING_RANGE, xy_heading)
-            pitch = add_noise(PITCH_NOISE, PITCH_RANGE, pitch)
-        xy_heading_r, pitch_r = math.radians(xy_heading), math.radians(pitch)
-        speed_xy = math.cos(pitch_r) * speed
-        dx = math.sin(xy_heading_r) * speed_xy * delta_t
-        dy = math.cos(xy_heading_r) * speed_xy * delta_t
-        dz = math.sin(pitch_r) * speed * delta_t
+            speed = add_noise(SPEED_NOISE, [], speed, rng=rng)
+            xy_heading = add_noise(HEADING_NOISE, HEADING_RANGE, xy_heading, rng=rng)
+            pitch = add_noise(PITCH_NOISE, PITCH_RANGE, pitch, rng=rng)
+        dx, dy, dz = (float(d) for d in motion_deltas(speed, xy_heading, pitch, delta_t))
         if checker is None or checker(self, dx, dy, dz):
             self.move_by(dx, dy, dz)
             return True
@@ -210,17 +241,118 @@ class Particle(object):
         self.y += y
         self.z += z
 
+# ------------------------------------------------------------------------
+class ParticleSet(object):
+    """
+    Struct-of-arrays store of the whole particle cloud. Each attribute
+    (x, y, z, xy_heading, pitch, w) is a contiguous numpy array of the same
+    length, so the filter steps work on all particles at once instead of
+    walking a list of Particle objects.
+    """
+    def __init__(self, x, y, z, xy_heading=None, pitch=None, w=None, rng=None):
+        self.x = np.array(x, dtype=float)
+        self.y = np.array(y, dtype=float)
+        self.z = np.array(z, dtype=float)
+        count = len(self.x)
+        if xy_heading is None:
+            rng = rng if rng is not None else np.random.default_rng()
+            xy_heading = rng.uniform(HEADING_RANGE[0], HEADING_RANGE[1], size=count)
+        if pitch is None:
+            pitch = np.zeros(count)
+        if w is None:
+            w = np.ones(count)
+        self.xy_heading = np.array(xy_heading, dtype=float)
+        self.pitch = np.array(pitch, dtype=float)
+        self.w = np.array(w, dtype=float)
+
+    def __len__(self):
+        return len(self.x)
+
+    def __getitem__(self, idx):
+        """
+        An integer index returns a Particle copy of that entry, anything
+        else (slice, index array, boolean mask) returns a new ParticleSet.
+        """
+        if isinstance(idx, (int, np.integer)):
+            return Particle(self.x[idx], self.y[idx], self.z[idx],
+                            xy_heading=self.xy_heading[idx], pitch=self.pitch[idx], w=self.w[idx])
+        return self.take(idx)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __repr__(self):
+        return "ParticleSet(%d particles)" % len(self)
+
+    @property
+    def xy(self):
+        return np.column_stack((self.x, self.y))
+
+    @property
+    def xyz(self):
+        return np.column_stack((self.x, self.y, self.z))
+
+    @classmethod
+    def from_particles(cls, particles):
+        return cls([p.x for p in particles], [p.y for p in particles], [p.z for p in particles],
+                   xy_heading=[p.xy_heading for p in particles], pitch=[p.pitch for p in particles],
+                   w=[p.w for p in particles])
+
+    def take(self, idx):
+        return ParticleSet(self.x[idx], self.y[idx], self.z[idx],
+                           xy_heading=self.xy_heading[idx], pitch=self.pitch[idx], w=self.w[idx])
+
+    def make_noisy(self, reset_weights=True, rng=None):
+        """
+        Array counterpart of Particle(..., noisy=True): jitter the position
+        and heading of every particle and (optionally) reset the weights.
+        """
+        rng = rng if rng is not None else np.random.default_rng()
+        self.x = add_noise_batch(AXIAL_NOISE, [], self.x, rng=rng)
+        self.y = add_noise_batch(AXIAL_NOISE, [], self.y, rng=rng)
+        self.z = add_noise_batch(AXIAL_NOISE, [], self.z, rng=rng)
+        self.xy_heading = add_noise_batch(HEADING_NOISE, HEADING_RANGE, self.xy_heading, rng=rng)
+        self.pitch = np.zeros(len(self))
+        if reset_weights:
+            self.w = np.ones(len(self))
+
+    def advance_by(self, speed, delta_t=1, checker=None, noisy=False, rng=None):
+        """
+        Array counterpart of Particle.advance_by: move every particle by speed
+        along its own heading/pitch, with independent speed/heading/pitch noise
+        per particle if noisy. checker(particles, dx, dy, dz) returns a boolean
+        array of the particles allowed to move; the others stay in place.
+        Returns the boolean array of moved particles.
+        """
+        xy_heading = self.xy_heading
+        pitch = self.pitch
+        if noisy:
+            rng = rng if rng is not None else np.random.default_rng()
+            speed = add_noise_batch(SPEED_NOISE, [], np.full(len(self), speed, dtype=float), rng=rng)
+            xy_heading = add_noise_batch(HEADING_NOISE, HEADING_RANGE, xy_heading, rng=rng)
+            pitch = add_noise_batch(PITCH_NOISE, PITCH_RANGE, pitch, rng=rng)
+        dx, dy, dz = motion_deltas(speed, xy_heading, pitch, delta_t)
+        moved = np.ones(len(self), dtype=bool)
+        if checker is not None:
+            moved = np.asarray(checker(self, dx, dy, dz), dtype=bool)
+        self.x = self.x + np.where(moved, dx, 0)
+        self.y = self.y + np.where(moved, dy, 0)
+        self.z = self.z + np.where(moved, dz, 0)
+        return moved
+
 # ------------------------------------------------------------------------
 class Robot(Particle):
     speed = 0
 
-    def __init__(self, maze):
-        super(Robot, self).__init__(*maze.random_free_place(z_range=Z_RANGE), xy_heading=90)
+    def __init__(self, maze, rng=None):
+        self.rng = rng if rng is not None else np.random.default_rng()
+        super(Robot, self).__init__(*maze.random_free_place(rng=self.rng, z_range=Z_RANGE), xy_heading=90)
         self.chose_random_direction()
         self.step_count = 0
 
     def chose_random_direction(self):
-        self.xy_heading = random.uniform(HEADING_RANGE[0], HEADING_RANGE[1])
+        self.xy_heading = self.rng.uniform(HEADING_RANGE[0], HEADING_RANGE[1])
 
     def sim_read_nearest_sensor(self, maze, noise_level=AXIAL_NOISE):
         """
@@ -228,7 +360,7 @@ class Robot(Particle):
         it only can measure the distance to the nearest beacon(!)
         and is not very accurate at that too!
         """
-        return add_noise(noise_level, super(Robot, self).sim_read_nearest_sensor(maze))
+        return add_noise(noise_level, super(Robot, self).sim_read_nearest_sensor(maze), rng=self.rng)
     
     def sim_read_sensors(self, maze, range_lim=[], noise_level=AXIAL_NOISE):
         """
@@ -238,14 +370,14 @@ class Robot(Particle):
         random_loss: True/False
             Simulate the randomized reading loss for some of the sensors (beacons)
         """
-        return add_noise(noise_level, range_lim, super(Robot, self).sim_read_sensors(maze))
+        return add_noise(noise_level, range_lim, super(Robot, self).sim_read_sensors(maze), rng=self.rng)
 
     def move(self, maze, speed, delta_t):
         """
         Move the robot with true application readings. Note that the movement is stochastic too.
         """
         self.step_count += 1
-        self.advance_by(speed, delta_t=1, noisy=True, checker=None)
+        self.advance_by(speed, delta_t=delta_t, noisy=True, checker=None, rng=self.rng)
     
     def sim_move(self, maze, speed, delta_t):
         """
@@ -253,13 +385,119 @@ class Robot(Particle):
         """
         self.step_count += 1
         while True:
-            if self.advance_by(speed, delta_t=1, noisy=True,
+            if self.advance_by(speed, delta_t=delta_t, noisy=True, rng=self.rng,
                         checker=lambda r, dx, dy, dz: maze.is_free(r.x+dx, r.y+dy, r.z+dz)):
                 break
             # In simulation, bumped into something or too long in same direction,
             # chose random new direction
             self.chose_random_direction()
 
+# ------------------------------------------------------------------------
+class ParticleFilter(object):
+    """
+    Weight update, normalization and resampling of a ParticleSet.
+    Resampling only happens when the effective sample size drops below
+    resample_threshold * N; otherwise the weights are carried over to the
+    next step. Per-step statistics are passed to stats_callback(stats).
+
+    With adaptive_count the particle count is chosen by KLD-sampling on every
+    resample: kld_bin_size (cm) is the histogram bin width, kld_epsilon and
+    kld_delta the error bound, and min_particles/max_particles the limits.
+    sigma is the ranging noise (cm) of the likelihood.
+    All random draws of the filter come from rng.
+    """
+    def __init__(self, particles, maze, resampling="systematic", resample_threshold=0.5,
+                 stats_callback=None, adaptive_count=False, kld_bin_size=20, kld_epsilon=0.05,
+                 kld_delta=0.01, min_particles=300, max_particles=10000, sigma=SIGMA, rng=None):
+        self.particles = particles
+        self.maze = maze
+        self.sigma = sigma
+        self.rng = rng if rng is not None else np.random.default_rng()
+        self.resample = get_resampler(resampling)
+        self.resample_threshold = resample_threshold
+        self.adaptive_count = adaptive_count
+        self.kld_bin_size = kld_bin_size
+        self.kld_epsilon = kld_epsilon
+        self.kld_delta = kld_delta
+        self.min_particles = min_particles
+        self.max_particles = max_particles
+        self.stats_callback = stats_callback
+        self.step_count = 0
+        self.resample_count = 0
+        self.weight_sum = 0
+
+    def update_weights(self, r_ds, p_ds, is_free=None):
+        """
+        Multiply the particle weights with the likelihood of the ranges r_ds
+        given the predicted ranges p_ds (N x M). Particles outside the free
+        space (is_free False) get w=0.
+        """
+        likelihood = np.exp(log_w_gauss_multi_batch(r_ds, p_ds, sigma=self.sigma))
+        if is_free is not None:
+            likelihood = np.where(is_free, likelihood, 0)
+        self.particles.w = self.particles.w * likelihood
+
+    def predict(self, speed, d_xy_heading=0, delta_t=1, checker=None):
+        """
+        Motion update: turn the particles by d_xy_heading and move them by the
+        believed speed with noise. Particles rejected by checker stay in place.
+        """
+        if d_xy_heading:
+            self.particles.xy_heading = np.mod(self.particles.xy_heading + d_xy_heading, 360)
+        return self.particles.advance_by(speed, delta_t=delta_t, checker=checker, noisy=True, rng=self.rng)
+
+    def normalize(self):
+        self.weight_sum = self.particles.w.sum()
+        if self.weight_sum:
+            self.particles.w /= self.weight_sum
+        return self.weight_sum
+
+    def resample_if_needed(self, xy_heading=None):
+        """
+        Resample when the ESS is too low, regenerate all particles when every
+        particle is improbable, otherwise only diffuse the particles.
+        xy_heading overrides the heading of resampled particles (compass).
+        """
+        count = len(self.particles)
+        ess = effective_sample_size(self.particles.w)
+        entropy = weight_entropy(self.particles.w) if self.stats_callback is not None else None
+        picked, generated, resampled = 0, 0, False
+        if not self.weight_sum:
+            # No pick b/c all totally improbable, the belief is spread out again
+            generated = self.max_particles if self.adaptive_count else count
+            self.particles = Particle.create_random_particles(generated, self.maze, rng=self.rng)
+        elif ess < self.resample_threshold * count:
+            if self.adaptive_count:
+                picked_idx = kld_resample(self.particles.w, self.particles.xyz, self.kld_bin_size,
+                                          epsilon=self.kld_epsilon, delta=self.kld_delta,
+                                          min_count=self.min_particles, max_count=self.max_particles,
+                                          rng=self.rng)
+            else:
+                picked_idx = self.resample(self.particles.w, rng=self.rng)
+            self.particles = self.particles.take(picked_idx)
+            if xy_heading is not None:
+                self.particles.xy_heading[:] = xy_heading
+            self.particles.make_noisy(rng=self.rng)
+            picked, resampled = len(self.particles), True
+            self.resample_count += 1
+        else:
+            self.particles.make_noisy(reset_weights=False, rng=self.rng)
+        self.step_count += 1
+        if self.stats_callback is not None:
+            self.stats_callback({
+                "step": self.step_count,
+                "particle_count": len(self.particles),
+                "weight_sum": float(self.weight_sum),
+                "ess": ess,
+                "ess_fraction": ess / count if count else 0.0,
+                "weight_entropy": entropy,
+                "resampled": resampled,
+                "resample_count": self.resample_count,
+                "picked": picked,
+                "generated": generated,
+            })
+        return self.particles
+
 
 def mqtt_on_connect(client, userdata, flags, rc):
     """
@@ -268,32 +506,22 @@ def mqtt_on_connect(client, userdata, flags, rc):
     print("MQTT connected with result code "+str(rc))
     # Subscribing in on_connect() means that if we lose the connection and
     # reconnect then subscriptions will be renewed.
-    client.subscribe("Tag/9A1C/Uplink/Location")
+    client.subscribe([("Tag/9A1C/Uplink/Location", 0), ("Tag/9A1C/Uplink/LocationBatch", 0)])
 
 
 def mqtt_on_message(client, userdata, msg):
     """
     The callback for when a PUBLISH message is received from the server.
+    The payload is decoded into a timestamped LocationFrame and handed to the
+    filter loop through the FrameQueue passed as the client userdata, nothing
+    else is touched on the network thread. The retained latest frame of a
+    batching publisher repeats the last frame of its batch and is dropped as
+    duplicate by the queue.
     """
-    global mqtt_data, spd_window_size, last_uwb_pos, new_uwb_pos_semaphore
-    prev_mqtt_data = mqtt_data
-    mqtt_data = json.loads(msg.payload.decode("utf-8"))
-    if 'est_pos' in mqtt_data.keys():
-        prev_uwb_pos = last_uwb_pos
-        new_uwb_pos_semaphore = True
-        last_uwb_pos = [mqtt_data['est_pos'],  time.time()]
-        curr_x, curr_y = last_uwb_pos[0]['x'], last_uwb_pos[0]['y']
-        if prev_uwb_pos:
-            prev_x, prev_y = prev_uwb_pos[0]['x'], prev_uwb_pos[0]['y']
-            displacement = math.sqrt((curr_x - prev_x) ** 2 + (curr_y - prev_y) ** 2)
-            time_diff = last_uwb_pos[1] - prev_uwb_pos[1]
-            if time_diff > 0:
-                differential_spd = displacement / time_diff * 100   # unit in cm
-                if len(speed_window) < spd_window_size:
-                    speed_window.append(differential_spd)
-                else:
-                    speed_window.pop(0)
-                    speed_window.append(differential_spd)
+    if msg.topic.endswith("/LocationBatch"):
+        userdata.put_batch_payload(msg.payload)
+    else:
+        userdata.put_payload(msg.payload)
 
 def parse_anchor_id(json_dict):
     ret = []
@@ -325,8 +553,42 @@ def particle_anchor_ranging(selected_anc, json_dict, particle):
     return ret
 
 
+def free_space_checker(maze, **kwargs):
+    """
+    Vectorized checker for ParticleSet.advance_by, only lets particles move
+    into free space of the maze.
+    """
+    return lambda particles, dx, dy, dz: maze.is_free_batch(
+        np.column_stack((particles.x + dx, particles.y + dy, particles.z + dz)), **kwargs)
+
+def filter_mqtt_frame(pf, world, mqtt_data, xy_heading=None, modes=0):
+    """
+    Run one weight/normalize/resample step of the ParticleFilter pf on a
+    decoded MQTT location frame. Returns the estimation.Estimate (mean,
+    covariance, confidence and the top modes) of the weighted particles.
+    """
+    selected_anc = sorted(parse_anchor_id(mqtt_data))
+    r_ds = parse_tag_ranging(selected_anc, mqtt_data)  # unit in m
+    r_ds = [round(i*100) if i != float('inf') else i for i in r_ds]     # convert unit to cm
+    particles = pf.particles
+    is_free = world.is_free_batch(particles.xyz)
+    p_ds = world.distance_matrix(particles.xyz, selected_anc)
+    pf.update_weights(r_ds, p_ds, is_free)
+    estimate = estimate_state(particles.xyz, particles.w, radius=5, modes=modes)
+    pf.normalize()
+    pf.resample_if_needed(xy_heading=xy_heading)
+    return estimate
+
 if __name__ == '__main__':
-    PARTICLE_COUNT = 2000       # Total number of particles
+    parser = argparse.ArgumentParser(description="UWB particle filter")
+    parser.add_argument("--seed", type=int, default=None,
+                        help="seed of the random streams, makes a SIMULATION run reproducible")
+    args = parser.parse_args()
+
+    PARTICLE_COUNT = 2000       # Initial number of particles
+    ADAPTIVE_PARTICLE_COUNT = True  # KLD-sampling of the particle count on every resample
+    MIN_PARTICLES, MAX_PARTICLES = 300, 10000
+    KLD_BIN_SIZE = 20           # histogram bin width for KLD-sampling, unit in cm
     SIMULATION = False           # switch between simulation and application
     # create the particle filter maze world
     # anchor_list = [('00',0,0,0), ('01',9,0,0), ('02',9,9,0), ('03',0,9,0)] # no units
@@ -340,26 +602,57 @@ if __name__ == '__main__':
     # with 3000+ particles, it obviously needs lots more hypotheses as a 2
     # now has to correctly match not only the position but also the xy_heading.
     RANDOM_LOSS = False
+    RESAMPLING = "systematic"   # one of: systematic, stratified, residual, multinomial
+    RESAMPLE_THRESHOLD = 0.5    # resample once the ESS drops below this fraction of the particles
     PLOT_3D = True
     PLOT_PARTICLE_STATS = True
-    if PLOT_3D:
-        world = Maze(maze_data, anc_list=anchor_list, turtle_init=False)
-        pl = NBWorldPlot(world=world)
+    HEADLESS = False            # no turtle or plot windows, e.g. on the servers
+    EXPORT_FRAMES = None        # directory for a PNG sequence or a .avi/.mjpeg file, None for no export
+    EXPORT_EVERY = 5            # export every n-th step
+    PRINT_INTERVAL = 1.0        # seconds between the telemetry printouts, None for no printing
+    TELEMETRY_LOG = None        # JSONL file the telemetry of every step is appended to, None for no log
+    # Independent random streams of the world, the (simulated) robot, the filter
+    # and the simulated reading loss, all derived from the one --seed
+    world_rng, robot_rng, filter_rng, loss_rng = [
+        np.random.default_rng(s) for s in np.random.SeedSequence(args.seed).spawn(4)]
+    if HEADLESS:
+        PLOT_3D = PLOT_PARTICLE_STATS = False
+    if PLOT_3D or HEADLESS:
+        world = Maze(maze_data, anc_list=anchor_list, turtle_init=False, rng=world_rng,
+                     z_range=Z_RANGE, margin=ROOM_MARGIN)
+        if PLOT_3D:
+            pl = NBWorldPlot(world=world, capacity=MAX_PARTICLES)
+            atexit.register(pl.close)     # stop the plotter and free its shared memory
     else:
-        world = Maze(maze_data, anc_list=anchor_list, turtle_init=True)
+        world = Maze(maze_data, anc_list=anchor_list, turtle_init=True, rng=world_rng,
+                     z_range=Z_RANGE, margin=ROOM_MARGIN)
     if PLOT_PARTICLE_STATS:
-        pl_stats = NBStatsPlot()
+        pl_stats = NBStatsPlot(capacity=MAX_PARTICLES)
+        atexit.register(pl_stats.close)
+    if EXPORT_FRAMES is not None:
+        exporter = FrameExporter(world, EXPORT_FRAMES, every=EXPORT_EVERY)
+        atexit.register(exporter.close)    # finish the video on Ctrl-C
+    telemetry = Telemetry()
+    if PRINT_INTERVAL is not None:
+        telemetry.add_sink(StdoutSink(interval=PRINT_INTERVAL))
+    if TELEMETRY_LOG is not None:
+        telemetry.add_sink(JsonlSink(TELEMETRY_LOG))
     # initial distribution assigns each particle an equal probability
-    particles = Particle.create_random_particles(PARTICLE_COUNT, world)
-    robbie = Robot(world)
-
+    particles = Particle.create_random_particles(PARTICLE_COUNT, world, rng=filter_rng)
+    pf = ParticleFilter(particles, world, resampling=RESAMPLING, resample_threshold=RESAMPLE_THRESHOLD,
+                        stats_callback=telemetry.update if telemetry.enabled else None,
+                        adaptive_count=ADAPTIVE_PARTICLE_COUNT,
+                        kld_bin_size=KLD_BIN_SIZE, min_particles=MIN_PARTICLES, max_particles=MAX_PARTICLES,
+                        rng=filter_rng)
+    robbie = Robot(world, rng=robot_rng)
+
+    step_interval = SIM_STEP_INTERVAL     # unit in s, the robbie.speed (cm/s) is applied over it
     if not SIMULATION:
-        last_uwb_pos = None
-        new_uwb_pos_semaphore = False
-        mqtt_data = None
+        last_frame = last_pos_frame = None
         spd_window_size = 10
-        speed_window = []
-        client = mqtt.Client()
+        speed_window = collections.deque(maxlen=spd_window_size)
+        frame_queue = FrameQueue(maxlen=16, policy=DROP_OLDEST)
+        client = mqtt.Client(userdata=frame_queue)
         client.on_connect = mqtt_on_connect
         client.on_message = mqtt_on_message
         client.connect("192.168.0.182", 1883, 60)
@@ -373,22 +666,33 @@ if __name__ == '__main__':
         # robbie's sensor reading
         
         if not SIMULATION:
-            if not mqtt_data:
+            # Block until the next frame arrives, every frame is processed once
+            frame = frame_queue.get(timeout=1.0)
+            if frame is None:
                 continue
-            selected_anc = sorted(parse_anchor_id(mqtt_data))
+            telemetry.begin_step()
+            if last_frame is not None:
+                # time the motion update by the frame interval, a gap is not extrapolated beyond MAX_STEP_INTERVAL
+                step_interval = min(frame_interval(last_frame, frame), MAX_STEP_INTERVAL)
+            last_frame = frame
+            selected_anc = sorted(frame.anchor_ids)
             if not RANDOM_LOSS:
                 chosen_idx = list(range(len(selected_anc)))
             else:
-                chosen_idx = random.sample(range(len(selected_anc)), random.randint(0, len(selected_anc)))
-                selected_anc = random.sample(selected_anc, random.randint(0, len(selected_anc)))
-            r_ds = parse_tag_ranging(selected_anc, mqtt_data)  # unit in m
-            r_ds = [round(i*100) for i in r_ds]     # convert unit to cm
+                chosen_idx = list(loss_rng.choice(len(selected_anc), loss_rng.integers(0, len(selected_anc) + 1),
+                                                  replace=False))
+                selected_anc = [str(a) for a in loss_rng.choice(selected_anc, loss_rng.integers(0, len(selected_anc) + 1),
+                                                                replace=False)]
+            r_ds = [frame.ranges.get(anc, float('inf')) for anc in selected_anc]  # unit in m
+            # an anchor of all_anc_id missing from the frame stays inf, as in filter_mqtt_frame
+            r_ds = [round(i*100) if i != float('inf') else i for i in r_ds]     # convert unit to cm
         else:
+            telemetry.begin_step()
             r_ds = robbie.sim_read_sensors(world)
             if not RANDOM_LOSS:
                 chosen_idx = list(range(len(r_ds)))
             else:
-                chosen_idx = random.sample(range(len(r_ds)), random.randint(0, len(r_ds)))
+                chosen_idx = list(loss_rng.choice(len(r_ds), loss_rng.integers(0, len(r_ds) + 1), replace=False))
             selected_anc = [sorted([anchor_list[i][0] for j in anchor_list])[i] for i in chosen_idx]
             for i in range(len(r_ds)):
                 if i not in chosen_idx:
@@ -396,96 +700,67 @@ if __name__ == '__main__':
         
         # ---------- Update particle weights ----------
 
-        max_weight = 0
-        for p in particles:
-            if world.is_free(*p.xyz):
-                if not SIMULATION:
-                    p_ds = particle_anchor_ranging(selected_anc, mqtt_data, p)
-                else:
-                    p_ds = p.sim_read_sensors(world)
-                    for i in range(len(r_ds)):
-                        if i not in chosen_idx:
-                            p_ds[i] = float('inf')
-                new_weight = w_gauss_multi(r_ds, p_ds, sigma=SIGMA)
-                max_weight = max(max_weight, new_weight)
-                if new_weight is not None:
-                    # if new_weight > 0.95 * (max_weight):
-                        # print(selected_anc)
-                        # print(robbie.x, robbie.y, robbie.z)
-                        # print(p.x, p.y, p.z)
-                        # print(r_ds)
-                        # print(p_ds)
-                        # print('\n')
-                    p.w = new_weight
-            else:
-                p.w = 0
-        print("before shuffle: min/max weight: {}/{}".format(min([p.w for p in particles]), max([p.w for p in particles])))
+        particles = pf.particles
+        is_free = world.is_free_batch(particles.xyz)
+        # Predicted ranges of all particles from the configured anchor positions
+        # (unit in cm), anchors unknown to the world are masked out as inf.
+        # In simulation r_ds already carries inf for the lost readings
+        p_ds = world.distance_matrix(particles.xyz, selected_anc if not SIMULATION else None)
+        pf.update_weights(r_ds, p_ds, is_free)
+        telemetry.lap("weight")
         
         # ---------- Update the UWB-measured positions ----------
-        if not SIMULATION:
-            if new_uwb_pos_semaphore:
-                robbie.x, robbie.y, robbie.z = last_uwb_pos[0]['x']*100, last_uwb_pos[0]['y']*100, last_uwb_pos[0]['z']*100 #unit in cm
-                new_uwb_pos_semaphore = False
+        if not SIMULATION and frame.est_pos is not None:
+            robbie.x, robbie.y, robbie.z = [c * 100 for c in frame.est_pos]    # unit in cm
+            if last_pos_frame is not None:
+                # speed between the tag positions, timed by the tag's clock when it reports one
+                time_diff = frame_interval(last_pos_frame, frame)
+                if time_diff > 0:
+                    displacement = math.hypot(frame.est_pos[0] - last_pos_frame.est_pos[0],
+                                              frame.est_pos[1] - last_pos_frame.est_pos[1])
+                    speed_window.append(displacement / time_diff * 100)    # unit in cm
+            last_pos_frame = frame
         
         # ---------- Show current state ----------
         m_x, m_y, m_z, confidence_indicator = compute_mean_point(world, particles, dist_threshold=5)
-        if not PLOT_3D:
+        telemetry.lap("mean")
+        if PLOT_3D:
+            if plt.get_backend() == "MacOSX":   # MacOS might require a different start method
+                mp.set_start_method("forkserver")
+            pl.plot(data=[selected_anc, robbie, particles, (m_x, m_y, m_z, confidence_indicator)])
+        elif not HEADLESS:
             world.draw(selected_anc)
             world.show_particles(particles)
             world.show_mean(m_x, m_y, confidence_indicator)
             world.show_robot(robbie)
-        else:
-            if plt.get_backend() == "MacOSX":   # MacOS might require a different start method
-                mp.set_start_method("forkserver")
-            pl.plot(data=[selected_anc, robbie, particles, (m_x, m_y, m_z, confidence_indicator)])
+        if PLOT_PARTICLE_STATS:
+            pl_stats.plot(data=[particles.w])
+        if EXPORT_FRAMES is not None:
+            exporter.export(particles.xyz, particles.w, mean=(m_x, m_y, m_z), confident=confidence_indicator,
+                            truth=(robbie.x, robbie.y, robbie.z), selected=selected_anc)
+        telemetry.lap("plot")
+        # ---------- Normalise weights ----------
+        telemetry.update_particles(particles)
+        pf.normalize()
+        telemetry.lap("normalize")
+
         # ---------- Shuffle particles ----------
-        new_particles = []
+        particles = pf.resample_if_needed(xy_heading=robbie.xy_heading if ROBOT_HAS_COMPASS else None)
+        telemetry.lap("resample")
 
-        # ---------- Normalise weights ----------
-        pl_stats.plot(data=[particles])
-        nu = sum(p.w for p in particles)
-        if nu:
-            for p in particles:
-                p.w = p.w / nu
-        print("after shuffle: min/max weight: {}/{}".format(min([p.w for p in particles]), max([p.w for p in particles])))
-        print("weight sum: {}\n".format(nu))
-
-        picked, generated = [], []
-        
-        # ---------- Create a weighted distribution, for fast picking ----------
-        dist = WeightedDistribution(particles)
-        for _ in particles:
-            p = dist.pick()
-            if p is None:  # No pick b/c all totally improbable
-                new_particle = Particle.create_random_particles(1, world)[0]
-                generated.append(new_particle)
-            else:
-                new_particle = Particle(p.x, p.y, p.z, 
-                        xy_heading=robbie.xy_heading if ROBOT_HAS_COMPASS else p.xy_heading, 
-                        noisy=True)
-                picked.append(new_particle)
-            new_particles.append(new_particle)
-
-        particles = new_particles
-        # print(r_ds, p_ds)
-        print("Robot speed: {}, picked particle: {}, generated particle: {}"
-                .format(robbie.speed, len(picked), len(generated)))
-        print("particle x range: [{}-{}] y range: [{}-{}] z range: [{}-{}]"
-                .format(round(min([p.x for p in particles]),2), round(max([p.x for p in particles]),2), 
-                        round(min([p.y for p in particles]),2), round(max([p.y for p in particles]),2),
-                        round(min([p.z for p in particles]),2), round(max([p.z for p in particles]),2)))
-        print("particle x: {} y: {} z: {}"
-                .format(round(m_x,2), round(m_y,2), round(m_z, 2)))
-        print("uwb x: {}, y: {}, z: {}".format(round(robbie.x,2), round(robbie.y, 2), round(robbie.z,2)))
         if not SIMULATION:
             if speed_window:
                 robbie.speed = sum(speed_window) / len(speed_window)
         # ---------- Move things ----------
         old_xy_heading = robbie.xy_heading
-        robbie.move(world, speed=robbie.speed, delta_t=1)
+        robbie.move(world, speed=robbie.speed, delta_t=step_interval)
         d_xy_heading = robbie.xy_heading - old_xy_heading
         # Move particles according to my belief of movement (this may
-        # be different than the real movement, but it's all I got)
-        # for p in particles:
-        #     p.xy_heading += d_xy_heading # in case robot changed xy_heading, swirl particle xy_heading too
-        #     p.advance_by(robbie.speed)
\ No newline at end of file
+        # be different than the real movement, but it's all I got). In case
+        # robot changed xy_heading, swirl particle xy_heading too
+        pf.predict(robbie.speed, d_xy_heading=d_xy_heading, delta_t=step_interval,
+                   checker=free_space_checker(world, z_range=Z_RANGE))
+        telemetry.lap("move")
+        telemetry.end_step(mean=(m_x, m_y, m_z), confident=confidence_indicator,
+                           uwb=(robbie.x, robbie.y, robbie.z), robot_speed=robbie.speed, step_interval=step_interval,
+                           frames=frame_queue.stats() if not SIMULATION else None)
\ No newline at end of file
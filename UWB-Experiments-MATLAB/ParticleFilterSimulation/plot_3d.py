@@ -5,13 +5,16 @@ import matplotlib.pyplot as plt
 import mpl_toolkits.mplot3d.axes3d as p3
 import numpy as np
 
-# Fixing random state for reproducibility
-np.random.seed(19680801)
+from shared_frames import SharedFrameBuffer
+
 DRAW_EVERY = 10
+FRAME_CAPACITY = 10000  # particles per shared memory frame, larger clouds are thinned out
+FRAME_INTERVAL = 50     # ms between the checks of the world plotter for a new frame
 
 class WorldProcessPlotter(object):
     def __init__(self, **kwargs):
         self.world = kwargs.get('world', None)
+        self.last_generation = 0
     
     def terminate(self):
         plt.close('all')
@@ -19,57 +22,67 @@ class WorldProcessPlotter(object):
     def weight_to_color(self, weight):
         return "#%02x00%02x" % (int(weight * 255), int((1 - weight) * 255))
 
+    def weights_to_colors(self, weights):
+        """
+        Vectorized weight_to_color(), returns an (N, 3) RGB array.
+        """
+        weights = np.clip(weights, 0, 1)
+        return np.column_stack((weights, np.zeros(len(weights)), 1 - weights))
+
+    def create_artists(self):
+        """
+        Create the anchor, particle, mean and robot artists once, every frame
+        only updates their data in place.
+        """
+        self.ax.set_xlabel('X axis')
+        self.ax.set_ylabel('Y axis')
+        self.ax.set_zlabel('Z axis')
+        self.ax.set_xlim3d(self.world.bounds_min[0], self.world.bounds_max[0])
+        self.ax.set_ylim3d(self.world.bounds_min[1], self.world.bounds_max[1])
+        self.ax.set_zlim3d(self.world.bounds_min[2], self.world.bounds_max[2])
+        anchor_x, anchor_y, anchor_z = self.world.anchor_xyz.T
+        self.anchor_artist = self.ax.scatter(anchor_x, anchor_y, anchor_z, marker='o', s=40, c='r', depthshade=False)
+        self.particle_artist = self.ax.scatter([], [], [], marker='o', depthshade=False)
+        self.mean_artist, = self.ax.plot([], [], [], 'o', color='gray', markersize=12, alpha=0.6)
+        self.robot_artist, = self.ax.plot([], [], [], 'g*', markersize=20)
+
     def world_plot_call_back(self):
         """
         Define plotting details and actions within callback function. 
         Called regularly within self.__call__(conn)
         """
-        xlm=self.ax.get_xlim3d() #we use them in the next
-        ylm=self.ax.get_ylim3d() #we use them in the next
-        zlm=self.ax.get_zlim3d() #graph to reproduce the magnification from mousing
         while self.pipe_conn.poll():
-            command = self.pipe_conn.recv()
-            if command is None:
+            if self.pipe_conn.recv() is None:
                 self.terminate()
                 return False
-            else:
-                self.ax.clear()
-                [selected_anc, robbie, particles, (m_x, m_y, m_z, confidence_indicator)] = command
-                self.ax.set_xlabel('X axis')
-                self.ax.set_ylabel('Y axis')
-                self.ax.set_zlabel('Z axis')
-                if xlm != (0, 1.0): # (0,1.0) by default, avoid the default because we want the lim to be calculated automatically
-                    self.ax.set_xlim3d(xlm[0], xlm[1])
-                    self.ax.set_ylim3d(ylm[0], ylm[1])
-                    self.ax.set_zlim3d(zlm[0], zlm[1])
-                # draw the beacons/anchors
-                x, y, z, attr = [], [] ,[], []
-                for i in range(len(self.world.beacons)):
-                    x, y, z = self.world.beacons[i][1],self.world.beacons[i][2],self.world.beacons[i][3]
-                    if self.world.beacons[i][0] in selected_anc:
-                        self.ax.plot(x, y, z, 'go')
-                    else:
-                        self.ax.plot(x, y, z, 'ro')
-                draw_cnt = 0
-                for p in particles:
-                    draw_cnt += 1
-                    if DRAW_EVERY == 0 or draw_cnt % DRAW_EVERY == 1:
-                        self.ax.plot(p.x, p.y, p.z, 'o', color=self.weight_to_color(p.w))
-                self.ax.plot(robbie.x, robbie.y, robbie.z, 'g*', markersize=20)
-                self.fig.canvas.draw()
-                xlm=self.ax.get_xlim3d() #These are two tupples
-                ylm=self.ax.get_ylim3d() #we use them in the next
-                zlm=self.ax.get_zlim3d() #graph to reproduce the magnification from mousing
-                azm=self.ax.azim
-                ele=self.ax.elev
+        # Only the latest frame is drawn, the ones published in between are skipped
+        frame = self.frames.read(self.last_generation)
+        if frame is not None:
+            generation, meta, (p_x, p_y, p_z, p_w) = frame
+            self.counters[1] += generation - self.last_generation - 1
+            self.counters[0] += 1
+            self.last_generation = generation
+            robot_xyz, mean_xyz, confident, selected = meta[:3], meta[3:6], meta[6], meta[7:].astype(bool)
+            self.anchor_artist.set_color(np.where(selected[:, np.newaxis], (0, 0.5, 0, 1), (1, 0, 0, 1)))
+            step = DRAW_EVERY if DRAW_EVERY > 0 else 1
+            self.particle_artist._offsets3d = (p_x[::step], p_y[::step], p_z[::step])
+            self.particle_artist.set_color(self.weights_to_colors(p_w[::step]))
+            self.mean_artist.set_data_3d([mean_xyz[0]], [mean_xyz[1]], [mean_xyz[2]])
+            self.mean_artist.set_color('g' if confident else 'gray')
+            self.robot_artist.set_data_3d([robot_xyz[0]], [robot_xyz[1]], [robot_xyz[2]])
+            self.ax.set_title("frames drawn: {} dropped: {}".format(*self.counters))
+            self.fig.canvas.draw_idle()
         return True
 
-    def __call__(self, pipe_conn):
+    def __call__(self, pipe_conn, frames, counters):
         print('starting world plotter...')
         self.pipe_conn = pipe_conn
+        self.frames = frames
+        self.counters = counters    # frames drawn, frames dropped
         self.fig = plt.figure(figsize=plt.figaspect(0.5))
-        self.ax = p3.Axes3D(self.fig)
-        timer = self.fig.canvas.new_timer(interval=1)
+        self.ax = self.fig.add_subplot(projection='3d')
+        self.create_artists()
+        timer = self.fig.canvas.new_timer(interval=FRAME_INTERVAL)
         timer.add_callback(self.world_plot_call_back)
         timer.start()
 
@@ -79,7 +92,7 @@ class WorldProcessPlotter(object):
 
 class StatsProcessPlotter(object):
     def __init__(self, **kwargs):
-        pass
+        self.last_generation = 0
     
     def terminate(self):
         plt.close('all')
@@ -90,26 +103,26 @@ class StatsProcessPlotter(object):
         Called regularly within self.__call__(conn)
         """
         while self.pipe_conn.poll():
-            command = self.pipe_conn.recv()
-            if command is None:
+            if self.pipe_conn.recv() is None:
                 self.terminate()
                 return False
-            else:
-                self.ax.clear()
-                [particles] = command
-                weights = np.asarray([p.w for p in particles])
-                n, bins, patches = self.ax.hist(weights, 50, facecolor='g', alpha=0.75)
-                self.ax.set_xlabel('Weights')
-                self.ax.set_ylabel('Amount of Particles')
-                self.ax.set_title('Particle Distribution in Weights')
-                self.ax.grid(True)
-                self.fig.canvas.draw()
+        frame = self.frames.read(self.last_generation)
+        if frame is not None:
+            self.last_generation, _, (weights,) = frame
+            self.ax.clear()
+            n, bins, patches = self.ax.hist(weights, 50, facecolor='g', alpha=0.75)
+            self.ax.set_xlabel('Weights')
+            self.ax.set_ylabel('Amount of Particles')
+            self.ax.set_title('Particle Distribution in Weights')
+            self.ax.grid(True)
+            self.fig.canvas.draw()
 
         return True
     
-    def __call__(self, pipe_conn):
+    def __call__(self, pipe_conn, frames):
         print('starting stats plotter...')
         self.pipe_conn = pipe_conn
+        self.frames = frames
         self.fig, self.ax = plt.subplots(1, 1)
         timer = self.fig.canvas.new_timer(interval=1000)
         timer.add_callback(self.particle_stats_plot_call_back)
@@ -119,35 +132,83 @@ class StatsProcessPlotter(object):
         plt.show()
 
 
+def thin_out(values, capacity):
+    """ Every k-th value so that at most capacity values are left.
+    """
+    return values[::-(-len(values) // capacity)] if len(values) > capacity else values
+
+
 class NBWorldPlot(object):
-    def __init__(self, **kwargs):
+    """
+    Non-blocking world plot: plot() publishes the particles, the robot, the
+    mean point and the selected anchors to the plotter process through a
+    SharedFrameBuffer, the pipe only carries the finish command.
+    """
+    def __init__(self, capacity=FRAME_CAPACITY, **kwargs):
         self.world_plot_pipe_parent_conn, world_plotter_pipe_child_conn = mp.Pipe()
+        self.world = kwargs.get('world', None)
+        self.counters = mp.Array('q', 2, lock=False)    # written by the plotter only
+        # meta: robot xyz, mean xyz + confidence, one selected flag per anchor
+        self.frames = SharedFrameBuffer(capacity, columns=4, meta_size=7 + len(self.world.beacons))
         
         self.world_plotter = WorldProcessPlotter(**kwargs)
         self.world_plot_process = mp.Process(
-            target=self.world_plotter, args=(world_plotter_pipe_child_conn,), daemon=True)
+            target=self.world_plotter, args=(world_plotter_pipe_child_conn, self.frames, self.counters), daemon=True)
         self.world_plot_process.start()
 
     def plot(self, data, finished=False):
         if finished:
             self.world_plot_pipe_parent_conn.send(None)
-        else:
-            self.world_plot_pipe_parent_conn.send(data)
+            return
+        [selected_anc, robbie, particles, (m_x, m_y, m_z, confidence_indicator)] = data
+        selected = [anc[0] in selected_anc for anc in self.world.beacons]
+        self.frames.write([thin_out(a, self.frames.capacity) for a in (particles.x, particles.y, particles.z, particles.w)],
+                          meta=[robbie.x, robbie.y, robbie.z, m_x, m_y, m_z, confidence_indicator] + selected)
+
+    def frame_stats(self):
+        """
+        Number of frames the plotter drew and dropped (skipped for a newer one).
+        """
+        return {"published": self.frames.generation, "drawn": self.counters[0], "dropped": self.counters[1]}
+
+    def close(self):
+        try:
+            self.plot(None, finished=True)
+        except BrokenPipeError:     # the plot window was already closed
+            pass
+        self.world_plot_process.join(timeout=1.0)
+        self.frames.close()
+        self.frames.unlink()
 
 class NBStatsPlot(object):
-    def __init__(self, **kwargs):
+    """
+    Non-blocking histogram of the particle weights, published through a
+    SharedFrameBuffer like NBWorldPlot.
+    """
+    def __init__(self, capacity=FRAME_CAPACITY, **kwargs):
         self.stats_plot_pipe_parent_conn, stats_plotter_pipe_child_conn = mp.Pipe()
+        self.frames = SharedFrameBuffer(capacity, columns=1)
         
         self.stats_plotter = StatsProcessPlotter(**kwargs)
         self.stats_plot_process = mp.Process(
-            target=self.stats_plotter, args=(stats_plotter_pipe_child_conn,), daemon=True)
+            target=self.stats_plotter, args=(stats_plotter_pipe_child_conn, self.frames), daemon=True)
         self.stats_plot_process.start()
 
     def plot(self, data, finished=False):
         if finished:
             self.stats_plot_pipe_parent_conn.send(None)
-        else:
-            self.stats_plot_pipe_parent_conn.send(data)
+            return
+        [weights] = data
+        self.frames.write([thin_out(np.asarray(weights), self.frames.capacity)])
+
+    def close(self):
+        try:
+            self.plot(None, finished=True)
+        except BrokenPipeError:     # the plot window was already closed
+            pass
+        self.stats_plot_process.join(timeout=1.0)
+        self.frames.close()
+        self.frames.unlink()
 
 
 def main():
@@ -0,0 +1,169 @@
+# ------------------------------------------------------------------------
+# coding=utf-8
+# ------------------------------------------------------------------------
+#
+#  Resampling strategies for the UWB particle filter
+# ------------------------------------------------------------------------
+
+from statistics import NormalDist
+
+import numpy as np
+
+# Every resampler takes the (not necessarily normalized) particle weights and
+# returns an index array into the particle arrays, e.g. particles.take(idx).
+# None is returned when all particles are improbable (all weights are 0), the
+# caller then has to regenerate the particles. Random draws come from the
+# numpy.random.Generator passed as rng (a fresh unseeded one if None).
+
+
+def _cumulative(weights):
+    weights = np.asarray(weights, dtype=float)
+    cumsum = np.cumsum(weights)
+    if len(cumsum) == 0 or cumsum[-1] <= 0:
+        return None
+    return cumsum / cumsum[-1]
+
+
+def _search(cumsum, positions):
+    idx = np.searchsorted(cumsum, positions, side='right')
+    return np.minimum(idx, len(cumsum) - 1)
+
+
+def multinomial_resample(weights, count=None, rng=None):
+    """
+    Draw count independent indices proportionally to the weights. O(N log N).
+    """
+    cumsum = _cumulative(weights)
+    if cumsum is None:
+        return None
+    count = len(cumsum) if count is None else count
+    rng = rng if rng is not None else np.random.default_rng()
+    return _search(cumsum, rng.uniform(0, 1, size=count))
+
+
+def systematic_resample(weights, count=None, rng=None):
+    """
+    One random offset, then count evenly spaced positions. O(N) and
+    the lowest variance of the strategies here.
+    """
+    cumsum = _cumulative(weights)
+    if cumsum is None:
+        return None
+    count = len(cumsum) if count is None else count
+    rng = rng if rng is not None else np.random.default_rng()
+    positions = (rng.uniform(0, 1) + np.arange(count)) / count
+    return _search(cumsum, positions)
+
+
+def stratified_resample(weights, count=None, rng=None):
+    """
+    One random position inside each of the count equal strata. O(N).
+    """
+    cumsum = _cumulative(weights)
+    if cumsum is None:
+        return None
+    count = len(cumsum) if count is None else count
+    rng = rng if rng is not None else np.random.default_rng()
+    positions = (rng.uniform(0, 1, size=count) + np.arange(count)) / count
+    return _search(cumsum, positions)
+
+
+def residual_resample(weights, count=None, rng=None):
+    """
+    Deterministically keep floor(count * w) copies of every particle and
+    draw the remaining ones multinomially from the residual weights.
+    """
+    weights = np.asarray(weights, dtype=float)
+    total = weights.sum()
+    if len(weights) == 0 or total <= 0:
+        return None
+    count = len(weights) if count is None else count
+    scaled = weights * (count / total)
+    copies = np.floor(scaled).astype(int)
+    idx = np.repeat(np.arange(len(weights)), copies)
+    remaining = count - len(idx)
+    if remaining > 0:
+        idx = np.concatenate((idx, multinomial_resample(scaled - copies, remaining, rng=rng)))
+    return idx
+
+
+RESAMPLERS = {
+    "multinomial": multinomial_resample,
+    "systematic": systematic_resample,
+    "stratified": stratified_resample,
+    "residual": residual_resample,
+}
+
+
+def get_resampler(name):
+    try:
+        return RESAMPLERS[name]
+    except KeyError:
+        raise ValueError("Unknown resampling method '{}', choose from: {}"
+                         .format(name, ", ".join(sorted(RESAMPLERS))))
+
+
+def kld_sample_size(k, epsilon=0.05, delta=0.01):
+    """
+    Number of particles needed so that, with probability 1 - delta, the
+    KL-divergence between the sample-based and the true posterior stays
+    below epsilon, given that the posterior occupies k histogram bins
+    (Fox, "KLD-Sampling: Adaptive Particle Filters"). Works on arrays of k.
+    """
+    k = np.maximum(np.asarray(k, dtype=float), 2)
+    z = NormalDist().inv_cdf(1 - delta)
+    a = 2 / (9 * (k - 1))
+    return (k - 1) / (2 * epsilon) * (1 - a + np.sqrt(a) * z) ** 3
+
+
+def kld_resample(weights, xyz, bin_size, epsilon=0.05, delta=0.01, min_count=300, max_count=10000, rng=None):
+    """
+    KLD-adaptive resampling: keep drawing particles until their number
+    exceeds the KLD bound for the number of (bin_size-wide) xyz bins the
+    drawn particles occupy, within [min_count, max_count]. A spread-out
+    belief keeps the count high, a converged one shrinks it.
+    Returns an index array of the adaptive length (None if all w=0).
+    """
+    rng = rng if rng is not None else np.random.default_rng()
+    candidates = systematic_resample(weights, max_count, rng=rng)
+    if candidates is None:
+        return None
+    # Systematic positions come out sorted, shuffle them so that every prefix
+    # is an unbiased sample of the posterior
+    candidates = rng.permutation(candidates)
+    bins = np.floor(np.asarray(xyz, dtype=float)[candidates] / bin_size).astype(np.int64)
+    bins -= bins.min(axis=0)
+    flat_bins = np.ravel_multi_index(bins.T, bins.max(axis=0) + 1)
+    _, first_seen = np.unique(flat_bins, return_index=True)
+    is_new_bin = np.zeros(max_count, dtype=bool)
+    is_new_bin[first_seen] = True
+    occupied = np.cumsum(is_new_bin)
+    drawn = np.arange(1, max_count + 1)
+    enough = np.nonzero((drawn >= kld_sample_size(occupied, epsilon, delta)) & (drawn >= min_count))[0]
+    count = enough[0] + 1 if len(enough) else max_count
+    return candidates[:count]
+
+
+def effective_sample_size(weights):
+    """
+    ESS = 1 / sum(w^2) of the normalized weights, between 1 (one particle
+    carries all the weight) and N (uniform weights).
+    """
+    weights = np.asarray(weights, dtype=float)
+    total = weights.sum()
+    if total <= 0:
+        return 0.0
+    weights = weights / total
+    return float(1.0 / np.dot(weights, weights))
+
+
+def weight_entropy(weights):
+    """
+    Shannon entropy (nats) of the normalized weights, log(N) when uniform.
+    """
+    weights = np.asarray(weights, dtype=float)
+    total = weights.sum()
+    if total <= 0:
+        return 0.0
+    weights = weights[weights > 0] / total
+    return float(-np.dot(weights, np.log(weights)))
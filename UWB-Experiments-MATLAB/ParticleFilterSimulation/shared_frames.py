@@ -0,0 +1,100 @@
+# ------------------------------------------------------------------------
+# coding=utf-8
+# ------------------------------------------------------------------------
+#
+#  Double-buffered numpy frames in shared memory, to hand the particle
+#  cloud to the plotter processes without pickling it
+# ------------------------------------------------------------------------
+
+from multiprocessing import shared_memory
+
+import numpy as np
+
+HEADER_SIZE = 4     # generation, active slot, generation of slot 0, generation of slot 1
+WRITING = -1        # slot generation while the slot is being written
+
+
+class SharedFrameBuffer(object):
+    """
+    Two slots of `columns` float64 arrays of up to `capacity` entries plus
+    meta_size float64 meta values, in one multiprocessing.shared_memory block.
+    The (single) writer fills the inactive slot and then flips the active
+    slot, the reader copies the latest slot and uses the slot generation as
+    a sequence lock to discard a slot that was overwritten while copying.
+
+    Pickling only passes the name of the block, so the buffer can be handed
+    to a multiprocessing.Process and is attached there.
+    """
+    def __init__(self, capacity, columns, meta_size=0, name=None):
+        self.capacity = capacity
+        self.columns = columns
+        self.meta_size = meta_size
+        self.slot_size = 1 + meta_size + columns * capacity     # count, meta, column data
+        if name is None:
+            size = 8 * (HEADER_SIZE + 2 * self.slot_size)
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.header = np.ndarray((HEADER_SIZE,), dtype=np.int64, buffer=self.shm.buf)
+        self.slots = np.ndarray((2, self.slot_size), dtype=np.float64, buffer=self.shm.buf, offset=8 * HEADER_SIZE)
+        if name is None:
+            self.header[:] = 0
+
+    def __getstate__(self):
+        return self.capacity, self.columns, self.meta_size, self.shm.name
+
+    def __setstate__(self, state):
+        capacity, columns, meta_size, name = state
+        self.__init__(capacity, columns, meta_size, name=name)
+
+    @property
+    def generation(self):
+        return int(self.header[0])
+
+    def write(self, columns, meta=()):
+        """
+        Publish a new frame: columns is a sequence of equally long arrays (at
+        most capacity entries), meta a sequence of meta_size values.
+        Returns the generation of the frame.
+        """
+        slot = 1 - int(self.header[1])
+        count = min(len(columns[0]), self.capacity) if len(columns) else 0
+        self.header[2 + slot] = WRITING
+        data = self.slots[slot]
+        data[0] = count
+        data[1:1 + self.meta_size] = meta
+        frame = data[1 + self.meta_size:].reshape(self.columns, self.capacity)
+        for i, column in enumerate(columns):
+            frame[i, :count] = column[:count]
+        generation = self.generation + 1
+        self.header[2 + slot] = generation
+        self.header[1] = slot
+        self.header[0] = generation
+        return generation
+
+    def read(self, last_generation=0):
+        """
+        Copy of the latest frame as (generation, meta, columns x count array),
+        or None if there is no frame newer than last_generation or it was
+        overwritten while copying (the next call gets the newer one).
+        """
+        if self.generation == last_generation:
+            return None
+        slot = int(self.header[1])
+        generation = int(self.header[2 + slot])
+        if generation in (WRITING, last_generation):
+            return None
+        data = self.slots[slot]
+        count = int(data[0])
+        meta = data[1:1 + self.meta_size].copy()
+        frame = data[1 + self.meta_size:].reshape(self.columns, self.capacity)[:, :count].copy()
+        if int(self.header[2 + slot]) != generation:
+            return None
+        return generation, meta, frame
+
+    def close(self):
+        self.header = self.slots = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
@@ -0,0 +1,161 @@
+# ------------------------------------------------------------------------
+# coding=utf-8
+# ------------------------------------------------------------------------
+#
+#  Per-step telemetry of the particle filter loop and its sinks
+# ------------------------------------------------------------------------
+
+import collections
+import json
+import time
+
+import numpy as np
+
+
+def particle_stats(particles):
+    """
+    Weight and spatial extent statistics of a ParticleSet, from one min and
+    one max pass over the stacked x/y/z/w arrays.
+    """
+    if not len(particles):
+        return {"weight_min": 0.0, "weight_max": 0.0, "weight_sum": 0.0, "extent_min": None, "extent_max": None}
+    data = np.vstack((particles.x, particles.y, particles.z, particles.w))
+    low, high = data.min(axis=1).tolist(), data.max(axis=1).tolist()
+    return {
+        "weight_min": low[3],
+        "weight_max": high[3],
+        "weight_sum": float(data[3].sum()),
+        "extent_min": low[:3],
+        "extent_max": high[:3],
+    }
+
+
+class Telemetry(object):
+    """
+    Collects one record per filter step and hands it to the sinks, callables
+    taking the record dict. Usage per step:
+
+        telemetry.begin_step()
+        ...; telemetry.lap("weight")        # time since the previous lap
+        telemetry.update(stats)             # e.g. as ParticleFilter stats_callback
+        telemetry.end_step(mean=...)        # emit to all sinks
+
+    Without sinks every call returns immediately, nothing is computed.
+    """
+    def __init__(self, sinks=()):
+        self.sinks = list(sinks)
+        self.record = None
+        self._lap_start = 0.0
+
+    @property
+    def enabled(self):
+        return bool(self.sinks)
+
+    def add_sink(self, sink):
+        self.sinks.append(sink)
+
+    def begin_step(self):
+        if not self.sinks:
+            return
+        self.record = {"time": time.time(), "stage_ms": {}}
+        self._lap_start = time.perf_counter()
+
+    def lap(self, stage):
+        if self.record is None:
+            return
+        now = time.perf_counter()
+        self.record["stage_ms"][stage] = self.record["stage_ms"].get(stage, 0.0) + 1000 * (now - self._lap_start)
+        self._lap_start = now
+
+    def update(self, stats):
+        if self.record is None:
+            return
+        self.record.update(stats)
+
+    def update_particles(self, particles):
+        if self.record is None:
+            return
+        self.record.update(particle_stats(particles))
+
+    def end_step(self, **stats):
+        if self.record is None:
+            return
+        record, self.record = self.record, None
+        record.update(stats)
+        for sink in self.sinks:
+            sink(record)
+
+
+# ------------------------------------------------------------------------
+# Sinks
+
+class RingBufferSink(object):
+    """ Keeps the last maxlen records in memory, e.g. for a live plot or a post-mortem.
+    """
+    def __init__(self, maxlen=1000):
+        self.records = collections.deque(maxlen=maxlen)
+
+    def __call__(self, record):
+        self.records.append(record)
+
+
+def _to_json(value):
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    return str(value)
+
+
+class JsonlSink(object):
+    """ Appends every record as one JSON line to path, flushed every flush_every records.
+    """
+    def __init__(self, path, flush_every=10):
+        self.file = open(path, "a")
+        self.flush_every = flush_every
+        self.count = 0
+
+    def __call__(self, record):
+        self.file.write(json.dumps(record, default=_to_json) + "\n")
+        self.count += 1
+        if self.count % self.flush_every == 0:
+            self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def format_record(record):
+    lines = ["step {}: particle count: {}, ESS fraction: {:.2f}, weight entropy: {:.3f}, weight sum: {:.4g}, "
+             "resampled: {} (total {}), picked particle: {}, generated particle: {}"
+             .format(record.get("step"), record.get("particle_count"), record.get("ess_fraction", 0.0),
+                     record.get("weight_entropy") or 0.0, record.get("weight_sum", 0.0), record.get("resampled"),
+                     record.get("resample_count"), record.get("picked"), record.get("generated"))]
+    if record.get("extent_min") is not None:
+        lines.append("particle x range: [{:.2f}-{:.2f}] y range: [{:.2f}-{:.2f}] z range: [{:.2f}-{:.2f}]"
+                     .format(*[v for pair in zip(record["extent_min"], record["extent_max"]) for v in pair]))
+    for key in ("mean", "uwb"):
+        if record.get(key) is not None:
+            lines.append("{} x: {:.2f} y: {:.2f} z: {:.2f}".format(key, *record[key]))
+    if record.get("stage_ms"):
+        lines.append("stage ms: " + ", ".join("{} {:.2f}".format(k, v) for k, v in record["stage_ms"].items()))
+    if record.get("frames"):
+        lines.append("frames received: {received}, queued: {queued} (max {max_queued}), dropped: {dropped}, "
+                     "duplicate: {duplicates}, missed: {missed}, stale: {stale}, restarts: {restarts}, "
+                     "decode errors: {decode_errors}, "
+                     "decode ms: {decode_ms_mean:.3f} (max {decode_ms_max:.3f})".format(**record["frames"]))
+    return "\n".join(lines)
+
+
+class StdoutSink(object):
+    """ Prints at most one record every interval seconds, the others are skipped.
+    """
+    def __init__(self, interval=1.0, formatter=format_record):
+        self.interval = interval
+        self.formatter = formatter
+        self._last = -float("inf")
+
+    def __call__(self, record):
+        now = time.monotonic()
+        if now - self._last < self.interval:
+            return
+        self._last = now
+        print(self.formatter(record))
@@ -16,15 +16,38 @@ import json, threading
 
 
 from utils import *
+from location_codec import encode_frame, encode_batch, MAX_BATCH_FRAMES
 # Constants for the MQTT
 MQTT_BROKER = "localhost"
 MQTT_PORT = 1883
+PAYLOAD_FORMAT = "json"     # "json", or "binary" for the compact location_codec payload
+# Batching: up to BATCH_FRAMES frames, or the frames of BATCH_INTERVAL_MS,
+# go out as one message on the LocationBatch topic, 0 for no batching.
+# More than MAX_BATCH_FRAMES (255) frames go out as several messages
+BATCH_FRAMES = 0
+BATCH_INTERVAL_MS = 500
 
 
 def mqtt_on_publish(client, data, result):
     # TODO: Define actions to take if mqtt_on_publish is needed
     pass
     
+def encode_location(frame):
+    return encode_frame(frame) if PAYLOAD_FORMAT == "binary" else json.dumps(frame)
+
+
+def publish_batch(client, tag_id, frames):
+    """ Publish the batched frames as one message, or as several of at most
+        MAX_BATCH_FRAMES frames, and the latest of them retained on the
+        location topic for late subscribers.
+    """
+    for start in range(0, len(frames), MAX_BATCH_FRAMES):
+        client.publish("Tag/{}/Uplink/LocationBatch".format(tag_id[-4:]),
+                       encode_batch(frames[start:start + MAX_BATCH_FRAMES], binary=PAYLOAD_FORMAT == "binary"),
+                       qos=0)
+    client.publish("Tag/{}/Uplink/Location".format(tag_id[-4:]), encode_location(frames[-1]), qos=0, retain=True)
+
+
 def report_uart_data(serial_port, uwb_pointer, proximity_pointer):
     # uwb_pointer[0] is the pointer used to pass the coordinates and other UWB readings to other threads
     # proximity_pointer[0] passes the proximity sensor data acquired in a separate thread
@@ -46,25 +69,46 @@ def report_uart_data(serial_port, uwb_pointer, proximity_pointer):
     serial_port.reset_input_buffer()
 
     super_frame = 0
-    while True:
-        try:
-            data = str(serial_port.readline(), encoding="UTF-8").rstrip()
-            if not data[:4] == "DIST":
-                continue            
-            json_dic = make_json_dic(data)
-            json_dic['tag_id'] = tag_id
-            json_dic['superFrameNumber'] = super_frame
-            # pass in the proximity reading using proximity_pointer[0] pointer from proximity thread
-            json_dic['proximity'] = proximity_pointer[0] if proximity_pointer[0] is not None else "OutOfRange"
-            json_data = json.dumps(json_dic)
-            tag_client.publish("Tag/{}/Uplink/Location".format(tag_id[-4:]), json_data, qos=0, retain=True)
-            super_frame += 1
-            # pass out coordinates using uwb_pointer[0] pointer for other threads
-            uwb_pointer[0] = json_dic
-        except Exception as exp:
-            data = str(serial_port.readline(), encoding="UTF-8").rstrip()
-            sys.stdout.write(timestamp_log() + data)
-            raise exp
+    batch, batch_start = [], None
+    try:
+        while True:
+            try:
+                data = str(serial_port.readline(), encoding="UTF-8").rstrip()
+                # checked on every line (and readline timeout) so a batch never waits for the next frame
+                if batch and time.monotonic() - batch_start >= BATCH_INTERVAL_MS / 1000:
+                    publish_batch(tag_client, tag_id, batch)
+                    batch = []
+                if not data[:4] == "DIST":
+                    continue            
+                json_dic = make_json_dic(data)
+                json_dic['tag_id'] = tag_id
+                json_dic['superFrameNumber'] = super_frame
+                # pass in the proximity reading using proximity_pointer[0] pointer from proximity thread
+                json_dic['proximity'] = proximity_pointer[0] if proximity_pointer[0] is not None else "OutOfRange"
+                if BATCH_FRAMES:
+                    if not batch:
+                        batch_start = time.monotonic()
+                    batch.append(json_dic)
+                    if len(batch) >= BATCH_FRAMES:
+                        publish_batch(tag_client, tag_id, batch)
+                        batch = []
+                else:
+                    tag_client.publish("Tag/{}/Uplink/Location".format(tag_id[-4:]), encode_location(json_dic),
+                                       qos=0, retain=True)
+                super_frame += 1
+                # pass out coordinates using uwb_pointer[0] pointer for other threads
+                uwb_pointer[0] = json_dic
+            except Exception as exp:
+                data = str(serial_port.readline(), encoding="UTF-8").rstrip()
+                sys.stdout.write(timestamp_log() + data)
+                raise exp
+    finally:
+        # the frames of an unfinished batch still go out when reporting stops
+        if batch:
+            try:
+                publish_batch(tag_client, tag_id, batch)
+            except Exception as exp:
+                sys.stdout.write(timestamp_log() + "Last batch of {} frames lost: {}\n".format(len(batch), exp))
     
     
 # thread used for proximity sensor controlling and data reading
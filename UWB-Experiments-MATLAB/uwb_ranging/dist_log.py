@@ -0,0 +1,306 @@
+import sys, os, time, mmap
+from multiprocessing import Pool
+
+import numpy as np
+
+from dist_parser import parse_dist_line, _ACCEL_EN_TABLE
+
+CHUNK_SIZE = 1024 * 1024     # bytes of a capture file parsed at once, keeps the column blocks small
+
+
+def dist_dtype(max_anchors):
+    """ Row type of a parsed capture: one row per DIST frame, the per-anchor
+        columns padded to max_anchors and masked by valid. Units as reported
+        (m by the OEM firmware, mm by the accelerometer-enabled firmware).
+    """
+    return np.dtype([
+        ("file", np.int16),                         # index of the capture file
+        ("line", np.int64),                         # line number in the capture file
+        ("uwb_time", np.int64),                     # UWBLOCALTIME (us), -1 if not reported
+        ("anc_num", np.int16),
+        ("anc_id", "U4", (max_anchors,)),
+        ("anc_x", np.float64, (max_anchors,)),
+        ("anc_y", np.float64, (max_anchors,)),
+        ("anc_z", np.float64, (max_anchors,)),
+        ("dist_to", np.float64, (max_anchors,)),
+        ("anc_qf", np.int16, (max_anchors,)),       # -1 if not reported
+        ("valid", np.bool_, (max_anchors,)),
+        ("has_pos", np.bool_),
+        ("pos", np.float64, (3,)),
+        ("pos_qf", np.int16),
+        ("has_acc", np.bool_),
+        ("acc", np.int32, (3,)),
+    ])
+
+
+def _empty_rows(count, max_anchors):
+    rows = np.zeros(count, dtype=dist_dtype(max_anchors))
+    rows["uwb_time"] = -1
+    rows["anc_qf"] = -1
+    rows["pos_qf"] = -1
+    return rows
+
+
+def _layout(tokens, accel_en):
+    """ Token positions of a well-formed line: (anchor count, group width,
+        [(token position, expected label)], {field: first value position}),
+        or None if the line is not well formed.
+    """
+    try:
+        k = int(tokens[1])
+    except ValueError:
+        return None
+    width = 7 if accel_en else 6
+    end = 2 + width * k
+    labels = [(2 + width * i, b'AN%d' % i) for i in range(k)]
+    fields = {}
+    i, n = end, len(tokens)
+    while i < n:
+        label = tokens[i]
+        if label == b'POS':
+            fields["pos"] = i + 1
+            labels.append((i, label))
+            i += 5
+        elif label == b'ACC' and accel_en:
+            fields["acc"] = i + 1
+            labels.append((i, label))
+            i += 4
+        elif label == b'UWBLOCALTIME' and accel_en:
+            fields["uwb_time"] = i + 1
+            labels.append((i, label))
+            i += 2
+        elif label == b'' and i == n - 1:
+            break
+        else:
+            return None
+    if i > n:
+        return None
+    return k, width, labels, fields
+
+
+def _to_numbers(chars):
+    """ Decimal integer/fixed-point tokens to float64, digit column by digit
+        column: chars is a uint8 array (..., width) of the token characters,
+        0 padded.
+
+        :returns:
+            numpy array of chars.shape[:-1], or None if a token is not a plain decimal number
+    """
+    digits = (chars >= ord('0')) & (chars <= ord('9'))
+    point = chars == ord('.')
+    minus = chars[..., 0] == ord('-')
+    if not (digits | point | (chars == 0))[..., 1:].all() or not (digits[..., 0] | minus).all() or \
+            (point.sum(axis=-1) > 1).any():
+        return None
+    value = np.zeros(chars.shape[:-1])
+    scale = np.ones(chars.shape[:-1])
+    after_point = np.zeros(chars.shape[:-1], dtype=bool)
+    for j in range(chars.shape[-1]):
+        value = np.where(digits[..., j], value * 10 + (chars[..., j] - ord('0')), value)
+        scale[digits[..., j] & after_point] *= 10
+        after_point |= point[..., j]
+    value[minus] *= -1
+    return value / scale
+
+
+def _parse_group(lines, accel_en, rows):
+    """ Parse lines of one token count into rows, straight from the joined
+        bytes: the token offsets are found once, then every column is
+        gathered as a fixed-width character block over all lines. Returns
+        False (and leaves rows alone) if any line does not fit the layout.
+    """
+    layout = _layout(lines[0].split(b','), accel_en)
+    if layout is None:
+        return False
+    k, width, labels, fields = layout
+    n, count = len(lines), lines[0].count(b',') + 1
+    text = b','.join(lines) + b','
+    ends = np.flatnonzero(np.frombuffer(text, dtype=np.uint8) == ord(',')).astype(np.int32)
+    if len(ends) != n * count:
+        return False
+    starts = np.concatenate(([0], ends[:-1] + 1)).astype(np.int32).reshape(n, count)
+    lengths = ends.reshape(n, count) - starts
+    # padded, so the fixed-width blocks of the last tokens stay inside
+    buffer = np.frombuffer(text + bytes(int(lengths.max())), dtype=np.uint8)
+
+    def gather(positions, size):
+        # (n, len(positions), size) characters of the tokens, 0 padded
+        offsets = np.arange(size, dtype=np.int32)
+        chars = buffer[starts[:, positions, np.newaxis] + offsets]
+        chars[offsets >= lengths[:, positions, np.newaxis]] = 0
+        return chars
+
+    for position, label in labels:
+        if (lengths[:, position] != len(label)).any() or \
+                (gather([position], len(label))[:, 0] != np.frombuffer(label, dtype=np.uint8)).any():
+            return False
+    id_positions = [3 + width * i for i in range(k)]
+    if k and (lengths[:, id_positions] > 4).any():
+        return False
+    text_positions = set(id_positions) | {position for position, _ in labels} | ({count - 1} if accel_en else set())
+    numeric = [position for position in range(1, count) if position not in text_positions]
+    values = _to_numbers(gather(numeric, max(lengths[:, numeric].max(), 1)))
+    if values is None:
+        return False
+    column = dict(zip(numeric, range(len(numeric))))
+    rows["anc_num"] = k
+    if k:
+        rows["anc_id"][:, :k] = gather(id_positions, 4).view("S4")[..., 0].astype("U4")
+    for i in range(k):
+        first = column[4 + width * i]
+        rows["anc_x"][:, i], rows["anc_y"][:, i], rows["anc_z"][:, i], rows["dist_to"][:, i] = \
+            values[:, first], values[:, first + 1], values[:, first + 2], values[:, first + 3]
+        if accel_en:
+            rows["anc_qf"][:, i] = values[:, first + 4]
+    rows["valid"][:, :k] = True
+    if "pos" in fields:
+        first = column[fields["pos"]]
+        rows["has_pos"] = True
+        rows["pos"] = values[:, first:first + 3]
+        rows["pos_qf"] = values[:, first + 3]
+    if "acc" in fields:
+        first = column[fields["acc"]]
+        rows["has_acc"] = True
+        rows["acc"] = values[:, first:first + 3]
+    if "uwb_time" in fields:
+        rows["uwb_time"] = values[:, column[fields["uwb_time"]]]
+    return True
+
+
+def _fill_row(row, record):
+    k = len(record.anc_ids)
+    row["anc_num"] = k
+    row["anc_id"][:k] = record.anc_ids
+    row["anc_x"][:k], row["anc_y"][:k], row["anc_z"][:k] = record.anc_x, record.anc_y, record.anc_z
+    row["dist_to"][:k] = record.dist_to
+    if record.anc_qf is not None:
+        row["anc_qf"][:k] = record.anc_qf
+    row["valid"][:k] = True
+    if record.pos is not None:
+        row["has_pos"], row["pos"], row["pos_qf"] = True, record.pos, record.pos_qf
+    if record.acc is not None:
+        row["has_acc"], row["acc"] = True, record.acc
+    if record.uwb_time is not None:
+        row["uwb_time"] = record.uwb_time
+
+
+def parse_dist_chunk(data, first_line=0):
+    """ Parse the DIST lines of a chunk of capture bytes (whole lines) into a
+        structured array of dist_dtype. Lines of the same token count are
+        converted together, convoluted lines go through parse_dist_line one
+        at a time.
+
+        :returns:
+            structured array, padded to the largest anchor count of the chunk
+    """
+    # [AN0,C584,...]=[1176,100];POS=[...]; -> AN0,C584,...,1176,100,POS,...,
+    # on the whole chunk at once, the OEM lines have none of these characters
+    lines = data.translate(_ACCEL_EN_TABLE, b'[]\r').split(b'\n')
+    numbers = [number for number, line in enumerate(lines) if b'DIST' in line]
+    # DIST not at the start of the line, e.g. behind a log timestamp
+    dist_lines = [line if line[:4] == b'DIST' else line[line.find(b'DIST'):].rstrip()
+                  for line in (lines[number] for number in numbers)]
+    token_counts = np.array([line.count(b',') for line in dist_lines], dtype=int)
+    parsed, fallback = [], []
+    for token_count in np.unique(token_counts):
+        indices = np.flatnonzero(token_counts == token_count)
+        group = [dist_lines[index] for index in indices]
+        # the accelerometer-enabled firmware ends its lines with ';', now ','
+        accel_en = group[0][-1:] == b','
+        k = int(group[0].split(b',', 2)[1]) if group[0][5:6].isdigit() else 0
+        rows = _empty_rows(len(group), max(k, 1))
+        if _parse_group(group, accel_en, rows):
+            parsed.append((indices, rows))
+        else:
+            fallback.extend(indices)
+    records = {}
+    if fallback:
+        raw_lines = data.split(b'\n')
+        for index in fallback:
+            line = raw_lines[numbers[index]]
+            record = parse_dist_line(line[line.find(b'DIST'):])
+            if record is not None and record.anc_ids:
+                records[index] = record
+    max_anchors = max([rows["anc_id"].shape[1] for _, rows in parsed] +
+                      [len(record.anc_ids) for record in records.values()] + [1])
+    out = _empty_rows(len(numbers), max_anchors)
+    for indices, rows in parsed:
+        out[indices] = pad_anchors(rows, max_anchors)
+    for index, record in records.items():
+        _fill_row(out[index], record)
+    out["line"] = np.array(numbers, dtype=np.int64) + first_line
+    keep = np.ones(len(out), dtype=bool)
+    keep[[index for index in fallback if index not in records]] = False
+    return out[keep]
+
+
+def pad_anchors(rows, max_anchors):
+    """ rows with the per-anchor columns padded (invalid) to max_anchors.
+    """
+    if rows.dtype["anc_id"].shape[0] == max_anchors:
+        return rows
+    out = _empty_rows(len(rows), max_anchors)
+    k = rows.dtype["anc_id"].shape[0]
+    for name in rows.dtype.names:
+        if rows.dtype[name].shape and name not in ("pos", "acc"):
+            out[name][:, :k] = rows[name]
+        else:
+            out[name] = rows[name]
+    return out
+
+
+def load_dist_log(path, file_index=0, chunk_size=CHUNK_SIZE):
+    """ Parse a whole UART capture file, memory-mapped and in chunks of whole lines.
+
+        :returns:
+            structured array of dist_dtype, one row per DIST frame
+    """
+    parts, first_line = [], 0
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return _empty_rows(0, 1)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            start = 0
+            while start < len(data):
+                end = data.rfind(b'\n', start, start + chunk_size) + 1 if start + chunk_size < len(data) else len(data)
+                if end <= start:
+                    # a single line longer than the chunk
+                    end = data.find(b'\n', start + chunk_size) + 1 or len(data)
+                chunk = data[start:end]
+                parts.append(parse_dist_chunk(chunk, first_line))
+                first_line += chunk.count(b'\n')
+                start = end
+    max_anchors = max(part.dtype["anc_id"].shape[0] for part in parts)
+    rows = np.concatenate([pad_anchors(part, max_anchors) for part in parts])
+    rows["file"] = file_index
+    return rows
+
+
+def _load_indexed(args):
+    return load_dist_log(*args)
+
+
+def load_dist_logs(paths, processes=None, chunk_size=CHUNK_SIZE):
+    """ Parse several capture files in parallel, one file per worker process.
+
+        :returns:
+            one structured array of dist_dtype, the rows of paths[i] with file == i, in order
+    """
+    jobs = [(path, i, chunk_size) for i, path in enumerate(paths)]
+    if processes == 1 or len(paths) < 2:
+        parts = [_load_indexed(job) for job in jobs]
+    else:
+        with Pool(processes) as pool:
+            parts = pool.map(_load_indexed, jobs)
+    max_anchors = max([part.dtype["anc_id"].shape[0] for part in parts] + [1])
+    return np.concatenate([pad_anchors(part, max_anchors) for part in parts]) if parts else _empty_rows(0, 1)
+
+
+if __name__ == "__main__":
+    # python dist_log.py capture1.txt capture2.txt ...
+    start = time.perf_counter()
+    rows = load_dist_logs(sys.argv[1:])
+    elapsed = time.perf_counter() - start
+    print("{} frames from {} files in {:.2f} s ({:.0f} frames/s), up to {} anchors, {} with POS"
+          .format(len(rows), len(sys.argv[1:]), elapsed, len(rows) / elapsed if elapsed else 0,
+                  rows.dtype["anc_id"].shape[0], int(rows["has_pos"].sum())))
@@ -0,0 +1,400 @@
+import sys, time
+from collections import namedtuple
+from itertools import repeat
+
+# One DIST reporting of a DWM1001 master, as reported by the firmware, the
+# anchors in columns (tuples in reporting order): the OEM firmware ("lec")
+# reports floats in m and no quality factors per anchor, ACC or UWBLOCALTIME,
+# the dwm-accelerometer-enabled firmware reports integers in mm.
+# pos and acc are (x, y, z) tuples, missing parts are None.
+DistRecord = namedtuple("DistRecord", ["anc_ids", "anc_x", "anc_y", "anc_z", "dist_to", "anc_qf",
+                                       "pos", "pos_qf", "acc", "uwb_time"])
+
+
+# expected anchor labels of a well-formed line with k anchors
+_ANCHOR_LABELS = [[b'AN%d' % i for i in range(k)] for k in range(16)]
+_ANCHOR_COUNTS = {b'%d' % k: k for k in range(16)}
+# [AN0,C584,160,0,-1510]=[1176,100];POS=[...] -> AN0,C584,160,0,-1510,1176,100,POS,...
+_ACCEL_EN_TABLE = bytes.maketrans(b'=;', b',,')
+# values following the label of a section
+_SECTION_SIZES = {b'POS': 4, b'ACC': 3, b'UWBLOCALTIME': 1}
+_new_record = tuple.__new__
+
+
+class _Converted(dict):
+    """ token -> converted value, every distinct token is converted once: the
+        anchor ids and positions repeat on every line, the distances and
+        quality factors come from a small set of values. Cleared when full.
+    """
+    def __init__(self, convert, max_size=1 << 16):
+        self.convert = convert
+        self.max_size = max_size
+
+    def __missing__(self, token):
+        if len(self) >= self.max_size:
+            self.clear()
+        value = self[token] = self.convert(token)
+        return value
+
+
+_ids = _Converted(bytes.decode).__getitem__
+_ints = _Converted(int).__getitem__
+_floats = _Converted(float).__getitem__
+
+
+def _fast_parse_oem(tokens):
+    # well-formed line: the announced anchor count of 6 token groups, then POS,x,y,z,qf or nothing
+    k = _ANCHOR_COUNTS[tokens[1]]
+    end = 2 + 6 * k
+    if tokens[2:end:6] != _ANCHOR_LABELS[k]:
+        raise ValueError("Convoluted anchor groups")
+    pos = pos_qf = None
+    if len(tokens) > end:
+        if len(tokens) != end + 5 or tokens[end] != b'POS':
+            raise ValueError("Convoluted position")
+        pos, pos_qf = tuple(map(_floats, tokens[end + 1:end + 4])), _ints(tokens[end + 4])
+    return _new_record(DistRecord, (tuple(map(_ids, tokens[3:end:6])), tuple(map(_floats, tokens[4:end:6])),
+                                    tuple(map(_floats, tokens[5:end:6])), tuple(map(_floats, tokens[6:end:6])),
+                                    tuple(map(_floats, tokens[7:end:6])), None, pos, pos_qf, None, None))
+
+
+def _fast_parse_accel_en(tokens):
+    # well-formed line: the announced anchor count of 7 token groups, then the labelled POS, ACC, UWBLOCALTIME
+    k = _ANCHOR_COUNTS[tokens[1]]
+    end = 2 + 7 * k
+    if tokens[2:end:7] != _ANCHOR_LABELS[k]:
+        raise ValueError("Convoluted anchor groups")
+    pos = pos_qf = acc = uwb_time = None
+    i, n = end, len(tokens)
+    while i < n:
+        label = tokens[i]
+        if label == b'POS':
+            pos, pos_qf = tuple(map(_ints, tokens[i + 1:i + 4])), _ints(tokens[i + 4])
+            i += 5
+        elif label == b'ACC':
+            acc = tuple(map(_ints, tokens[i + 1:i + 4]))
+            i += 4
+        elif label == b'UWBLOCALTIME':
+            uwb_time = int(tokens[i + 1])
+            i += 2
+        elif label == b'' and i == n - 1:
+            break
+        else:
+            raise ValueError("Convoluted section")
+    return _new_record(DistRecord, (tuple(map(_ids, tokens[3:end:7])), tuple(map(_ints, tokens[4:end:7])),
+                                    tuple(map(_ints, tokens[5:end:7])), tuple(map(_ints, tokens[6:end:7])),
+                                    tuple(map(_ints, tokens[7:end:7])), tuple(map(_ints, tokens[8:end:7])),
+                                    pos, pos_qf, acc, uwb_time))
+
+
+def _parse_oem(line):
+    # DIST,4,AN0,022E,7.94,8.03,0.00,3.44,AN1,...,POS,6.95,5.37,-1.97,52
+    tokens = line.split(b',')
+    anc_ids, anc_x, anc_y, anc_z, dist_to = [], [], [], [], []
+    pos = pos_qf = None
+    i, n = 2, len(tokens)
+    while i < n:
+        token = tokens[i]
+        if token[:2] == b'AN' and len(token) == 3 and i + 5 < n:
+            try:
+                x, y, z, dist = float(tokens[i + 2]), float(tokens[i + 3]), float(tokens[i + 4]), float(tokens[i + 5])
+            except ValueError:
+                # convoluted anchor group, resync on the next token
+                i += 1
+                continue
+            anc_ids.append(tokens[i + 1].decode())
+            anc_x.append(x)
+            anc_y.append(y)
+            anc_z.append(z)
+            dist_to.append(dist)
+            i += 6
+        elif token == b'POS' and i + 4 < n:
+            try:
+                pos, pos_qf = (float(tokens[i + 1]), float(tokens[i + 2]), float(tokens[i + 3])), int(tokens[i + 4])
+            except ValueError:
+                pos = pos_qf = None
+            i += 5
+        else:
+            i += 1
+    return DistRecord(tuple(anc_ids), tuple(anc_x), tuple(anc_y), tuple(anc_z), tuple(dist_to), None, pos, pos_qf,
+                      None, None)
+
+
+def _parse_accel_en(line):
+    # DIST,4;[AN0,C584,160,0,-1510]=[1176,100];...;POS=[502,827,803,58];ACC=[-512,768,9449];UWBLOCALTIME,38439537;
+    anc_ids, anc_x, anc_y, anc_z, dist_to, anc_qf = [], [], [], [], [], []
+    pos = pos_qf = acc = uwb_time = None
+    for section in line.split(b';')[1:]:
+        try:
+            if section[:3] == b'[AN':
+                fields = section[1:-1].replace(b']=[', b',').split(b',')
+                if len(fields) != 7:
+                    continue
+                x, y, z, dist, qf = int(fields[2]), int(fields[3]), int(fields[4]), int(fields[5]), int(fields[6])
+                anc_ids.append(fields[1].decode())
+                anc_x.append(x)
+                anc_y.append(y)
+                anc_z.append(z)
+                dist_to.append(dist)
+                anc_qf.append(qf)
+            elif section[:5] == b'POS=[':
+                x, y, z, qf = section[5:-1].split(b',')
+                pos, pos_qf = (int(x), int(y), int(z)), int(qf)
+            elif section[:5] == b'ACC=[':
+                x, y, z = section[5:-1].split(b',')
+                acc = (int(x), int(y), int(z))
+            elif section[:13] == b'UWBLOCALTIME,':
+                uwb_time = int(section[13:])
+        except ValueError:
+            # convoluted section, the other sections of the line are still good
+            continue
+    return DistRecord(tuple(anc_ids), tuple(anc_x), tuple(anc_y), tuple(anc_z), tuple(dist_to), tuple(anc_qf),
+                      pos, pos_qf, acc, uwb_time)
+
+
+def parse_dist_line(line):
+    """ Parse one DIST reporting line (bytes, as from readline()) of either firmware.
+        Convoluted anchor groups/sections are skipped, the rest of the line is kept.
+
+        :returns:
+            DistRecord, or None if the line is not a DIST reporting
+    """
+    line = line.strip()
+    if line[:4] != b'DIST':
+        return None
+    # fast path over the token slices of a well-formed line, the token by
+    # token resync of the convoluted ones otherwise
+    try:
+        if b';' in line:
+            return _fast_parse_accel_en(line.translate(_ACCEL_EN_TABLE, b'[]').split(b','))
+        return _fast_parse_oem(line.split(b','))
+    except (ValueError, IndexError, KeyError):
+        pass
+    if b';' in line:
+        return _parse_accel_en(line)
+    return _parse_oem(line)
+
+
+def _layout(tokens):
+    """ Label checks [(token index, label)] and section token indices of a
+        well-formed line (tokens of the translated line), or None.
+    """
+    k = _ANCHOR_COUNTS.get(tokens[1]) if len(tokens) > 1 else None
+    if k is None or tokens[0] != b'DIST':
+        return None
+    # the accelerometer-enabled lines end with ';', now ','
+    width = 7 if tokens[-1] == b'' else 6
+    end = 2 + width * k
+    labels = [(0, b'DIST'), (1, tokens[1])] + [(2 + width * i, label) for i, label in enumerate(_ANCHOR_LABELS[k])]
+    sections = {}
+    i, n = end, len(tokens) - (width == 7)
+    while i < n:
+        size = _SECTION_SIZES.get(tokens[i])
+        if size is None or i + size >= n or tokens[i] in sections or (width == 6 and tokens[i] != b'POS'):
+            return None
+        labels.append((i, tokens[i]))
+        sections[tokens[i]] = i
+        i += size + 1
+    if i != n:
+        return None
+    return k, width, labels, sections
+
+
+def _anchor_field(columns, convert):
+    """ Tuples of one field of the anchors line by line, from the token column of each anchor.
+    """
+    first = next(zip(*columns), ())
+    if list(map(list.count, columns, first)) == list(map(len, columns)):
+        # the anchor ids and positions of a fixed setup are the same on every line
+        return repeat(tuple(map(convert, first)))
+    return zip(*[map(convert, column) for column in columns])
+
+
+def _parse_same_lines(text, count, raw):
+    """ Records of count DIST lines, translated and joined by line ends in
+        text, converted together column by column, or None if any line is not
+        well-formed or they are not all of the same token count. raw is the
+        same lines untranslated.
+    """
+    # every raw line starts with DIST and the text has no other DIST: the DIST
+    # tokens are the line starts, all the first line's token count apart if
+    # the DIST label check below passes
+    if raw[:4] != b'DIST' or raw.count(b'\nDIST') != count - 1 or text.count(b'DIST') != count:
+        return None
+    step, rest = divmod(text.count(b',') + count, count)
+    if rest:
+        return None
+    tokens = text.replace(b'\n', b',').split(b',')
+    layout = _layout(tokens[:step])
+    if layout is None:
+        return None
+    k, width, labels, sections = layout
+    if width == 7:
+        # the accelerometer-enabled firmware format as parse_dist_line() tells it
+        if raw.count(b';\n') != count - 1 or raw[-1:] != b';':
+            return None
+    elif text != raw:
+        # no ';', '=', '[' or ']' on the OEM lines
+        return None
+    # the token column of every field, line by line
+    columns = [tokens[i::step] for i in range(step)]
+    for index, label in labels:
+        if columns[index].count(label) != count:
+            return None
+    end = 2 + width * k
+    number = _ints if width == 7 else _floats
+    try:
+        fields = [_anchor_field(columns[offset:end:width], convert)
+                  for offset, convert in ((3, _ids), (4, number), (5, number), (6, number))]
+        fields.append(zip(*[map(number, column) for column in columns[7:end:width]]) if k else repeat(()))
+        fields.append(_anchor_field(columns[8:end:width], _ints) if width == 7 else repeat(None))
+        if b'POS' in sections:
+            i = sections[b'POS']
+            fields += [zip(*[map(number, column) for column in columns[i + 1:i + 4]]), map(_ints, columns[i + 4])]
+        else:
+            fields += [repeat(None), repeat(None)]
+        i = sections.get(b'ACC')
+        fields.append(zip(*[map(_ints, column) for column in columns[i + 1:i + 4]]) if i else repeat(None))
+        i = sections.get(b'UWBLOCALTIME')
+        fields.append(map(int, columns[i + 1]) if i else repeat(None))
+        return list(map(_new_record, repeat(DistRecord, count), zip(*fields)))
+    except ValueError:
+        return None
+
+
+def parse_dist_lines(lines):
+    """ Parse a list of lines (bytes, e.g. of read() chunks split at the line ends) of either
+        firmware, as parse_dist_line() does line by line: the well-formed lines
+        of the same token count are split and converted together, the others
+        go through parse_dist_line().
+
+        :returns:
+            list of the DistRecords, in line order, the lines that are not a DIST reporting left out
+    """
+    stripped = list(map(bytes.strip, lines))
+    raw = b'\n'.join(stripped)
+    if raw.count(b'\n') != len(lines) - 1:
+        # a line with a line end in it, e.g. as given by the caller
+        return [record for record in map(parse_dist_line, lines) if record is not None]
+    text = raw.translate(_ACCEL_EN_TABLE, b'[]') if b';' in raw else raw
+    # the usual chunk of the stream: DIST lines only, all of the same token count
+    records = _parse_same_lines(text, len(lines), raw)
+    if records is not None:
+        return records
+    # else the lines of the same token count together, a line that is not a
+    # DIST reporting or not well-formed sends the lines of its count to parse_dist_line()
+    translated = text.split(b'\n')
+    counts = list(map(bytes.count, translated, repeat(b',')))
+    records = [None] * len(lines)
+    for count in set(counts):
+        indices = [i for i, line_count in enumerate(counts) if line_count == count]
+        parsed = _parse_same_lines(b'\n'.join([translated[i] for i in indices]), len(indices),
+                                   b'\n'.join([stripped[i] for i in indices]))
+        if parsed is None:
+            parsed = [parse_dist_line(stripped[i]) for i in indices]
+        for i, record in zip(indices, parsed):
+            records[i] = record
+    return [record for record in records if record is not None]
+
+
+def as_json_dict(record):
+    """ The JSON-style dictionary make_json_dict_oem() / make_json_dict_accel_en() makes from the same line.
+    """
+    data = {}
+    for i, anc_id in enumerate(record.anc_ids):
+        data[anc_id] = {'anc_id': anc_id, 'x': record.anc_x[i], 'y': record.anc_y[i], 'z': record.anc_z[i],
+                        'dist_to': record.dist_to[i]}
+        if record.anc_qf is not None:
+            data[anc_id]['anc_qf'] = record.anc_qf[i]
+    data['anc_num'] = len(record.anc_ids)
+    data['all_anc_id'] = list(record.anc_ids)
+    if record.pos is not None:
+        data['est_pos'] = {'x': record.pos[0], 'y': record.pos[1], 'z': record.pos[2]}
+        data['est_pos_qf'] = record.pos_qf
+    if record.acc is not None:
+        data['acc'] = {'x': record.acc[0], 'y': record.acc[1], 'z': record.acc[2]}
+    if record.uwb_time is not None:
+        data['timestamp'] = record.uwb_time
+    return data
+
+
+class DistStreamParser(object):
+    """ Incremental parser over the raw UART byte stream, for read() instead of
+        readline(): feed() any chunk of bytes and get the records of the lines
+        completed by it. A partial line is kept until its end arrives.
+    """
+    def __init__(self, max_line=4096):
+        self.buffer = b''
+        self.max_line = max_line
+        self.lines = 0
+        self.skipped = 0
+
+    def feed(self, data):
+        lines = (self.buffer + data).split(b'\n')
+        self.buffer = lines.pop()
+        if len(self.buffer) > self.max_line:
+            # no line end in sight, garbage on the line
+            self.buffer = b''
+            self.skipped += 1
+        records = parse_dist_lines(lines)
+        self.lines += len(lines)
+        self.skipped += len(lines) - len(records)
+        return records
+
+
+if __name__ == "__main__":
+    # Micro-benchmark against the regex parsers on the recorded lines of their docstrings
+    import random
+    from utils import make_json_dict_oem, make_json_dict_accel_en
+    oem_lines = [b"DIST,4,AN0,022E,7.94,8.03,0.00,3.44,AN1,9280,7.95,0.00,0.00,5.68,AN2,DCAE,0.00,8.03,0.00,7.76,"
+                 b"AN3,5431,0.00,0.00,0.00,8.73,POS,6.95,5.37,-1.97,52\r\n",
+                 b"DIST,4,AN0,0090,0.00,0.00,0.00,3.25,AN1,D91E,0.00,0.00,0.00,3.33,AN2,0487,0.00,0.00,0.00,0.18,"
+                 b"AN3,15BA,0.00,0,AN3,15BA,0.00,0.00,0.00,0.00\r\n"]
+    accel_en_lines = [b"DIST,4;[AN0,C584,160,0,-1510]=[1176,100];[AN1,8287,-2700,0,1340]=[2801,100];"
+                      b"[AN2,DA36,400,3250,790]=[2838,100];[AN3,9234,2910,-2984,550]=[3058,100];"
+                      b"POS=[502,827,803,58];ACC=[-512,768,9449];UWBLOCALTIME,38439537;\r\n"]
+    for line in oem_lines:
+        assert as_json_dict(parse_dist_line(line)) == make_json_dict_oem(str(line, encoding="UTF-8").rstrip())
+    for line in accel_en_lines:
+        assert as_json_dict(parse_dist_line(line)) == make_json_dict_accel_en(str(line, encoding="UTF-8").rstrip())
+
+    # A stream of the same anchors as reported while the tag moves: new distances, position and
+    # UWBLOCALTIME on every line, every 100th OEM line the convoluted one
+    rng = random.Random(0)
+    oem_stream = [oem_lines[1] if i % 100 == 99 else
+                  b"DIST,4,AN0,022E,7.94,8.03,0.00,%.2f,AN1,9280,7.95,0.00,0.00,%.2f,AN2,DCAE,0.00,8.03,0.00,%.2f,"
+                  b"AN3,5431,0.00,0.00,0.00,%.2f,POS,%.2f,%.2f,-1.97,%d\r\n"
+                  % tuple([rng.uniform(0, 12) for _ in range(6)] + [rng.randint(40, 60)]) for i in range(10000)]
+    accel_en_stream = [b"DIST,4;[AN0,C584,160,0,-1510]=[%d,100];[AN1,8287,-2700,0,1340]=[%d,100];"
+                       b"[AN2,DA36,400,3250,790]=[%d,100];[AN3,9234,2910,-2984,550]=[%d,100];"
+                       b"POS=[%d,%d,803,58];ACC=[%d,768,9449];UWBLOCALTIME,%d;\r\n"
+                       % tuple([rng.randint(0, 12000) for _ in range(6)] + [rng.randint(-600, 600), 38439537 + 100000 * i])
+                       for i in range(10000)]
+
+    def best_rate(parse, lines, passes=5):
+        # lines/s of the best of the passes, the machine is not always ours alone
+        best = float("inf")
+        for _ in range(passes):
+            start = time.perf_counter()
+            parse()
+            best = min(best, time.perf_counter() - start)
+        return len(lines) / best
+
+    def feed_chunks(data):
+        parser = DistStreamParser()
+        for offset in range(0, len(data), 4096):
+            parser.feed(data[offset:offset + 4096])
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print("lines/s      {:>10} {:>10} {:>12} {:>8} {:>8}".format("regex", "line", "feed 4 kB", "line", "feed"))
+    for name, lines, regex_parser in (("oem", oem_lines, make_json_dict_oem),
+                                      ("oem stream", oem_stream, make_json_dict_oem),
+                                      ("accel_en", accel_en_lines, make_json_dict_accel_en),
+                                      ("accel_en stream", accel_en_stream, make_json_dict_accel_en)):
+        lines = lines * (n // len(lines))
+        data = b"".join(lines)
+        regex_rate = best_rate(lambda: [regex_parser(str(line, encoding="UTF-8").rstrip()) for line in lines], lines)
+        line_rate = best_rate(lambda: [parse_dist_line(line) for line in lines], lines)
+        feed_rate = best_rate(lambda: feed_chunks(data), lines)
+        print("{:<15} {:>8.0f} {:>10.0f} {:>12.0f} {:>7.1f}x {:>7.1f}x".format(
+            name, regex_rate, line_rate, feed_rate, line_rate / regex_rate, feed_rate / regex_rate))
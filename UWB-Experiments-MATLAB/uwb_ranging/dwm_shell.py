@@ -0,0 +1,120 @@
+import re, time
+
+PROMPT = b'dwm> '
+# The decawave shell buffer only takes at most 6 characters at once (by observation),
+# the next ones are written once the echo of the previous ones came back
+INPUT_CHUNK = 6
+
+
+class ShellCommandError(IOError):
+    pass
+
+
+def parse_sys_info(lines):
+    """ Parse the response lines of the "si" shell command
+
+        :returns:
+            Dictionary of system information: pan_id, device_id (hexadecimal), upd_rate
+    """
+    si = "\n".join(lines)
+    # PANID in hexadecimal
+    pan_id = re.search(r"(?<=uwb0\:\spanid=)(.{5})(?=\saddr=)", si)
+    # Device ID in hexadecimal
+    device_id = re.search(r"(?<=panid=.{6}addr=)(.{17})", si)
+    # Update rate of location reporting in int
+    upd_rate = re.search(r"(?<=upd_rate_stat=)(\d+)(?=\slabel=)", si)
+    if not (pan_id and device_id and upd_rate):
+        raise ShellCommandError("Incomplete system information: {}".format(si))
+    return {"pan_id": pan_id.group(0), "device_id": device_id.group(0), "upd_rate": int(upd_rate.group(0))}
+
+
+class DwmShell(object):
+    """ Command session on the UART shell of a DWM1001: a command is typed in
+        chunks of INPUT_CHUNK characters, each one as soon as the echo of the
+        previous one returns, and its response is read until the "dwm> "
+        prompt, so a round trip takes as long as the device needs to answer.
+        A command that times out is cleared from the shell's input line and
+        retried.
+    """
+    def __init__(self, serial_port, timeout=1.0, retries=2, enter_delay=0.5):
+        self.port = serial_port
+        self.timeout = timeout
+        self.retries = retries
+        self.enter_delay = enter_delay
+        self.last_round_trip = None
+        self.retried = 0
+
+    def _read_until(self, expected, timeout):
+        saved = self.port.timeout
+        self.port.timeout = timeout
+        try:
+            return self.port.read_until(expected)
+        finally:
+            self.port.timeout = saved
+
+    def _type(self, data, deadline):
+        for start in range(0, len(data), INPUT_CHUNK):
+            chunk = data[start:start + INPUT_CHUNK]
+            self.port.write(chunk)
+            if not self._read_until(chunk, max(deadline - time.monotonic(), 0)).endswith(chunk):
+                raise ShellCommandError("No echo of {!r}".format(chunk))
+
+    def enter(self, retries=None):
+        """ Switch to the shell mode with the double enter (carriage return) as
+            specified by Decawave, or check the shell is responding if it already is.
+            The second enter only follows after enter_delay if nothing came back.
+        """
+        retries = self.retries if retries is None else retries
+        for _ in range(retries + 1):
+            self.port.reset_input_buffer()
+            self.port.write(b'\x0D')
+            if self._read_until(PROMPT, self.enter_delay).endswith(PROMPT):
+                return True
+            self.port.write(b'\x0D')
+            if self._read_until(PROMPT, self.timeout).endswith(PROMPT):
+                return True
+            self.retried += 1
+        raise ShellCommandError("Shell of {} not responding".format(self.port.name))
+
+    def command(self, command, timeout=None, retries=None, wait_prompt=True):
+        """ Run a shell command, e.g. "si" or b"aurs 600 600". With wait_prompt
+            False (commands that start the location reporting), it returns as
+            soon as the command is typed.
+
+            :returns:
+                List of the response lines, without the echo, the prompt and the DIST reporting lines
+        """
+        timeout = self.timeout if timeout is None else timeout
+        retries = self.retries if retries is None else retries
+        data = (command.encode() if isinstance(command, str) else command).rstrip(b'\x0D')
+        error = None
+        for attempt in range(retries + 1):
+            start = time.monotonic()
+            try:
+                self.port.reset_input_buffer()
+                self._type(data, start + timeout)
+                self.port.write(b'\x0D')
+                if not wait_prompt:
+                    return []
+                response = self._read_until(PROMPT, max(start + timeout - time.monotonic(), 0))
+                if not response.endswith(PROMPT):
+                    raise ShellCommandError("No prompt after {!r}".format(data))
+            except ShellCommandError as exp:
+                error = exp
+                self.retried += 1
+                # clear the partially typed command from the shell's input line
+                self.port.write(b'\x0D')
+                self._read_until(PROMPT, self.timeout)
+                continue
+            self.last_round_trip = time.monotonic() - start
+            lines = response[:-len(PROMPT)].decode("ascii", errors="replace").splitlines()
+            return [line.strip() for line in lines if line.strip() and not line.startswith("DIST")]
+        raise ShellCommandError("Shell command {!r} failed after {} attempt(s): {}".format(data, retries + 1, error))
+
+    def sys_info(self, timeout=None, retries=None):
+        """ Run "si"
+
+            :returns:
+                Dictionary of system information
+        """
+        return parse_sys_info(self.command(b'si', timeout, retries))
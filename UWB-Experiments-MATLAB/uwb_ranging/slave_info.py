@@ -0,0 +1,112 @@
+import sys, time, struct
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
+
+# The slaves' informative position is burned into the anchor position the
+# dwm-accelerometer-enabled firmware reports: of the 12 bytes of the int32 LE
+# x, y, z (mm)
+#
+#    byte   0    1    2    3    4    5    6    7    8    9   10   11
+#          --  x_slave   y_lo  --  y_hi  z_slave    --  id   --   --
+#
+# x_slave, y_slave, z_slave are int16, id_assoc uint8, the unused bytes (--)
+# are burned as 0. The burning sometimes leaves the x word one float32 step
+# off (1 unit of drift on x_slave, the 2nd byte is the culprit), which shows
+# as a non-zero byte 0: flagged as x_drift, any other non-zero unused byte as
+# mismatch.
+
+# per anchor, the x column: byte 0, x_slave, y_lo; the y column: byte 4, y_hi, z_slave;
+# the z column: byte 8, id, bytes 10-11
+_X_COLUMN, _Y_COLUMN, _Z_COLUMN = "BhB", "BBh", "BBH"
+
+# slave info columns of many anchor reports, see decode_slave_info_arrays()
+SlaveInfo = namedtuple("SlaveInfo", ["x_slave", "y_slave", "z_slave", "id_assoc", "x_drift", "mismatch"])
+
+
+@lru_cache(maxsize=None)
+def _frame_structs(k):
+    # packs the x, y, z columns of k anchors / unpacks the fields of all of them
+    return struct.Struct("<%di" % (3 * k)), struct.Struct("<" + _X_COLUMN * k + _Y_COLUMN * k + _Z_COLUMN * k)
+
+
+def decode_slave_info(anc_ids, anc_x, anc_y, anc_z, dist_to):
+    """ Decode the slave informative position of every anchor of one frame
+        from its reporting columns (e.g. of a DistRecord), with one pack and
+        one unpack for the whole frame.
+
+        :returns:
+            the dictionary decode_slave_info_position() makes, plus the
+            x_drift and mismatch flags per anchor
+    """
+    k = len(anc_ids)
+    slave_info_dict = {"all_anc_id": list(anc_ids)}
+    words, columns = _frame_structs(k)
+    fields = columns.unpack(words.pack(*anc_x, *anc_y, *anc_z))
+    for i, anc in enumerate(anc_ids):
+        x0, x_slave, y_lo = fields[3 * i:3 * i + 3]
+        y0, y_hi, z_slave = fields[3 * k + 3 * i:3 * k + 3 * i + 3]
+        z0, id_assoc, z_hi = fields[6 * k + 3 * i:6 * k + 3 * i + 3]
+        slave_info_dict[anc] = {'x_slave': x_slave,
+                                'y_slave': ((y_hi << 8 | y_lo) ^ 0x8000) - 0x8000,
+                                'z_slave': z_slave,
+                                'id_assoc': id_assoc,
+                                'dist_to': dist_to[i],
+                                'x_drift': x0 != 0,
+                                'mismatch': bool(y0 or z0 or z_hi)}
+    return slave_info_dict
+
+
+def decode_slave_info_arrays(anc_x, anc_y, anc_z):
+    """ Decode the slave informative position of any number of anchor reports
+        at once, e.g. the (frames, anchors) columns of a dist_log array: the
+        x, y, z words are packed into one 12 byte record per report and the
+        fields are read through uint8/int16 views of it.
+
+        :returns:
+            SlaveInfo of arrays, of the shape of anc_x
+    """
+    anc_x = np.asarray(anc_x)
+    raw = np.empty(anc_x.shape + (3,), dtype="<i4")
+    for i, column in enumerate((anc_x, anc_y, anc_z)):
+        raw[..., i] = np.asarray(column, dtype=np.int64)    # int32 wrap, as burned
+    data = raw.view(np.uint8)      # (..., 12)
+    x_slave = np.ascontiguousarray(data[..., 1:3]).view("<i2")[..., 0]
+    y_slave = (data[..., 3] | data[..., 5].astype(np.uint16) << 8).view(np.int16)
+    z_slave = np.ascontiguousarray(data[..., 6:8]).view("<i2")[..., 0]
+    return SlaveInfo(x_slave, y_slave, z_slave, data[..., 9].copy(), data[..., 0] != 0,
+                     (data[..., 4] | data[..., 8] | data[..., 10] | data[..., 11]) != 0)
+
+
+if __name__ == "__main__":
+    # Check against the byte by byte decoder and time one frame of each
+    from utils import decode_slave_info_position
+    frame = {'all_anc_id': ['459A', '0B1E'],
+             '459A': {'anc_id': '459A', 'x': -1525078912, 'y': -60523264, 'z': 63744, 'dist_to': 2833, 'anc_qf': 100},
+             '0B1E': {'anc_id': '0B1E', 'x': -870767360, 'y': -60522752, 'z': 64256, 'dist_to': 2969, 'anc_qf': 100}}
+    columns = [frame['all_anc_id']] + [[frame[anc][key] for anc in frame['all_anc_id']]
+                                       for key in ('x', 'y', 'z', 'dist_to')]
+    old = decode_slave_info_position(frame)
+    new = decode_slave_info(*columns)
+    arrays = decode_slave_info_arrays(*columns[1:4])
+    for i, anc in enumerate(frame['all_anc_id']):
+        assert {key: new[anc][key] for key in old[anc]} == old[anc]
+        assert (arrays.x_slave[i], arrays.y_slave[i], arrays.z_slave[i], arrays.id_assoc[i]) == \
+               (old[anc]['x_slave'], old[anc]['y_slave'], old[anc]['z_slave'], old[anc]['id_assoc'])
+        print(anc, new[anc])
+
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    start = time.perf_counter()
+    for _ in range(n):
+        decode_slave_info_position(frame)
+    old_rate = n / (time.perf_counter() - start)
+    start = time.perf_counter()
+    for _ in range(n):
+        decode_slave_info(*columns)
+    new_rate = n / (time.perf_counter() - start)
+    print("frames/s: bytearray {:.0f}, struct {:.0f} ({:.1f}x)".format(old_rate, new_rate, new_rate / old_rate))
+    xyz = [np.tile(column, n) for column in columns[1:4]]
+    start = time.perf_counter()
+    decode_slave_info_arrays(*xyz)
+    print("arrays: {:.0f} anchor reports/s".format(len(xyz[0]) / (time.perf_counter() - start)))
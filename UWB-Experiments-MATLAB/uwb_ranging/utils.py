@@ -3,6 +3,8 @@ from time import localtime
 import sys, time, json, re
 import atexit, signal
 
+from dwm_shell import DwmShell, ShellCommandError
+
 
 def reportlog(data: list()):
     """ This method logs the ranging data on daily basis.
@@ -69,6 +71,9 @@ def timestamp_log(incl_UTC=False):
 
 
 def write_shell_command(serial_port, command, delay=0.1):
+    """ Write the command bytes exactly as given, one at a time with delay in between,
+        without reading anything back. Use a DwmShell session to get the response.
+    """
     time.sleep(delay)
     for B in command:
         serial_port.write(bytes([B]))
@@ -121,11 +126,10 @@ def is_uwb_shell_ok(serial_port, verbose=False):
         :returns:
             True or False
     """
-    serial_port.reset_input_buffer()
-    write_shell_command(serial_port, command=b'\x0D\x0D')
-    if serial_port.in_waiting:
-        return True
-    return False
+    try:
+        return DwmShell(serial_port, retries=0).enter()
+    except ShellCommandError:
+        return False
 
 
 def is_reporting_loc(serial_port, timeout=1, verbose=False):
@@ -152,44 +156,29 @@ def parse_uart_sys_info(serial_port, oem_firmware=False, verbose=False, attempt=
         :returns:
             Dictionary of system information
     """
+    shell = DwmShell(serial_port)
     attempt_cnt = 0
     while attempt_cnt <= attempt:
         try:
             if verbose:
                 sys.stdout.write(timestamp_log() + "Fetching system information of UWB port {}, attempt: {}...\n".format(serial_port.name, attempt_cnt))
-            sys_info = {}
             if is_reporting_loc(serial_port):
                 if oem_firmware:
                     # Write "lec" to stop data reporting
-                    write_shell_command(serial_port, command=b'\x6C\x65\x63\x0D')
+                    shell.command(b'lec')
                 else:
                     # Write "aurs 600 600" to slow down data reporting into 60s/ea.
-                    write_shell_command(serial_port, command=b'\x61\x75\x72\x73\x20\x36\x30\x30\x20\x36\x30\x30\x0D') # "aurs 600 600\n"
-                    
+                    shell.command(b'aurs 600 600')
             # Write "si" to show system information of DWM1001
-            serial_port.reset_input_buffer()
-            write_shell_command(serial_port, command=b'\x73\x69\x0D')
-            byte_si = serial_port.read(serial_port.in_waiting)
-            si = str(byte_si)
+            sys_info = shell.sys_info()
             if verbose:
-                sys.stdout.write(timestamp_log() + "Raw system info of UWB port {} fetched as: \n".format(serial_port.name)
-                                 + str(byte_si, encoding="UTF-8") + "\n")
-            # PANID in hexadecimal
-            pan_id = re.search("(?<=uwb0\:\spanid=)(.{5})(?=\saddr=)", si).group(0)
-            sys_info["pan_id"] = pan_id
-            # Device ID in hexadecimal
-            device_id = re.search("(?<=panid=.{6}addr=)(.{17})", si).group(0)
-            sys_info["device_id"] = device_id
-            # Update rate of location reporting in int
-            upd_rate = re.search("(?<=upd_rate_stat=)(.*)(?=\slabel=)",si).group(0)
-            sys_info["upd_rate"] = int(upd_rate)
-            
+                sys.stdout.write(timestamp_log() + "System info of UWB port {} fetched as: {} ({:.0f} ms)\n"
+                                 .format(serial_port.name, sys_info, 1000 * shell.last_round_trip))
             return sys_info
-        except:
+        except ShellCommandError:
             attempt_cnt += 1
     sys.stdout.write(timestamp_log() + "Maximum attempt of {} to acquire system info of {} has reached. Failed. \n".format(attempt, serial_port.name))
     raise BaseException("UWB Shell Command Error")
-            
 
 
 def config_uart_settings(serial_port, settings):
@@ -325,6 +314,7 @@ def decode_slave_info_position(ranging_json_dict):
     # the 2nd byte in the bytearray is the culprit. However it might also resume normal after
     # some actions. Considering a validation process on the Android's side.
     # validation process: burn-validate-check-if-need-to-reburn-with-attempts
+    # slave_info.decode_slave_info() decodes a whole frame at once and flags the drift, this is the byte by byte reference.
     slave_info_dict = {}
     slave_info_dict["all_anc_id"] = ranging_json_dict.get("all_anc_id", [])
     for anc in ranging_json_dict.get("all_anc_id", []):
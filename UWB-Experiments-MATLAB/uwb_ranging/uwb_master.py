@@ -6,8 +6,11 @@ import time
 import subprocess, atexit, signal
 
 import threading
+import collections, queue
 
 from utils import *
+from dist_parser import parse_dist_line, as_json_dict
+from slave_info import decode_slave_info
 from lcd import *
 
 # On 02.28.2021: update note:
@@ -40,23 +43,24 @@ def parse_uart_init(serial_port, oem_firmware=False, pause_reporting=True):
         atexit.register(on_exit, serial_port, True)
         signal.signal(signal.SIGTERM, on_killed)
         # Double enter (carriage return) as specified by Decawave shell
-        # Extra delay is required to switch to shell mode. Insufficient delay will fail. 
-        write_shell_command(serial_port, command=b'\x0D\x0D', delay=0.5)
+        # Extra delay is required to switch to shell mode, the second enter waits for it unless the prompt is back.
+        shell = DwmShell(serial_port)
+        shell.enter()
         if oem_firmware:
             if is_reporting_loc(serial_port):
                 if pause_reporting:
                     # By default the update rate is 10Hz/100ms. Check again for data flow
                     # If data is flowing, stop the data flow (temporarily) to execute commands
-                    write_shell_command(serial_port, command=b'\x6C\x65\x63\x0D')
+                    shell.command(b'lec')
             return True
         else:
             # Type "av" command to config/init accelerometer
             # If accelerometer is not configured/init, acceleration will get wrong values
-            write_shell_command(serial_port, command=b'\x61\x76\x0D') 
+            shell.command(b'av')
             if is_reporting_loc(serial_port):            
                 if pause_reporting:
                     # Write "aurs 600 600" to slow down reporting into 60s/ea. (pause data reporting)
-                    write_shell_command(serial_port, command=b'\x61\x75\x72\x73\x20\x36\x30\x30\x20\x36\x30\x30\x0D')
+                    shell.command(b'aurs 600 600')
                 sys.stdout.write(timestamp_log() + "Serial port {} init success\n".format(serial_port.name))
             return True
     except:
@@ -89,10 +93,10 @@ def pairing_uwb_ports(uwb_config_dict, oem_firmware=False, init_reporting=True):
                     if not is_reporting_loc(p):
                         # Type "lec\n" to the dwm shell console to activate data reporting
                         if dev == a_end_master or dev == b_end_master:
-                            write_shell_command(p, command=b'\x6C\x65\x63\x0D')
+                            DwmShell(p).command(b'lec', wait_prompt=False)
                 else:
                     # Write "aurs 1 1" to speed up data reporting into 0.1s/ea. (resume data reporting)
-                    write_shell_command(p, command=b'\x61\x75\x72\x73\x20\x31\x20\x31\x0D')
+                    DwmShell(p).command(b'aurs 1 1', wait_prompt=False)
                 assert is_reporting_loc(p)
                 # TODO: Maybe later we can close the ports linking to the Slave/Anchors if no needs
     return serial_ports
@@ -101,81 +105,191 @@ def config_uart_settings(serial_port, settings):
     pass
 
 
-def end_ranging_thread_job(serial_ports, devs, data_ptrs, oem_firmware=False):
-    dev_a, dev_b = devs[0], devs[1]
-    data_pointer_a_end, data_pointer_b_end = data_ptrs[0], data_ptrs[1]
-    
-    port_a_info_dict, port_b_info_dict = serial_ports.get(dev_a), serial_ports.get(dev_b)
-    port_a, port_b = port_a_info_dict.get("port"), port_b_info_dict.get("port")
-    sys_info_a, sys_info_b = port_a_info_dict.get("sys_info"), port_b_info_dict.get("sys_info")
-    
-    atexit.register(on_exit, port_a, True)
-    atexit.register(on_exit, port_b, True)
+UWB_CLOCK_WRAP = 2 ** 32         # UWBLOCALTIME is a 32 bit us counter
+PAIRING_WINDOW_US = 50000        # A/B end frames at most this far apart (offset corrected UWBLOCALTIME) are paired
+OFFSET_WINDOW = 600              # frames over which the minimum clock offset of an end is taken
 
-    if not is_reporting_loc(port_a):
-        if oem_firmware:
-            # Type "lec\n" to the dwm shell console to activate data reporting
-            write_shell_command(port_a, command=b'\x6C\x65\x63\x0D') 
-        else:
-            # Write "aurs 1 1" to speed up data reporting into 0.1s/ea.
-            write_shell_command(port_a, command=b'\x61\x75\x72\x73\x20\x31\x20\x31\x0D')
-        
-    if not is_reporting_loc(port_b):        
+
+def uwb_clock_diff(t1, t0):
+    """ t1 - t0 in us for two UWBLOCALTIME readings, across the counter wrap.
+    """
+    return (t1 - t0 + UWB_CLOCK_WRAP // 2) % UWB_CLOCK_WRAP - UWB_CLOCK_WRAP // 2
+
+
+class ClockOffset(object):
+    """ Offset of a master's UWBLOCALTIME (its own time since boot, the two
+        masters are not synchronized) to the host clock: the minimum of
+        UWBLOCALTIME - host receive time over the last `window` frames, i.e.
+        the reading with the least UART/thread delay. Taking it over a window
+        instead of all time follows the drift of the two crystals.
+    """
+    def __init__(self, window=OFFSET_WINDOW):
+        self.window = window
+        self.reference = None
+        self.count = 0
+        self._minima = collections.deque()   # (count, diff to reference), increasing diffs
+        self.offset_us = None
+
+    def correct(self, uwb_time, received):
+        """ uwb_time on the host clock (us, wrapped as UWBLOCALTIME)
+        """
+        diff = uwb_clock_diff(uwb_time, int(received * 1e6) % UWB_CLOCK_WRAP)
+        if self.reference is None:
+            self.reference = diff
+        diff = uwb_clock_diff(diff, self.reference)
+        while self._minima and self._minima[-1][1] >= diff:
+            self._minima.pop()
+        self._minima.append((self.count, diff))
+        if self._minima[0][0] <= self.count - self.window:
+            self._minima.popleft()
+        self.count += 1
+        self.offset_us = self.reference + self._minima[0][1]
+        return (uwb_time - self.offset_us) % UWB_CLOCK_WRAP
+
+
+class EndFrameMerger(object):
+    """ Pairs the frames of the A end and the B end master by their UWBLOCALTIME,
+        corrected by the ClockOffset of each end to the host clock.
+
+        add() is fed the frames of both ends in arrival order (each end in its
+        own time order) and returns (frame_a, frame_b) once a frame has a
+        partner within window_us, the closest one. A frame that can no longer
+        be paired (the other end is past it by more than the window, or more
+        than max_pending frames wait) is dropped and counted as unpaired.
+        The pairing latency is the time the earlier frame of a pair waited.
+    """
+    def __init__(self, window_us=PAIRING_WINDOW_US, max_pending=32, offset_window=OFFSET_WINDOW):
+        self.window_us = window_us
+        self.pending = {"a": collections.deque(maxlen=max_pending), "b": collections.deque(maxlen=max_pending)}
+        self.offsets = {"a": ClockOffset(offset_window), "b": ClockOffset(offset_window)}
+        self.paired = 0
+        self.unpaired = {"a": 0, "b": 0}
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+
+    def add(self, end, uwb_time, received, frame):
+        uwb_time = self.offsets[end].correct(uwb_time, received)
+        other_end = "b" if end == "a" else "a"
+        other = self.pending[other_end]
+        while other and uwb_clock_diff(uwb_time, other[0][0]) > self.window_us:
+            other.popleft()
+            self.unpaired[other_end] += 1
+        best = None
+        for i, (other_time, _, _) in enumerate(other):
+            diff = abs(uwb_clock_diff(uwb_time, other_time))
+            if diff <= self.window_us and (best is None or diff < best[0]):
+                best = (diff, i)
+        if best is None:
+            if len(self.pending[end]) == self.pending[end].maxlen:
+                self.unpaired[end] += 1
+            self.pending[end].append((uwb_time, received, frame))
+            return None
+        for _ in range(best[1]):
+            other.popleft()
+            self.unpaired[other_end] += 1
+        _, other_received, other_frame = other.popleft()
+        latency = time.monotonic() - min(received, other_received)
+        self.paired += 1
+        self.latency_sum += latency
+        self.latency_max = max(self.latency_max, latency)
+        return (frame, other_frame) if end == "a" else (other_frame, frame)
+
+    def stats(self):
+        return {
+            "paired": self.paired,
+            "unpaired_a": self.unpaired["a"],
+            "unpaired_b": self.unpaired["b"],
+            "latency_ms_mean": 1000 * self.latency_sum / self.paired if self.paired else 0.0,
+            "latency_ms_max": 1000 * self.latency_max,
+            "offset_a_us": self.offsets["a"].offset_us,
+            "offset_b_us": self.offsets["b"].offset_us,
+        }
+
+
+def start_end_reporting(serial_port, oem_firmware=False):
+    if not is_reporting_loc(serial_port):
         if oem_firmware:
             # Type "lec\n" to the dwm shell console to activate data reporting
-            write_shell_command(port_b, command=b'\x6C\x65\x63\x0D') 
+            DwmShell(serial_port).command(b'lec', wait_prompt=False)
         else:
             # Write "aurs 1 1" to speed up data reporting into 0.1s/ea.
-            write_shell_command(port_b, command=b'\x61\x75\x72\x73\x20\x31\x20\x31\x0D')
-    
-    assert is_reporting_loc(port_a)
-    assert is_reporting_loc(port_b)
-    
-    super_frame_a, super_frame_b = 0, 0
-    port_a.reset_input_buffer()
-    port_b.reset_input_buffer()
+            DwmShell(serial_port).command(b'aurs 1 1', wait_prompt=False)
+    assert is_reporting_loc(serial_port)
 
+
+def end_reader_thread_job(serial_ports, end, dev, frame_queue, line_counts, oem_firmware=False):
+    """ Reads the reporting of one master at its own update rate and queues
+        (end, UWBLOCALTIME, received, (reporting dict, ranging results)) for the merger.
+        Frames without UWBLOCALTIME (OEM firmware) are timed by the host clock.
+        line_counts[end] counts the lines read and the skipped (non DIST, partial) lines.
+    """
+    port = serial_ports.get(dev).get("port")
+    super_frame = 0
+    port.reset_input_buffer()
     while True:
         try:
-            data_a = str(port_a.readline(), encoding="UTF-8").rstrip()
-            data_b = str(port_b.readline(), encoding="UTF-8").rstrip()
-            if not data_a[:4] == "DIST" or not data_b[:4] == "DIST":
+            line = port.readline()
+            received = time.monotonic()
+            line_counts[end]["lines"] += 1
+            # either firmware's DIST line, parsed on the raw bytes
+            record = parse_dist_line(line)
+            if record is None:
+                line_counts[end]["skipped"] += 1
                 continue
-            if oem_firmware:
-                uwb_reporting_dict_a, uwb_reporting_dict_b = make_json_dict_oem(data_a), make_json_dict_oem(data_b)
+            uwb_reporting_dict = as_json_dict(record)
+            if record.anc_qf is not None:
+                slave_reporting_dict = decode_slave_info(record.anc_ids, record.anc_x, record.anc_y, record.anc_z,
+                                                         record.dist_to)
             else:
-                uwb_reporting_dict_a, uwb_reporting_dict_b = make_json_dict_accel_en(data_a), make_json_dict_accel_en(data_b)
-            slave_reporting_dict_a, slave_reporting_dict_b = decode_slave_info_position(uwb_reporting_dict_a), decode_slave_info_position(uwb_reporting_dict_b)
-            uwb_reporting_dict_a['superFrameNumber'], uwb_reporting_dict_b['superFrameNumber'] = super_frame_a, super_frame_b
-                
-            ranging_results_a, ranging_results_b = [], []
-            for anc in uwb_reporting_dict_a.get("all_anc_id", []):
+                # the OEM firmware reports the anchor positions in m, nothing burned into them
+                slave_reporting_dict = {anc: {'dist_to': dist} for anc, dist in zip(record.anc_ids, record.dist_to)}
+            uwb_reporting_dict['superFrameNumber'] = super_frame
+            super_frame += 1
+            ranging_results = []
+            for anc in uwb_reporting_dict.get("all_anc_id", []):
                 if not serial_ports.get(anc):
                     # If the anchor/slave id is not recognized, it is from foreign vehicle.
-                    ranging_results_a.append((anc, slave_reporting_dict_a.get(anc, {})))
-            for anc in uwb_reporting_dict_b.get("all_anc_id", []):
-                if not serial_ports.get(anc):
-                    # If the anchor/slave id is not recognized, it is from foreign vehicle.
-                    ranging_results_b.append((anc, slave_reporting_dict_b.get(anc, {})))
-            
+                    ranging_results.append((anc, slave_reporting_dict.get(anc, {})))
             # Sort by proximity - nearest first
-            ranging_results_a.sort(key=lambda x: x[1].get("dist_to", float("inf")))
-            ranging_results_b.sort(key=lambda x: x[1].get("dist_to", float("inf")))
-            # Write/publish data
-            json_data_a, json_data_b = json.dumps(uwb_reporting_dict_a), json.dumps(uwb_reporting_dict_b)
-            # tag_client.publish("Tag/{}/Uplink/Location".format(tag_id[-4:]), json_data, qos=0, retain=True)
-            data_pointer_a_end[0], data_pointer_a_end[1] = uwb_reporting_dict_a, ranging_results_a
-            data_pointer_b_end[0], data_pointer_b_end[1] = uwb_reporting_dict_b, ranging_results_b
-            super_frame_a += 1
-            super_frame_b += 1
-             
+            ranging_results.sort(key=lambda x: x[1].get("dist_to", float("inf")))
+            uwb_time = record.uwb_time if record.uwb_time is not None else int(received * 1e6) % UWB_CLOCK_WRAP
+            frame_queue.put((end, uwb_time, received, (uwb_reporting_dict, ranging_results)))
         except Exception as exp:
-            data_a = str(port_a.readline(), encoding="UTF-8").rstrip()
-            data_b = str(port_b.readline(), encoding="UTF-8").rstrip()
-            sys.stdout.write(timestamp_log() + "End reporting thread failed. Last fetched UART data: A: {}; B: {}. Thread: {}\n"
-                             .format(data_a, data_b, threading.currentThread().getName()))
+            data = str(port.readline(), encoding="UTF-8").rstrip()
+            sys.stdout.write(timestamp_log() + "End reporting thread failed. Last fetched UART data: {}: {}. Thread: {}\n"
+                             .format(end.upper(), data, threading.currentThread().getName()))
             raise exp
-            sys.exit()
+
+
+def end_ranging_thread_job(serial_ports, devs, data_ptrs, oem_firmware=False, merger=None, line_counts=None):
+    """ Starts one reader thread per master and pairs their frames with an
+        EndFrameMerger. data_ptrs[0] / data_ptrs[1] get the A / B end
+        [reporting dict, ranging results] of every pair, both updated together.
+    """
+    dev_a, dev_b = devs[0], devs[1]
+    data_pointer_a_end, data_pointer_b_end = data_ptrs[0], data_ptrs[1]
+    merger = merger if merger is not None else EndFrameMerger()
+    line_counts = line_counts if line_counts is not None else {}
+
+    port_a, port_b = serial_ports.get(dev_a).get("port"), serial_ports.get(dev_b).get("port")
+    atexit.register(on_exit, port_a, True)
+    atexit.register(on_exit, port_b, True)
+    start_end_reporting(port_a, oem_firmware)
+    start_end_reporting(port_b, oem_firmware)
+
+    frame_queue = queue.Queue()
+    for end, dev in (("a", dev_a), ("b", dev_b)):
+        line_counts[end] = {"lines": 0, "skipped": 0}
+        threading.Thread(target=end_reader_thread_job,
+                         args=(serial_ports, end, dev, frame_queue, line_counts, oem_firmware),
+                         name="{} End Reader".format(end.upper()), daemon=True).start()
+    while True:
+        pair = merger.add(*frame_queue.get())
+        if pair is None:
+            continue
+        (uwb_reporting_dict_a, ranging_results_a), (uwb_reporting_dict_b, ranging_results_b) = pair
+        data_pointer_a_end[0], data_pointer_a_end[1] = uwb_reporting_dict_a, ranging_results_a
+        data_pointer_b_end[0], data_pointer_b_end[1] = uwb_reporting_dict_b, ranging_results_b
 
 
 if __name__ == "__main__":
@@ -193,11 +307,13 @@ if __name__ == "__main__":
     serial_ports = pairing_uwb_ports(config_data, init_reporting=True) 
     
     a_end_dist_ptr, b_end_dist_ptr = [{}, []], [{}, []]
+    merger, line_counts = EndFrameMerger(window_us=PAIRING_WINDOW_US), {}
     end_ranging_thread = threading.Thread(target=end_ranging_thread_job, 
                                             args=(serial_ports,
                                                   (a_end_master, b_end_master),
                                                   (a_end_dist_ptr, b_end_dist_ptr),),
-                                            name="A End Ranging",
+                                            kwargs={"merger": merger, "line_counts": line_counts},
+                                            name="End Ranging",
                                             daemon=True)
     lcd_init()
     end_ranging_thread.start()
@@ -217,4 +333,5 @@ if __name__ == "__main__":
 
         sys.stdout.write("A end reporting: " + repr(a_end_dist_ptr[1]) + "\n")
         sys.stdout.write("B end reporting: " + repr(b_end_dist_ptr[1]) + "\n")
+        sys.stdout.write("End pairing: " + repr(merger.stats()) + ", lines: " + repr(line_counts) + "\n")
         #sys.stdout.write(str(stp-stt)+"\n")